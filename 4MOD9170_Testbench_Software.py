@@ -20,10 +20,15 @@ from tkinter import messagebox
 from blabel import LabelWriter
 import psutil
 import re
+import statistics
 
 import io_board
 import comm_test_CM4
 import comm_test_STM
+import adc_calibration
+import current_trace
+import image_quality
+import dpm802
 import dpm802_1
 import dpm802_2
 import dpm802_3_voltmeter
@@ -361,6 +366,22 @@ class Tester():
         ]
     }
 
+    # Default limits of the rails checked by POWER_SUPPLY, "<rail>_min" and "<rail>_max" in the POWER_SUPPLY config override them
+    POWER_SUPPLY_LIMITS = {
+        "5V": (4.75, 5.25),
+        "3V3": (3.1, 3.5),
+        "3V3_RADAR": (3.135, 3.465),
+    }
+
+    # Maximum duration of the DPM802 measure of each rail, "voltage_measure_duration" in the config overrides them
+    RAIL_MEASURE_DURATIONS = {
+        "5V": 1.5,
+        "3V3": 1,
+        "3V3_RADAR": 1,
+    }
+
+    VoltageMeasure = collections.namedtuple(
+        typename="VoltageMeasure", field_names=["value", "nb_samples", "stdev", "duration", "status"])
 
     def __init__(self, testbench, config, logger=None, cm4logger = None):
         self.config = config
@@ -371,6 +392,7 @@ class Tester():
             self.logger = logging.getLogger(__name__)
         self.exit = False
         self.stop_cm4Thread = False
+        self.current_trace = None
 
     def initialize(self):
         self.io_board = io_board.IOBoard(port=self.config.get("io_board_port", None), config=self.config, logger=self.logger)
@@ -386,10 +408,16 @@ class Tester():
             self.tests_recorder = tests_recorder.TestsRecorder(recording_file_path=self.config.get("recording_file_path", "automatic"), recording_server_url=self.config.get(
                 "recording_server_url", "https://pego-pod-api.azurewebsites.net/Pod/AddPods"), config=self.config, logger=self.logger)
 
-        """self.dpm802_ampermeter_1 = dpm802_1.DPM802_1(port=self.config.get("dpm802_1_port", None), config=self.config, logger=self.logger)
-        self.dpm802_ampermeter_2 = dpm802_2.DPM802_2(port=self.config.get("dpm802_2_port", None), config=self.config, logger=self.logger)"""
         self.dpm802_voltmeter = dpm802_3_voltmeter.DPM802_VOLTMETER(port=self.config.get("dpm802_3_voltmeter_port", None), config=self.config, logger=self.logger)
 
+        # The meters stream in parallel on their own ports, their samples share the same timeline
+        meters = {"voltage": self.dpm802_voltmeter}
+        if self.config.get("dpm802_ammeters_enabled", False):
+            self.dpm802_ampermeter_1 = dpm802_1.DPM802_1(port=self.config.get("dpm802_1_port", None), config=self.config, logger=self.logger)
+            self.dpm802_ampermeter_2 = dpm802_2.DPM802_2(port=self.config.get("dpm802_2_port", None), config=self.config, logger=self.logger)
+            meters.update({"current_1": self.dpm802_ampermeter_1, "current_2": self.dpm802_ampermeter_2})
+        self.meters = dpm802.DPM802Group(meters, config=self.config, logger=self.logger)
+
 
         self.logger.debug(f"IOBoard port : {self.io_board.port_name()}")
         self.logger.debug(f"IOBoard version : {self.io_board.read_version()}")
@@ -397,30 +425,32 @@ class Tester():
 
         self.io_board.reset()
         time.sleep(0.5)
+        self.io_board.detect_protocol()
+        self.io_board.calibrate_turnaround()
+
+        # The rails are measured with the IO Board ADC once it is calibrated against the DPM802 voltmeter of this bench
+        self.adc_calibration = adc_calibration.ADCCalibration(self.io_board.read_id(), config=self.config, logger=self.logger)
+        self.voltage_measure_adc_enabled = self.config.get("voltage_measure_adc", True)
 
         if not self.reset_jig():
             raise Tester.TesterException("Coudn't reset jig !")   # it make stop the dpm802
 
-        """try:
-            self.dpm802_1.read_measure()
-        except TimeoutError as ex:
-            self.io_board.toggle_dpm802_1()
-            time.sleep(0.5)
-            self.dpm802_1.read_measure()
+        meters_rs232 = [(self.dpm802_voltmeter, self.io_board.toggle_dpm802_voltmeter_rs232)]
+        if self.config.get("dpm802_ammeters_enabled", False):
+            meters_rs232 += [(self.dpm802_ampermeter_1, self.io_board.toggle_dpm802_1), (self.dpm802_ampermeter_2, self.io_board.toggle_dpm802_2)]
 
-        try:
-            self.dpm802_2.read_measure()
-        except TimeoutError as ex:
-            self.io_board.toggle_dpm802_2()
-            time.sleep(0.5)
-            self.dpm802_2.read_measure()"""
+        for (meter, toggle_rs232) in meters_rs232:
+            try:
+                meter.read_measure()
+            except TimeoutError as ex:
+                toggle_rs232()
+                time.sleep(0.5)
+                meter.read_measure()
 
-        try:
-            self.dpm802_voltmeter.read_measure()
-        except TimeoutError as ex:
-            self.io_board.toggle_dpm802_voltmeter_rs232()
-            time.sleep(0.5)
-            self.dpm802_voltmeter.read_measure()
+        # Frames are decoded continuously, the measures don't wait for a fresh frame anymore.
+        # The ammeters are only read in the background, they need it.
+        if self.config.get("dpm802_streaming", True) or self.config.get("dpm802_ammeters_enabled", False):
+            self.meters.start()
 
         #self.set_dpm802_1_function(dpm802_1.DPM802_1.Function.CURRENT_MA)
         #self.set_dpm802_2_function(dpm802_2.DPM802_2.Function.CURRENT_MA)
@@ -440,36 +470,13 @@ class Tester():
             (io_board.IOBoard.GPIO.EN_SWA, 1)
         ])
 
-        #Check 5V : TP18
-        self.logger.info("Measure 5V TP18")
-        self.io_board.write_gpios([
-            (io_board.IOBoard.GPIO.A0_SWA, 1),
-            (io_board.IOBoard.GPIO.A1_SWA, 0),
-            (io_board.IOBoard.GPIO.A2_SWA, 0)
-        ])
-        time.sleep(0.1)
-        measures.append(self.voltage_measure_average(self.config.get("voltage_measure_duration", 1.5)))
-
-        #Check 3V3 : TP11
-        self.logger.info("Measure 3V3 TP11")
-        self.io_board.write_gpios([
-            (io_board.IOBoard.GPIO.A0_SWA, 1),
-            (io_board.IOBoard.GPIO.A1_SWA, 1),
-            (io_board.IOBoard.GPIO.A2_SWA, 0)
-        ])
-        time.sleep(0.1)
-        measures.append(self.voltage_measure_average(self.config.get("voltage_measure_duration", 1)))
-
-        #Check 3V3_RADAR : TP17
-        self.logger.info("Measure 3V3_RADAR TP17")
-        self.io_board.write_gpios([
-            (io_board.IOBoard.GPIO.A0_SWA, 0),
-            (io_board.IOBoard.GPIO.A1_SWA, 1),
-            (io_board.IOBoard.GPIO.A2_SWA, 0)
-        ])
-        time.sleep(0.1)
-        measures.append(self.voltage_measure_average(self.config.get("voltage_measure_duration", 1)))
-
+        # Check 5V : TP18, 3V3 : TP11 and 3V3_RADAR : TP17
+        # The IO Board scans every rail in a single exchange, the DPM802 only measures what the ADC can't decide
+        rails = ["5V", "3V3", "3V3_RADAR"]
+        scans = self.scan_rails_adc(rails)
+        for rail in rails:
+            self.logger.info(f"Measure {rail}")
+            measures.append(self.measure_rail(rail, self.config.get("voltage_measure_duration", Tester.RAIL_MEASURE_DURATIONS[rail]), scans.get(rail)))
 
         self.io_board.write_gpios([
             (io_board.IOBoard.GPIO.SELECT_TARGET_VOLT_MEAS, 0),
@@ -477,11 +484,81 @@ class Tester():
             (io_board.IOBoard.GPIO.EN_POWER_POE, 0)
         ])
 
-        voltage = {"5V": measures[0], "3V3": measures[1], "3V3_RADAR": measures[2]}
+        voltage = {rail: measure.value for (rail, (measure, currents)) in zip(rails, measures)}
+        # Samples count, standard deviation, duration and exit reason of each measure
+        voltage["measures"] = {rail: measure._asdict() for (rail, (measure, currents)) in zip(rails, measures)}
+        # Mean current of each ammeter while the rail was measured
+        if len(self.meters.meters) > 1:
+            voltage["currents"] = {rail: currents for (rail, (measure, currents)) in zip(rails, measures)}
         return voltage
 
-    def POWER_SUPPLY_check(self, online_test_results, context,  exit_signal, result=None):
+    def measure_rail(self, rail, max_duration, scan=None):
+        # The ammeters are averaged over the window of the voltage measure
+        start = time.time()
+        limits = self.power_supply_limits(rail)
+        measure = None
+        if scan is not None:
+            measure = self.voltage_measure_adc(scan, limits)
+        if measure is None:
+            # No calibration yet or borderline reading, the DPM802 voltmeter decides
+            self.io_board.select_rail(rail)
+            time.sleep(0.1)
+            measure = self.voltage_measure_adaptive(limits, max_duration)
+            if (scan is not None) and (measure.status == "converged") and not io_board.IOBoard.adc_saturated(scan.mean_mv):
+                self.adc_calibration.add_point(io_board.IOBoard.ADCChannel.VOLT_MEAS, (scan.mean_mv / 1000), measure.value)
+                self.adc_calibration.save()
+
+        # The ADC measure is too short for the ammeters, their last samples are used instead
+        start = min(start, (time.time() - self.config.get("dpm802_group_hold", 1.0)))
+        currents = {name: value for (name, value) in self.meters.means(start).items() if name != "voltage"}
+        return (measure, currents)
+
+    def scan_rails_adc(self, rails):
+        # Raw ADC scan of the rails, empty if the ADC can't be used
+        if not self.voltage_measure_adc_enabled:
+            return {}
+
+        start = time.time()
+        try:
+            scans = self.io_board.scan_rails(rails, settle=self.config.get("voltage_measure_adc_settle", 0.1),
+                                             nb_samples=self.config.get("voltage_measure_adc_samples", 32))
+        except (io_board.IOBoard.IOBoardException, TimeoutError) as ex:
+            self.logger.warning(f"IO Board ADC not available, the rails are measured with the DPM802 only : {ex}")
+            self.voltage_measure_adc_enabled = False
+            return {}
+
+        self.logger.debug(f"ADC scan in {(time.time() - start):.3f}seconds : {scans}")
+        return scans
+
+    def voltage_measure_adc(self, scan, limits):
+        # Calibrated measure of a rail scan, None if the DPM802 has to measure
+        channel = io_board.IOBoard.ADCChannel.VOLT_MEAS
+        if io_board.IOBoard.adc_saturated(scan.mean_mv):
+            self.logger.debug("ADC saturated, the rail is above its range")
+            return None
+        if not self.adc_calibration.is_calibrated(channel):
+            self.logger.debug(f"ADC not calibrated yet ({(scan.mean_mv / 1000):.4f}V raw)")
+            return None
+
+        average = self.adc_calibration.apply(channel, (scan.mean_mv / 1000))
+        stdev = (self.adc_calibration.channels[channel.name]["gain"] * (scan.stdev_mv / 1000))
+
+        # Readings close to the limits, within the calibration error, are confirmed by the DPM802
+        guard = max(self.config.get("voltage_measure_adc_guard", 0.02), (3 * self.adc_calibration.residual(channel)))
+        (voltage_min, voltage_max) = limits
+        if not ((voltage_min + guard) < average < (voltage_max - guard)):
+            self.logger.info(f"ADC measure {average:.4f}V too close to the limits, measure with the DPM802")
+            return None
+
+        self.logger.info(f"ADC average over {scan.nb_samples} samples : {average} (stdev {stdev:.4f})")
+        return Tester.VoltageMeasure(average, scan.nb_samples, stdev, 0.0, "adc")
+
+    def power_supply_limits(self, rail):
         power_supplyConfig = self.config.get("POWER_SUPPLY",{})
+        (voltage_min, voltage_max) = Tester.POWER_SUPPLY_LIMITS[rail]
+        return (power_supplyConfig.get(f"{rail}_min", voltage_min), power_supplyConfig.get(f"{rail}_max", voltage_max))
+
+    def POWER_SUPPLY_check(self, online_test_results, context,  exit_signal, result=None):
         correct_voltage = True
 
         if result is None:
@@ -489,20 +566,37 @@ class Tester():
             return False
 
         self.logger.info(f'5V measured :{result.get("5V")}')
-        if not (power_supplyConfig.get("5V_min", 4.75) < result.get("5V") < power_supplyConfig.get("5V_max", 5.25)):
+        (voltage_min, voltage_max) = self.power_supply_limits("5V")
+        if not (voltage_min < result.get("5V") < voltage_max):
             self.logger.error("Wrong voltage for 5V !")
             correct_voltage = False
 
         self.logger.info(f'3V3 measured : {result.get("3V3")}')
-        if not (power_supplyConfig.get("3V3_min", 3.1) < result.get("3V3") < power_supplyConfig.get("3V3_max", 3.5)):
+        (voltage_min, voltage_max) = self.power_supply_limits("3V3")
+        if not (voltage_min < result.get("3V3") < voltage_max):
             self.logger.error("Wrong voltage for 3V3 !")
             correct_voltage = False
 
         self.logger.info(f'3V3_RADAR measured :{result.get("3V3_RADAR")}')
-        if not (power_supplyConfig.get("3V3_RADAR_min", 3.135) < result.get("3V3_RADAR") < power_supplyConfig.get("3V3_RADAR_max", 3.465)):
+        (voltage_min, voltage_max) = self.power_supply_limits("3V3_RADAR")
+        if not (voltage_min < result.get("3V3_RADAR") < voltage_max):
             self.logger.error("Wrong voltage for 3V3 !")
             correct_voltage = False
 
+        # Optional "<ammeter>_min" and "<ammeter>_max" limits, in mA
+        power_supplyConfig = self.config.get("POWER_SUPPLY",{})
+        for (rail, currents) in result.get("currents", {}).items():
+            for (name, current) in currents.items():
+                self.logger.info(f"{name} measured during {rail} : {current}")
+                current_min = power_supplyConfig.get(f"{name}_min", None)
+                current_max = power_supplyConfig.get(f"{name}_max", None)
+                if ((current_min is not None) or (current_max is not None)) and (current is None):
+                    self.logger.error(f"No {name} measure during {rail} !")
+                    correct_voltage = False
+                elif ((current_min is not None) and (current < current_min)) or ((current_max is not None) and (current > current_max)):
+                    self.logger.error(f"Wrong {name} during {rail} !")
+                    correct_voltage = False
+
         return correct_voltage
 
 
@@ -526,11 +620,40 @@ class Tester():
 
         self.io_board.write_gpio(io_board.IOBoard.GPIO.EN_POWER_POE, 0)
         time.sleep(4)
+        # The current is traced from the power on until the CM4 is logged in (see INIT_SOM)
+        trace = self.start_current_trace()
         self.io_board.write_gpio(io_board.IOBoard.GPIO.EN_POWER_POE, 1)
+        if trace is not None:
+            trace.mark("power_on")
+        self.comm_test_STM.reset_baudrate()
         time.sleep(3)
 
         return flash_stm
 
+    def start_current_trace(self):
+        source = self.config.get("current_trace_source", "auto")
+        if source == "disabled":
+            return None
+
+        trace = None
+        if source in ["auto", "io_board"]:
+            try:
+                if self.io_board.read_current() is not None:
+                    trace = current_trace.CurrentTrace(read_current=(lambda: self.io_board.read_current(stats=False)), name="io_board", config=self.config, logger=self.logger)
+            except (io_board.IOBoard.IOBoardException, TimeoutError) as ex:
+                self.logger.warning(f"IO Board current not available : {ex}")
+
+        meter_name = self.config.get("current_trace_meter", "current_1")
+        if (trace is None) and (source in ["auto", "dpm802"]) and (meter_name in self.meters.meters):
+            trace = current_trace.CurrentTrace(meter=self.meters[meter_name], name=meter_name, config=self.config, logger=self.logger)
+
+        if trace is None:
+            self.logger.debug("No current source, the power on current is not traced")
+            return None
+
+        self.current_trace = trace.start()
+        return self.current_trace
+
     def INIT_SOM_perform(self, context, exit_signal):
         self.io_board.write_gpio(io_board.IOBoard.GPIO.EN_POWER_POE, 1)
 
@@ -556,6 +679,10 @@ class Tester():
         to = threading.Thread(name="cm4_thread_timeout", target=thread_timeout, args=(self, t, timeout))
         to.start()
         context["timeout_cm4_thread"]=to
+
+        # The trace goes on through the CM4 boot, the IO Board is shared with the following tests
+        if self.current_trace is not None:
+            self.current_trace.stop_when(lambda: ((not t.is_alive()) or ("logged_in" in self.comm_test_CM4.get_boot_milestones())))
         return True
 
     def HEAT_SENSOR_perform(self, context, exit_signal):
@@ -818,26 +945,25 @@ class Tester():
         self.comm_test_STM.set_OFF_GPIOs()
         time.sleep(0.1)
 
-        measures = []
-        measures.append(self.io_board.read_gpio(io_board.IOBoard.GPIO.GP0))
-        measures.append(self.io_board.read_gpio(io_board.IOBoard.GPIO.GP1))
-        measures.append(self.io_board.read_gpio(io_board.IOBoard.GPIO.GP2))
-        measures.append(self.io_board.read_gpio(io_board.IOBoard.GPIO.GP3))
-        measures.append(self.io_board.read_gpio(io_board.IOBoard.GPIO.GP4))
-        measures.append(self.io_board.read_gpio(io_board.IOBoard.GPIO.GP5))
+        EXTERNAL_GPIOS = [
+            io_board.IOBoard.GPIO.GP0,
+            io_board.IOBoard.GPIO.GP1,
+            io_board.IOBoard.GPIO.GP2,
+            io_board.IOBoard.GPIO.GP3,
+            io_board.IOBoard.GPIO.GP4,
+            io_board.IOBoard.GPIO.GP5,
+        ]
+
+        gpios = self.io_board.read_gpios(EXTERNAL_GPIOS)
+        measures = [gpios[gpio] for gpio in EXTERNAL_GPIOS]
         self.logger.debug(f"measures GPIOs OFF : {measures}")
 
         self.logger.info("Set GPIOs ON")
         self.comm_test_STM.set_ON_GPIOs()
         time.sleep(0.1)
 
-        measuresON = []
-        measuresON.append(self.io_board.read_gpio(io_board.IOBoard.GPIO.GP0))
-        measuresON.append(self.io_board.read_gpio(io_board.IOBoard.GPIO.GP1))
-        measuresON.append(self.io_board.read_gpio(io_board.IOBoard.GPIO.GP2))
-        measuresON.append(self.io_board.read_gpio(io_board.IOBoard.GPIO.GP3))
-        measuresON.append(self.io_board.read_gpio(io_board.IOBoard.GPIO.GP4))
-        measuresON.append(self.io_board.read_gpio(io_board.IOBoard.GPIO.GP5))
+        gpios = self.io_board.read_gpios(EXTERNAL_GPIOS)
+        measuresON = [gpios[gpio] for gpio in EXTERNAL_GPIOS]
         self.logger.debug(f"measures GPIOs ON : {measuresON}")
 
         self.comm_test_STM.set_OFF_GPIOs()
@@ -908,41 +1034,34 @@ class Tester():
         #Soft ask CM4 if connection with the ST is good
         self.boot_SOM(context)
 
-        gpios = {}
-        self.logger.info("Check WDG_SOM...")
-        self.comm_test_STM.wdg_som_on()
-        time.sleep(0.1)
-        wdg_som = self.comm_test_CM4.wdg_som()
-        gpios["WDG_SOM"] = wdg_som
-        self.comm_test_STM.wdg_som_off()
-
-        self.logger.info("Check GPIO_18...")
-        self.comm_test_STM.GPIO_18("ON")
-        time.sleep(0.1)
-        gpio_18 = self.comm_test_CM4.GPIO_18_script()
-        gpios["GPIO_18"] = gpio_18
-        self.comm_test_STM.GPIO_18("OFF")
+        # STM output to set during each CM4 script (on, off) and the script run alone
+        tests = {
+            "WDG_SOM": (self.comm_test_STM.wdg_som_on, self.comm_test_STM.wdg_som_off, self.comm_test_CM4.wdg_som),
+            "GPIO_18": ((lambda: self.comm_test_STM.GPIO_18("ON")), (lambda: self.comm_test_STM.GPIO_18("OFF")), self.comm_test_CM4.GPIO_18_script),
+            "GPIO_23": ((lambda: self.comm_test_STM.GPIO_23("ON")), (lambda: self.comm_test_STM.GPIO_23("OFF")), self.comm_test_CM4.GPIO_23_script),
+            "GPIO_24": ((lambda: self.comm_test_STM.GPIO_24("ON")), (lambda: self.comm_test_STM.GPIO_24("OFF")), self.comm_test_CM4.GPIO_24_script),
+            "GPIO_25": ((lambda: self.comm_test_STM.GPIO_25("ON")), (lambda: self.comm_test_STM.GPIO_25("OFF")), self.comm_test_CM4.GPIO_25_script),
+        }
+
+        def on_ready(name):
+            self.logger.info(f"Check {name}...")
+            tests[name][0]()
+            time.sleep(0.1)
 
-        self.logger.info("Check GPIO_23...")
-        self.comm_test_STM.GPIO_23("ON")
-        time.sleep(0.1)
-        gpio_23 = self.comm_test_CM4.GPIO_23_script()
-        gpios["GPIO_23"] = gpio_23
-        self.comm_test_STM.GPIO_23("OFF")
+        def on_result(name):
+            tests[name][1]()
 
-        self.logger.info("Check GPIO_24...")
-        self.comm_test_STM.GPIO_24("ON")
-        time.sleep(0.1)
-        gpio_24 = self.comm_test_CM4.GPIO_24_script()
-        gpios["GPIO_24"] = gpio_24
-        self.comm_test_STM.GPIO_24("OFF")
+        gpios = {}
+        if self.config.get("cm4_script_battery", True):
+            # A single CM4 command runs every script, the STM outputs are set on its handshakes
+            gpios = self.comm_test_CM4.run_script_battery(comm_test_CM4.CommTest.CONNEXION_SCRIPTS, on_ready, on_result)
 
-        self.logger.info("Check GPIO_25...")
-        self.comm_test_STM.GPIO_25("ON")
-        time.sleep(0.1)
-        gpio_25 = self.comm_test_CM4.GPIO_25_script()
-        gpios["GPIO_25"] = gpio_25
-        self.comm_test_STM.GPIO_25("OFF")
+        # One command per script for the ones the battery didn't run
+        for (name, (on, off, script)) in tests.items():
+            if name not in gpios:
+                on_ready(name)
+                gpios[name] = script()
+                on_result(name)
 
         self.io_board.write_gpio(io_board.IOBoard.GPIO.EN_UART_STM32, 0)
         return gpios
@@ -996,11 +1115,42 @@ class Tester():
         output = self.comm_test_CM4.take_image()
         result[0] = output
 
-        img = self.comm_test_CM4.check_image()
-        result[1] = img
+        # The image can be checked on the host, the CM4 check stays the fallback
+        analysis = None
+        if self.config.get("image_check_on_host", False):
+            analysis = self.check_image_on_host(context)
+        if analysis is not None:
+            result[1] = analysis["message"]
+            result.append(analysis)
+        else:
+            img = self.comm_test_CM4.check_image()
+            result[1] = img
 
         return result
 
+    def check_image_on_host(self, context):
+        # The image is transferred from the CM4, analyzed and archived with the test results
+        cm4_image_path = self.config.get("cm4_image_path", "./PI_Tests/image.jpg")
+        data = self.comm_test_CM4.read_file(cm4_image_path)
+        if data is None:
+            return None
+
+        try:
+            analysis = image_quality.analyze(data, self.config)
+        except (OSError, ValueError) as ex:
+            self.logger.error(f"Invalid image : {ex}")
+            return None
+
+        folder = self.config.get("image_archive_path", "./tests_results/images")
+        os.makedirs(folder, exist_ok=True)
+        name = "_".join([datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")] + ([context["UID"]] if context.get("UID") else []))
+        analysis["path"] = os.path.join(folder, f"{name}{os.path.splitext(cm4_image_path)[1]}")
+        with open(analysis["path"], "wb") as f:
+            f.write(data)
+
+        self.logger.info(f"Image analysis : {analysis}")
+        return analysis
+
     def TAKE_PICTURE_check(self, online_test_results, context, exit_signal, result=None):
         if result is None:
             self.logger.error("No data provided")
@@ -1015,9 +1165,10 @@ class Tester():
         self.boot_SOM(context)
         self.logger.info("CM4 correctly boot")
         self.logger.info("Start CM4 ID script...")
-        data = self.comm_test_CM4.cm4_ID_script()
+        identity = self.comm_test_CM4.cm4_ID_script()
 
-        return data
+        # Stored in the test results, the field names are kept in the JSON
+        return (None if identity is None else identity._asdict())
 
     def GET_SECURITY_KEYS_check(self, online_test_results, context, exit_signal, result=None):
         if result is None:
@@ -1038,45 +1189,32 @@ class Tester():
         online_test_results["pods"][0]["PodSerial"] = pod_serial
         context["pod_serial"] = pod_serial
 
-        try:
-            self.logger.info("CPU_Serial...")
-            cpu_serial = (re.search(r"CPU_Serial\s*:\s*([0-9a-fA-F]{16})", result)).group(1)
-            online_test_results["pods"][0]["SOM"]["CPUSerial"] = cpu_serial
-            context["cpu_serial"] = cpu_serial
+        # CM4 values, validated when they were read
+        identity = comm_test_CM4.CommTest.CM4Identity(**result)
+        self.logger.info(f"CPU_Serial : {identity.cpu_serial}")
+        online_test_results["pods"][0]["SOM"]["CPUSerial"] = identity.cpu_serial
+        context["cpu_serial"] = identity.cpu_serial
 
-            self.logger.info("Ethernet_mac_address...")
-            ethernet_mac_address = (re.search(r"Ethermet_mac_address\s*:\s*([0-9a-fA-F]{2}:[0-9a-fA-F]{2}:[0-9a-fA-F]{2}:[0-9a-fA-F]{2}:[0-9a-fA-F]{2}:[0-9a-fA-F]{2})", result)).group(1)
-            online_test_results["pods"][0]["SOM"]["EthernetMACAddress"] = ethernet_mac_address
-            context["ethernet_mac_address"] = ethernet_mac_address
+        self.logger.info(f"Ethernet_mac_address : {identity.ethernet_mac_address}")
+        online_test_results["pods"][0]["SOM"]["EthernetMACAddress"] = identity.ethernet_mac_address
+        context["ethernet_mac_address"] = identity.ethernet_mac_address
 
-            self.logger.info("Wifi_mac_address...")
-            try:
-                wifi_mac_address = (re.search(r"Wifi_mac_address\s*:\s*([0-9a-fA-F]{2}:[0-9a-fA-F]{2}:[0-9a-fA-F]{2}:[0-9a-fA-F]{2}:[0-9a-fA-F]{2}:[0-9a-fA-F]{2})", result)).group(1)
-                online_test_results["pods"][0]["WifiEnabled"] = True
-                online_test_results["pods"][0]["SOM"]["WifiMACAddress"] = wifi_mac_address
-            except:
-                wifi_mac_address = (re.search(r"Wifi_mac_address\s*:\s*(WIFI NOT ENABLED)", result)).group(1)
-                online_test_results["pods"][0]["SOM"]["WifiMACAddress"] = wifi_mac_address
-                online_test_results["pods"][0]["WifiEnabled"] = False
-            context["wifi_mac_address"] = wifi_mac_address
-
-            self.logger.info("registration_id...")
-            registration_id = (re.search(r"Registration_ID\s*:\s*([0-9a-zA-Z]{52})", result)).group(1)
-            online_test_results["pods"][0]["TPM"]["RegistrationID"] = registration_id
-            context["registration_id"]=registration_id
-
-            self.logger.info("endorsment_key")
-            endorsment_key = (re.search(r"Endorsment_Key\s*:\s*(.{424})", result)).group(1)
-            online_test_results["pods"][0]["TPM"]["EndorsementKey"] = endorsment_key
-            context["endorsment_key"] = endorsment_key
-
-            self.logger.info("cam_serial")
-            cam_serial = (re.search(r"Cam_serial\s*:\s*([0-9]{8})", result)).group(1)
-            online_test_results["pods"][0]["CAMERA"]["CamSerial"] = cam_serial
-            context["cam_serial"] = cam_serial
-        except Exception as ex:
-            self.logger.error(ex)
-            return False
+        self.logger.info(f"Wifi_mac_address : {identity.wifi_mac_address}")
+        online_test_results["pods"][0]["SOM"]["WifiMACAddress"] = identity.wifi_mac_address
+        online_test_results["pods"][0]["WifiEnabled"] = (identity.wifi_mac_address != comm_test_CM4.CommTest.WIFI_NOT_ENABLED)
+        context["wifi_mac_address"] = identity.wifi_mac_address
+
+        self.logger.info(f"registration_id : {identity.registration_id}")
+        online_test_results["pods"][0]["TPM"]["RegistrationID"] = identity.registration_id
+        context["registration_id"] = identity.registration_id
+
+        self.logger.info("endorsment_key")
+        online_test_results["pods"][0]["TPM"]["EndorsementKey"] = identity.endorsment_key
+        context["endorsment_key"] = identity.endorsment_key
+
+        self.logger.info(f"cam_serial : {identity.cam_serial}")
+        online_test_results["pods"][0]["CAMERA"]["CamSerial"] = identity.cam_serial
+        context["cam_serial"] = identity.cam_serial
         return True
 
     def POD_PROVISION_perform(self, context, exit_signal):
@@ -1193,6 +1331,7 @@ class Tester():
             self.io_board.write_gpio(io_board.IOBoard.GPIO.EN_POWER_POE, 0)
             time.sleep(2)
             self.io_board.write_gpio(io_board.IOBoard.GPIO.EN_POWER_POE, 1)
+            self.comm_test_STM.reset_baudrate()
             time.sleep(3)
             self.stop_cm4Thread = False
             t = self.comm_test_CM4.connectSOM(self.exit_signal, self.stop_cm4_thread)
@@ -1283,29 +1422,66 @@ class Tester():
         with open(self.config.get("sequential_number_path", "./sequential_number/sequential_number.txt"), "w") as f:
             f.write(str(number+1))
 
-    def voltage_measure_average(self, measure_duration):
-        measure = []
+    def voltage_measure_adaptive(self, limits, max_duration):
+        # Stops as soon as the running mean is stable within the tolerance, or clearly out of the limits
+        tolerance = self.config.get("voltage_measure_tolerance", 0.005)
+        margin = self.config.get("voltage_measure_limits_margin", 0.1)
+        min_samples = max(2, self.config.get("voltage_measure_min_samples", 3))
+        skipped_nb = self.config.get("voltage_measure_skipped_samples", 1)
+        (voltage_min, voltage_max) = limits
+
+        skipped = []
+        values = []
+        means = []
+        status = "timeout"
         now = time.time()
-        timeout = (now + measure_duration)
+        timeout = (now + max_duration)
+        since = now
         while now < timeout:
-            measure.append(self.dpm802_voltmeter.read_measure().value)
-            self.logger.debug(f"voltage measured : {measure}")
+            try:
+                if self.dpm802_voltmeter.streaming():
+                    self.dpm802_voltmeter.wait_sample(since, (timeout - now))
+                    samples = self.dpm802_voltmeter.samples_since(since)
+                    since = (samples[-1].timestamp + 0.000001)
+                    new_values = [sample.value for sample in samples]
+                else:
+                    new_values = [self.dpm802_voltmeter.read_measure().value]
+            except TimeoutError:
+                break
             now = time.time()
 
-        if len(measure) <= 0:
+            for value in new_values:
+                # The first values don't seem reliable
+                if len(skipped) < skipped_nb:
+                    skipped.append(value)
+                    continue
+                values.append(value)
+                means.append(sum(values) / len(values))
+            self.logger.debug(f"voltage measured : {skipped + values}")
+
+            if len(values) < min_samples:
+                continue
+
+            if not ((voltage_min - margin) < means[-1] < (voltage_max + margin)):
+                status = "out_of_limits"
+                break
+
+            if (max(means[-min_samples:]) - min(means[-min_samples:])) <= tolerance:
+                status = "converged"
+                break
+
+        duration = (time.time() - (timeout - max_duration))
+        if len(values) <= 0:
+            # Better an unreliable value than nothing
+            values = skipped
+        if len(values) <= 0:
             self.logger.error("No measure !")
-            return False
-        if len(measure)==1:
-            return measure[0]
-        if len(measure) > 1:
-            # Skip first value because it doesn't seem reliable
-            measure = measure[1:]
-            average = (sum(measure) / len(measure))
-            self.logger.info(measure)
-            self.logger.debug(f"sum measure {sum(measure)}; len = {len(measure)}")
-            self.logger.info(f"Average over {measure_duration}seconds : {average} ")
-            return average
-        return False
+            return Tester.VoltageMeasure(False, 0, 0.0, duration, status)
+
+        average = (sum(values) / len(values))
+        stdev = (statistics.pstdev(values) if len(values) > 1 else 0.0)
+        self.logger.info(f"Average over {len(values)} measures in {duration:.2f}seconds : {average} (stdev {stdev:.4f}, {status})")
+        return Tester.VoltageMeasure(average, len(values), stdev, duration, status)
 
 
     # TODO Add a field retry_nb to tell how many times a test should be retried
@@ -1344,6 +1520,9 @@ class Tester():
             return online_test_results
 
         online_test_results = prepare_online_test_results(self)
+        self.io_board.reset_stats()
+        self.current_trace = None
+        self.comm_test_CM4.reset_boot_milestones()
         try:
             self.stop_cm4Thread = False
             test_results = {}
@@ -1401,6 +1580,20 @@ class Tester():
             }
             self.testbench.gui.check_checklist(test, "red")
 
+        # Power on current of the board, the trace may still be running if the boot failed
+        if self.current_trace is not None:
+            self.current_trace.stop()
+            test_results["current_trace"] = self.current_trace.dump()
+            self.logger.debug(f"Current trace : {test_results['current_trace']['features']}")
+
+        # Boot time of the CM4, seconds since the boot started for each milestone
+        test_results["cm4_boot"] = self.comm_test_CM4.get_boot_milestones()
+        self.logger.debug(f"CM4 boot : {test_results['cm4_boot']}")
+
+        # Latency histograms and counters of the IO Board exchanges during this test
+        test_results["io_board_stats"] = self.io_board.dump_stats()
+        self.logger.debug(f"IO Board stats : {test_results['io_board_stats']}")
+
         if test_results.get("pass", False):
             # self.logger.info("Test success !")
             self.logger.log(ScrolledTextLoggingQueueHandler.LOGGING_LEVEL_TEST_RESULT_SUCCESS, "Test success !")
@@ -1506,7 +1699,7 @@ class Tester():
             (io_board.IOBoard.GPIO.EN_SHUNT_AMMETER, 1),
             (io_board.IOBoard.GPIO.CMD_EL, 0),
             (io_board.IOBoard.GPIO.EN_BOOT_CM4, 0)
-        ])
+        ], force=self.config.get("reset_jig_force_gpios", False))
         return True
 
     def stop(self):
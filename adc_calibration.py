@@ -0,0 +1,92 @@
+import datetime
+import json
+import logging
+import math
+import os
+
+
+class ADCCalibration():
+    # Linear correction of the IO Board ADC against the DPM802 voltmeter : volts = (gain * adc_volts) + offset.
+    # Each bench has its own IO Board, the calibrations are stored in a JSON file keyed by the IO Board ID.
+    # Points are (ADC, DPM802) pairs of the same rail, the fit is refreshed every time a point is added.
+    # When the points are too close to each other to fit a line, only the gain is fitted (no offset).
+
+    class ADCCalibrationException(Exception):
+        def __init__(self, msg):
+            super().__init__(msg)
+
+    def __init__(self, board_id, path=None, config={}, logger=None):
+        self.config = config
+
+        if logger is None:
+            self.logger = logging.getLogger(__name__)
+        else:
+            self.logger = logger.getChild(__name__)
+        self.logger.setLevel(self.config.get("log_level", "INFO"))
+
+        self.board_id = board_id
+        self.path = path or self.config.get("adc_calibration_path", "./calibration/adc.json")
+        self.channels = self.load().get(self.board_id, {})
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return {}
+
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError) as ex:
+            self.logger.error(f"Couldn't load the ADC calibrations ({self.path}) : {ex}")
+            return {}
+
+    def save(self):
+        # Other benches may share the file, only this board entry is replaced
+        calibrations = self.load()
+        calibrations[self.board_id] = self.channels
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path, "w") as f:
+            f.write(json.dumps(calibrations, indent=4))
+
+    def add_point(self, channel, adc_volts, meter_volts):
+        calibration = self.channels.setdefault(channel.name, {"points": []})
+        calibration["points"].append([adc_volts, meter_volts])
+        # Oldest points are dropped, the calibration follows the drift of the bench
+        del calibration["points"][:-self.config.get("adc_calibration_max_points", 60)]
+        calibration.update(ADCCalibration.fit(calibration["points"], self.config.get("adc_calibration_min_span", 1.0)))
+        calibration["date"] = datetime.datetime.now().strftime("%Y-%m-%d_%H:%M:%S")
+
+    @staticmethod
+    def fit(points, min_span):
+        # Least squares, the residual is the RMS error of the points around the fit
+        n = len(points)
+        span = (max([x for (x, y) in points]) - min([x for (x, y) in points]))
+        if span >= min_span:
+            mean_x = sum([x for (x, y) in points]) / n
+            mean_y = sum([y for (x, y) in points]) / n
+            gain = sum([((x - mean_x) * (y - mean_y)) for (x, y) in points]) / sum([((x - mean_x) ** 2) for (x, y) in points])
+            offset = (mean_y - (gain * mean_x))
+        else:
+            gain = sum([(x * y) for (x, y) in points]) / max(sum([(x * x) for (x, y) in points]), 1e-12)
+            offset = 0.0
+
+        residual = math.sqrt(sum([((((gain * x) + offset) - y) ** 2) for (x, y) in points]) / n)
+        return {"gain": gain, "offset": offset, "residual": residual, "span": span}
+
+    def is_calibrated(self, channel):
+        calibration = self.channels.get(channel.name)
+        if calibration is None:
+            return False
+        return (len(calibration["points"]) >= self.config.get("adc_calibration_min_points", 6))
+
+    def residual(self, channel):
+        return self.channels[channel.name]["residual"]
+
+    def apply(self, channel, adc_volts):
+        if not self.is_calibrated(channel):
+            raise ADCCalibration.ADCCalibrationException(f"ADC channel {channel.name} is not calibrated !")
+
+        calibration = self.channels[channel.name]
+        return ((calibration["gain"] * adc_volts) + calibration["offset"])
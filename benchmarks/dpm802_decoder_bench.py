@@ -0,0 +1,126 @@
+# Compare the DPM802 table driven decoders with the previous per frame decoding
+# Usage : python benchmarks/dpm802_decoder_bench.py [--frames N]
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import dpm802  # noqa: E402
+
+DPM802 = dpm802.DPM802
+
+
+def build_stream(nb_frames, seed=0):
+    # Valid voltage and current frames, as sent by the meters
+    rnd = random.Random(seed)
+    ranges = {
+        DPM802.Function.VOLTAGE: [0x30, 0x31, 0x32, 0x33, 0x34],
+        DPM802.Function.CURRENT_UA: [0x30, 0x31],
+        DPM802.Function.CURRENT_MA: [0x30, 0x31],
+        DPM802.Function.CURRENT_A: [0x30],
+    }
+    frames = []
+    for _ in range(nb_frames):
+        function = rnd.choice(list(ranges))
+        digits = [(0x30 + rnd.randrange(10)) for _ in range(4)]
+        frames.append(bytes([rnd.choice(ranges[function]), *digits, function.value, rnd.choice([0, 4]), 0, 0]) + b"\r\n")
+    return b"".join(frames)
+
+
+def legacy_decode(buff):
+    # Body of DPM802_1.read_measure() before the shared driver
+    buff = buff[:-2]  # Remove trailing "\r\n"
+
+    function = DPM802.Function(buff[5])
+
+    DIGITS = {
+        0b0110000: 0,
+        0b0110001: 1,
+        0b0110010: 2,
+        0b0110011: 3,
+        0b0110100: 4,
+        0b0110101: 5,
+        0b0110110: 6,
+        0b0110111: 7,
+        0b0111000: 8,
+        0b0111001: 9,
+    }
+
+    value = 0
+    for i in range(1, 5):
+        value *= 10
+        value += DIGITS[buff[i]]
+
+    if buff[6] & (1 << 2):  # Check sign
+        value = -value
+
+    FACTORS = {
+        0b0110000: {DPM802.Function.VOLTAGE: 0.0001, DPM802.Function.CURRENT_UA: 0.1, DPM802.Function.CURRENT_MA: 0.01, DPM802.Function.CURRENT_A: 0.01},
+        0b0110001: {DPM802.Function.VOLTAGE: 0.001,  DPM802.Function.CURRENT_UA: 1,  DPM802.Function.CURRENT_MA: 0.1},
+        0b0110010: {DPM802.Function.VOLTAGE: 0.01},
+        0b0110011: {DPM802.Function.VOLTAGE: 0.1},
+        0b0110100: {DPM802.Function.VOLTAGE: 1},
+        0b0110101: {},
+    }
+
+    value *= FACTORS[buff[0]][function]
+
+    # Convert all function to the same unit...
+    if function == DPM802.Function.CURRENT_UA:
+        value *= 0.001
+        function = DPM802.Function.CURRENT_MA
+    elif function == DPM802.Function.CURRENT_A:
+        value *= 1000
+        function = DPM802.Function.CURRENT_MA
+
+    return (function.value, value)
+
+
+def legacy_decode_all(stream):
+    return [legacy_decode(stream[i:(i + DPM802.FRAME_SIZE)]) for i in range(0, len(stream), DPM802.FRAME_SIZE)]
+
+
+def table_decode_all(stream):
+    view = memoryview(stream)
+    measures = [DPM802.decode_frame(view, i) for i in range(0, len(stream), DPM802.FRAME_SIZE)]
+    return [(measure.function.value, measure.value) for measure in measures]
+
+
+def numpy_decode_all(stream):
+    (functions, values) = DPM802.decode_many(stream)
+    return list(zip(functions.tolist(), values.tolist()))
+
+
+def run(name, stream, nb_frames, repeat, decode):
+    # Best of several runs, to limit the noise of the other processes
+    elapsed = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        measures = decode(stream)
+        duration = time.perf_counter() - start
+        elapsed = duration if elapsed is None else min(elapsed, duration)
+    print(f"{name:<12} : {nb_frames / elapsed:12.0f} frames/s ({elapsed * 1000:.1f} ms)")
+    return measures
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--frames", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    stream = build_stream(args.frames)
+
+    legacy = run("legacy", stream, args.frames, args.repeat, legacy_decode_all)
+    table = run("tables", stream, args.frames, args.repeat, table_decode_all)
+    many = run("decode_many", stream, args.frames, args.repeat, numpy_decode_all)
+
+    if (legacy != table) or (legacy != many):
+        raise SystemExit("Decoded measures differ !")
+
+
+if __name__ == "__main__":
+    main()
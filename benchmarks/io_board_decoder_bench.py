@@ -0,0 +1,134 @@
+# Compare the IOBoard frame decoder with the previous list based receive()
+# Usage : python benchmarks/io_board_decoder_bench.py [--frames N]
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import io_board  # noqa: E402
+
+IOBoard = io_board.IOBoard
+
+
+class ReplayPort():
+    # Mimics serial.Serial.read_until() over a captured byte stream
+    def __init__(self, stream):
+        self.stream = stream
+        self.pos = 0
+        self.timeout = None
+
+    def read_until(self, expected):
+        end = self.stream.find(expected, self.pos)
+        end = len(self.stream) if end < 0 else (end + len(expected))
+        data = self.stream[self.pos:end]
+        self.pos = end
+        return data
+
+
+def encode_frame(cmd_code, data):
+    buff = bytearray([IOBoard.SOF])
+    for b in [cmd_code, *data, ((cmd_code + sum(data)) & 0xFF)]:
+        if IOBoard.byte_is_special(b):
+            buff.append(IOBoard.ESC)
+        buff.append(b)
+    buff.append(IOBoard.EOF)
+    return bytes(buff)
+
+
+def build_stream(nb_frames, payload_size, seed=0):
+    rnd = random.Random(seed)
+    codes = [code.value for code in IOBoard.CommandCode]
+    frames = []
+    for _ in range(nb_frames):
+        data = [rnd.randrange(256) for _ in range(rnd.randrange(1, (payload_size + 1)))]
+        frames.append(encode_frame(rnd.choice(codes), data))
+    return b"".join(frames)
+
+
+def legacy_receive(port):
+    # Body of IOBoard.receive() before the streaming decoder, without the timeout handling
+    buff = []
+    while True:
+        buff.extend(port.read_until(bytes([IOBoard.EOF])))
+
+        try:
+            buff = buff[buff.index(IOBoard.SOF):]
+        except:
+            pass
+
+        if len(buff) >= 4:
+            if (buff[0] == IOBoard.SOF) and (buff[-1] == IOBoard.EOF):
+                i = 2
+                while (i < len(buff)) and (buff[-i] == IOBoard.ESC):
+                    i += 1
+                if i % 2:
+                    continue
+
+                buff = buff[1:-1]
+
+                i = 0
+                while i < len(buff):
+                    if buff[i] == IOBoard.ESC:
+                        buff.pop(i)
+                    i += 1
+
+                crc = buff.pop(-1)
+
+                if crc == (sum(buff) & 0xFF):
+                    cmd_code = IOBoard.CommandCode(buff.pop(0))
+                    return (cmd_code, buff)
+
+                raise IOBoard.IOBoardException("Invalid CRC !")
+
+
+def decoder_receive(port, decoder):
+    while True:
+        frame = decoder.pop()
+        if frame is not None:
+            return frame[:2]
+        decoder.feed(port.read_until(bytes([IOBoard.EOF])))
+
+
+def run(name, stream, nb_frames, repeat, receive):
+    # Best of several runs, to limit the noise of the other processes
+    elapsed = None
+    for _ in range(repeat):
+        port = ReplayPort(stream)
+        start = time.perf_counter()
+        frames = receive(port, nb_frames)
+        duration = time.perf_counter() - start
+        elapsed = duration if elapsed is None else min(elapsed, duration)
+    print(f"{name:<10} : {nb_frames / elapsed:12.0f} frames/s ({elapsed * 1000:.1f} ms)")
+    return frames
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--frames", type=int, default=50000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--payload-sizes", type=int, nargs="+", default=[4, 16, 64, 250],
+                        help="Maximum payload size of the generated frames")
+    args = parser.parse_args()
+
+    for payload_size in args.payload_sizes:
+        print(f"Payload up to {payload_size} bytes :")
+        stream = build_stream(args.frames, payload_size)
+
+        legacy = run("legacy", stream, args.frames, args.repeat,
+                     lambda port, nb_frames: [legacy_receive(port) for _ in range(nb_frames)])
+
+        def decode(port, nb_frames):
+            decoder = IOBoard.FrameDecoder()
+            return [decoder_receive(port, decoder) for _ in range(nb_frames)]
+
+        decoded = run("decoder", stream, args.frames, args.repeat, decode)
+
+        if legacy != decoded:
+            raise SystemExit("Decoded frames differ !")
+
+
+if __name__ == "__main__":
+    main()
@@ -6,6 +6,11 @@ import serial.tools.list_ports
 import time
 import re
 import collections
+import base64
+import binascii
+import zlib
+
+import serial_console
 
 
 class CommTest():
@@ -23,6 +28,36 @@ class CommTest():
     CommResult = collections.namedtuple(
         typename="CommResult", field_names=["raw", "data"])
 
+    CM4Identity = collections.namedtuple(
+        typename="CM4Identity", field_names=["cpu_serial", "ethernet_mac_address", "wifi_mac_address", "registration_id", "endorsment_key", "cam_serial"])
+
+    # Keys printed by CM4_ID_script.sh : field of CM4Identity and format of the value
+    MAC_ADDRESS = r"[0-9a-fA-F]{2}:[0-9a-fA-F]{2}:[0-9a-fA-F]{2}:[0-9a-fA-F]{2}:[0-9a-fA-F]{2}:[0-9a-fA-F]{2}"
+    WIFI_NOT_ENABLED = "WIFI NOT ENABLED"
+    CM4_ID_FIELDS = {
+        "CPU_Serial": ("cpu_serial", re.compile(r"[0-9a-fA-F]{16}")),
+        "Ethermet_mac_address": ("ethernet_mac_address", re.compile(MAC_ADDRESS)),
+        "Wifi_mac_address": ("wifi_mac_address", re.compile(f"{MAC_ADDRESS}|{WIFI_NOT_ENABLED}")),
+        "Registration_ID": ("registration_id", re.compile(r"[0-9a-zA-Z]{52}")),
+        "Endorsment_Key": ("endorsment_key", re.compile(r".{424}")),
+        "Cam_serial": ("cam_serial", re.compile(r"[0-9]{8}")),
+    }
+    CM4_ID_KEY_PATTERN = re.compile(f"({'|'.join(CM4_ID_FIELDS)})\\s*:\\s*")
+
+    # Lines printed by read_file()
+    FILE_SIZE_PATTERN = re.compile(r"@@SIZE ([0-9]+)")
+    FILE_CHUNK_PATTERN = re.compile(r"@@CHUNK ([0-9]+) ([0-9a-f]{8}) ([A-Za-z0-9+/=]*)")
+
+    # Boot messages of the CM4 console, each one is timestamped the first time it is received
+    BOOT_MILESTONES = {
+        "kernel_start": r"Booting Linux on physical CPU|Linux version [0-9]",
+        "login_prompt": r"(CM4|p[0-9]{15}) login:",
+        "kernel_panic": r"Kernel panic",
+    }
+
+    # Echoed by the CM4 to check the console after a baudrate change
+    CONSOLE_CHECK = ("0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ" * 2)
+
     @staticmethod
     def list():
         DEFAULT_USB_IDS = [
@@ -43,6 +78,7 @@ class CommTest():
     def __init__(self, port=None, config={}, logger=None):
         self.config = config
         self.cm4_is_boot = False
+        self.boot_milestones = {}
 
         if logger is None:
             self.logger = logging.getLogger(__name__)
@@ -60,10 +96,15 @@ class CommTest():
         # self.logger.debug("CommTest port : {}".format(port))
 
         # This already opens the port
-        self.port = serial.Serial(port, 115200)
+        self.port = serial.Serial(port, self.config.get("comm_test_CM4_default_baudrate", 115200))
+
+        # Only the console reader reads the port
+        self.console = serial_console.ConsoleReader(self.port, name="CM4", config=self.config, logger=self.logger).start()
+        self.session = serial_console.ShellSession(self.console, config=self.config, logger=self.logger)
 
     def __del__(self):
         try:
+            self.console.stop()
             if self.port.is_open:
                 self.port.close()
         except AttributeError as ex:
@@ -73,191 +114,180 @@ class CommTest():
         return self.port.port
 
     def flush_input(self):
-        self.port.reset_input_buffer()
+        self.console.flush()
 
     def read_lines(self, timeout=1, end_flags=[]):
-        lines = []
-
-        now = time.time()
-        timeout = (now + timeout)
-        while now < timeout:
-            self.port.timeout = (timeout - now)
-            line = self.port.read_all()
-            if len(line) > 1:
-                try:
-                    line = line.decode()
-                except UnicodeDecodeError as ex:
-                    self.logger.exception(ex)
-                    self.logger.error(f"Received : {line}")
-                    continue
-                line = line.strip()
-
-                self.logger.debug(f"RX: {line}")
-
-                lines.append(line)
-
-                if any([re.match(r, line) for r in end_flags]):
-                    return lines
-
-            now = time.time()
-
+        lines = self.console.read_lines(timeout=timeout, end_flags=end_flags)
+        for line in lines:
+            self.logger.debug(f"RX: {line}")
         return lines
 
     def read_lines_without_log(self, timeout=1, end_flags=[]):
-        lines = []
-
-        now = time.time()
-        timeout = (now + timeout)
-        while now < timeout:
-            self.port.timeout = (timeout - now)
-            line = self.port.read_all()
-            if len(line) > 1:
-                try:
-                    line = line.decode()
-                except UnicodeDecodeError as ex:
-                    self.logger.exception(ex)
-                    self.logger.error(f"Received : {line}")
-                    continue
-                line = line.strip()
-
-                #self.logger.debug(f"RX: {line}")
-
-                lines.append(line)
+        return self.console.read_lines(timeout=timeout, end_flags=end_flags)
 
-                if any([re.match(r, line) for r in end_flags]):
-                    return lines
-
-            now = time.time()
-
-        return lines
-
-    def singleCommand_withoutLogs(self, command, timeout=None, args=[], try_nb=None, end_flags=[]):
+    def send_command(self, command, timeout=None, args=[], try_nb=None, end_flags=[], log=True):
+        # Interactive input (login, password, Ctrl-C...) : sent as is, the output is read until an end flag
         if try_nb is None:
             try_nb = self.config.get("comm_test_CM4_try_nb", 3)
         if timeout is None:
             timeout= self.config.get("comm_CM4_timeout", 2)
+        if type(command) is str:
+            command = command.format(*args)
 
-        def try_send_command(self, command, timeout=1, args=[]):
-            self.flush_input()
-
-            if type(command) is str:
-                command = command.format(*args)
-                #self.logger.debug(f"TX: {command}")
-                self.port.write(f"{command}\n".encode())
-            elif type(command) is bytes:
-                #self.logger.debug(f"TX: {command}")
-                self.port.write(command)
-            output = self.read_lines_without_log(timeout=timeout, end_flags=end_flags)
-            return output
-
+        single_string = None
         while try_nb > 0:
             try:
-                lines = try_send_command(self=self, command=command, timeout=timeout, args=args)
-                single_string = ""
-                if len(lines)>1:
-                    for line in lines:
-                        single_string = single_string+line
-                elif len(lines)==0:
+                self.flush_input()
+                self.session.send(command, log)
+                (match, lines) = self.session.expect(end_flags, timeout, log)
+                if len(lines) == 0:
                     self.logger.warning("No data received")
-                elif type(lines) is list:
-                    single_string = lines[0]
-                else:
-                    single_string = lines
-
-                if len(end_flags) >=1:
-                    for ef in end_flags:
-                        if re.search(ef, single_string):
-                            self.logger.info(f"Retuned :{single_string}")
-                            return single_string
-                else:
-                    self.logger.info(f"Data returned")
+                single_string = "".join(lines)
+
+                if (match is not None) or (len(end_flags) == 0):
+                    self.logger.info(f"Retuned :{single_string}" if log else "Data returned")
                     return single_string
             except Exception as ex:
                 self.logger.error(ex)
             self.logger.warning("Retrying...")
             try_nb -= 1
+        return single_string
 
+    def singleCommand_withoutLogs(self, command, timeout=None, args=[], try_nb=None, end_flags=[]):
+        return self.send_command(command, timeout=timeout, args=args, try_nb=try_nb, end_flags=end_flags, log=False)
 
     def singleCommand(self, command, timeout=None, args=[], try_nb=None, end_flags=[]):
+        return self.send_command(command, timeout=timeout, args=args, try_nb=try_nb, end_flags=end_flags)
+
+    def run_script(self, command, timeout=None, try_nb=None, end_flags=[]):
+        # Shell command, returns as soon as it exits. The output lines are concatenated like the other reads.
+        # It is retried when it doesn't end before the timeout or none of the end flags is in its output.
         if try_nb is None:
             try_nb = self.config.get("comm_test_CM4_try_nb", 3)
         if timeout is None:
             timeout= self.config.get("comm_CM4_timeout", 2)
 
-        def try_send_command(self, command, timeout=1, args=[]):
-            self.flush_input()
-
-            if type(command) is str:
-                command = command.format(*args)
-                self.logger.debug(f"TX: {command}")
-                self.port.write(f"{command}\n".encode())
-            elif type(command) is bytes:
-                self.logger.debug(f"TX: {command}")
-                self.port.write(command)
-            output = self.read_lines(timeout=timeout, end_flags=end_flags)
-            return output
-
+        output = ""
         while try_nb > 0:
             try:
-                lines = try_send_command(self=self, command=command, timeout=timeout, args=args)
-                single_string = ""
-                if len(lines)>1:
-                    for line in lines:
-                        single_string = single_string+line
-                elif len(lines)==0:
-                    self.logger.warning("No data received")
-                else:
-                    single_string = lines
-
-                if len(end_flags) >=1:
-                    for ef in end_flags:
-                        if re.search(ef, single_string):
-                            self.logger.info(f"Retuned :{single_string}")
-                            return single_string
-                else:
-                    self.logger.info(f"Retuned :{single_string}")
-                    return single_string
+                self.flush_input()
+                (output, exit_status) = self.session.run(command, timeout)
+                output = output.replace("\n", "")
+
+                if exit_status is None:
+                    self.logger.warning(f"{command} didn't end after {timeout}s")
+                    self.session.send(b"\x03")  # Get the prompt back before retrying
+                elif (len(end_flags) == 0) or any([re.search(flag, output) for flag in end_flags]):
+                    self.logger.info(f"Retuned ({exit_status}) :{output}")
+                    return output
             except Exception as ex:
                 self.logger.error(ex)
             self.logger.warning("Retrying...")
             try_nb -= 1
+        return output
 
     #CHECK_IMAGE scripts:
+    def run_script_battery(self, scripts, on_ready=(lambda name: None), on_result=(lambda name: None), timeout=None):
+        # The scripts ({name: command}) are run one after the other by a single shell command.
+        # Before each script the CM4 prints "@@READY <name>" and waits for a new line : on_ready(name) prepares the test
+        # (STM outputs...) before the script is started. After it, "@@RESULT <name> <exit status>" is printed and
+        # on_result(name) is called. Returns the output of each script that ended, concatenated like the other reads.
+        if timeout is None:
+            timeout = self.config.get("gpio_som_script_timeout", 11)
+
+        # The quotes in the middle of the tags keep the echo of the command line from matching
+        cases = " ".join([f"{name}) {command} ;;" for (name, command) in scripts.items()])
+        command = (f'for name in {" ".join(scripts)}; do echo "@@READY"" $name"; read -r go; '
+                   f'case $name in {cases} esac; echo "@@RESULT"" $name $?"; done')
+
+        results = {}
+        self.flush_input()
+        self.session.send(command)
+        for name in scripts:
+            (match, lines) = self.session.expect([fr"@@READY {name}\b"], timeout)
+            if match is None:
+                self.logger.error(f"CM4 not ready to run {name} !")
+                break
+
+            on_ready(name)
+            self.session.send("")
+            (match, lines) = self.session.expect([fr"@@RESULT {name} ([0-9]+)"], timeout)
+            on_result(name)
+            if match is None:
+                self.logger.error(f"{name} didn't end after {timeout}s !")
+                break
+
+            output = serial_console.ShellSession.ESCAPE_SEQUENCE_PATTERN.sub("", "".join(lines))
+            results[name] = output[:-len(match.group(0))]
+            self.logger.info(f"{name} ({match.group(1)}) : {results[name]}")
+
+        if len(results) < len(scripts):
+            self.session.send(b"\x03")  # Stop the remaining scripts
+        return results
+
     def take_image(self, **kwargs):
-        timeout = self.config.get("take_image_timeout_delay", 10)
-        #image = self.singleCommand("python3 ./PI_Tests/camtest.py", timeout, end_flags=[r"pego@p[0-9]{15}:~\$", "raspberrypi:~"])
+        # The script used to be read take_image_read_retry times, it may last that long
+        timeout = (self.config.get("take_image_timeout_delay", 10) * self.config.get("take_image_read_retry", 6))
         command = "sudo ./PI_Tests/cam_test.sh"
         try_nb = self.config.get("take_image_try_nb", 2)
-        read_retry = self.config.get("take_image_read_retry", 6)
+        data = self.run_script(command, timeout, try_nb=try_nb, end_flags=[r"\s*Image\s*Captured\s*"])
+        if re.search(r"\s*Image\s*Captured\s*", data):
+            self.logger.info(f"CM4 values returned :{data}")
+        return data
 
+    def read_file(self, path, try_nb=None):
+        # The file is printed in base64 chunks by python3 on the CM4, each one as "@@CHUNK <index> <crc32> <base64>".
+        # Only the chunks that are missing or have a wrong CRC are printed again by the next tries.
+        if try_nb is None:
+            try_nb = self.config.get("cm4_file_try_nb", 3)
+        chunk_size = self.config.get("cm4_file_chunk_size", 768)
+        timeout = self.config.get("cm4_file_timeout", 120)
+
+        chunks = {}
+        nb_chunks = None
+        indexes = "range(n)"
         while try_nb > 0:
-            self.logger.debug(f"TX: {command}")
-            self.port.write(f"{command}\n".encode())
-            data=""
+            script = (f"import base64,os,zlib;f=open('{path}','rb');n=((os.path.getsize('{path}')+{chunk_size}-1)//{chunk_size});print('@@SIZE',n);"
+                      f"[print('@@CHUNK',i,'%08x'%zlib.crc32(c),base64.b64encode(c).decode()) for i in {indexes} for c in [(f.seek(i*{chunk_size}),f.read({chunk_size}))[1]]]")
             try:
-                is_empty = True
-                while is_empty and read_retry>0:
-                    readed_lines = self.read_lines(timeout=timeout, end_flags=[r"\s*Image\s*Captured\s*","Image Captured", r"pego@CM4:~\$", r"pego@CM4:~\$$", r"pego@p[0-9]{15}:~$\$"])
-                    if len(readed_lines) >=1:
-                        for e in readed_lines:
-                            data = data+str(e)
-                    if len(data) >0 and re.search(r"\s*Image\s*Captured\s*", data):
-                        is_empty = False
-                        self.logger.info(f"CM4 values returned :{data}")
-                        return data
-                    read_retry -=1
-                    self.logger.debug(f"retry read... {read_retry}")
-
+                self.flush_input()
+                (output, exit_status) = self.session.run(f'python3 -c "{script}"', timeout, log=False)
+                if exit_status is None:
+                    self.session.send(b"\x03")
+                for line in output.split("\n"):
+                    match = CommTest.FILE_CHUNK_PATTERN.match(line)
+                    if match is None:
+                        match = CommTest.FILE_SIZE_PATTERN.match(line)
+                        if match is not None:
+                            nb_chunks = int(match.group(1))
+                        continue
+                    try:
+                        data = base64.b64decode(match.group(3), validate=True)
+                    except binascii.Error:
+                        continue
+                    if zlib.crc32(data) == int(match.group(2), 16):
+                        chunks[int(match.group(1))] = data
             except Exception as ex:
                 self.logger.error(ex)
-            self.logger.warning("Retry cam_test.sh")
-            self.logger.debug("retry take picture")
-            try_nb -=1
-        return data
+
+            if nb_chunks is not None:
+                missing = [i for i in range(nb_chunks) if i not in chunks]
+                if len(missing) == 0:
+                    data = b"".join([chunks[i] for i in range(nb_chunks)])
+                    self.logger.info(f"{path} read ({len(data)} bytes)")
+                    return data
+                self.logger.warning(f"{len(missing)}/{nb_chunks} chunks of {path} to read again")
+                indexes = str(missing)
+            else:
+                self.logger.warning(f"Couldn't read {path}, retrying...")
+            try_nb -= 1
+
+        self.logger.error(f"Failed to read {path} !")
+        return None
 
     def check_image(self, **kwargs):
         timeout = self.config.get("check_image_timeout_delay", 45)
-        image = self.singleCommand("python3 ./PI_Tests/image_check.py", timeout, end_flags=["Image ok", "ok", "Too many black pixels","Too many white pixels","raspberrypi:~"])
+        image = self.run_script("python3 ./PI_Tests/image_check.py", timeout, end_flags=["Image ok", "ok", "Too many black pixels","Too many white pixels"])
         return image
     ###
 
@@ -268,28 +298,36 @@ class CommTest():
 
     def wdg_som(self, **kwargs):
         timeout = self.config.get("wdg_som_timeout_delay", 11)
-        wdg = self.singleCommand("sudo ./PI_Tests/test_wdg_som.sh", timeout, end_flags=["Succeeded", "Test failed:"])
+        wdg = self.run_script("sudo ./PI_Tests/test_wdg_som.sh", timeout, end_flags=["Succeeded", "Test failed:"])
         return wdg
 
     #GPIO_SOM scripts
+    CONNEXION_SCRIPTS = {
+        "WDG_SOM": "sudo ./PI_Tests/test_wdg_som.sh",
+        "GPIO_18": "sudo ./PI_Tests/test_pin_18.sh",
+        "GPIO_23": "sudo ./PI_Tests/test_pin_23.sh",
+        "GPIO_24": "sudo ./PI_Tests/test_pin_24.sh",
+        "GPIO_25": "sudo ./PI_Tests/test_pin_25.sh",
+    }
+
     def GPIO_18_script(self):
         timeout = self.config.get("gpio_som_script_timeout", 11)
-        gpio_18 = self.singleCommand("sudo ./PI_Tests/test_pin_18.sh", timeout, end_flags=["Succeeded", "Test failed:"])
+        gpio_18 = self.run_script("sudo ./PI_Tests/test_pin_18.sh", timeout, end_flags=["Succeeded", "Test failed:"])
         return gpio_18
 
     def GPIO_23_script(self, timeout=None):
         timeout = self.config.get("gpio_som_script_timeout", 11)
-        gpio_23 = self.singleCommand("sudo ./PI_Tests/test_pin_23.sh", timeout, end_flags=["Succeeded", "Test failed:"])
+        gpio_23 = self.run_script("sudo ./PI_Tests/test_pin_23.sh", timeout, end_flags=["Succeeded", "Test failed:"])
         return gpio_23
 
     def GPIO_24_script(self, timeout=None):
         timeout = self.config.get("gpio_som_script_timeout", 11)
-        gpio_24 = self.singleCommand("sudo ./PI_Tests/test_pin_24.sh", timeout, end_flags=["Succeeded", "Test failed:"])
+        gpio_24 = self.run_script("sudo ./PI_Tests/test_pin_24.sh", timeout, end_flags=["Succeeded", "Test failed:"])
         return gpio_24
 
     def GPIO_25_script(self, timeout=None):
         timeout = self.config.get("gpio_som_script_timeout", 11)
-        gpio_25 = self.singleCommand("sudo ./PI_Tests/test_pin_25.sh", timeout, end_flags=["Succeeded", "Test failed:"])
+        gpio_25 = self.run_script("sudo ./PI_Tests/test_pin_25.sh", timeout, end_flags=["Succeeded", "Test failed:"])
         return gpio_25
 
     def dut_provisioning(self, serial_number, **kwargs):
@@ -298,7 +336,8 @@ class CommTest():
         command = "sudo ./pod_provision.sh " + serial_number
 
         while dut_provision_try_nb>0:
-            provisioning = self.singleCommand(command, timeout, end_flags=[fr"Pod\s*provision\s*script\s*finished\s*with\s*Serial\s*{serial_number}\s*", r"pego@CM4:~$", r"pego@CM4:~\$$", r"pego@p[0-9]{15}:~$\$"]) #"## Run TPM Provision with serialnumber ##"
+            # Run again up to comm_test_CM4_try_nb times when it doesn't end before the timeout, as with singleCommand()
+            provisioning = self.run_script(command, timeout) #"## Run TPM Provision with serialnumber ##"
             if re.search(fr"Pod\s*provision\s*script\s*finished\s*with\s*Serial\s*{serial_number}\s*", provisioning):
                 self.logger.info("Provision OK")
                 return provisioning
@@ -313,49 +352,47 @@ class CommTest():
         return test_leds
 
     def cm4_ID_script(self, timeout=None):
-        timeout = self.config.get("CM4_ID_script_timeout", 5)
+        # The script used to be read read_cm4_id_nb_retry times, it may last that long
+        timeout = (self.config.get("CM4_ID_script_timeout", 5) * self.config.get("read_cm4_id_nb_retry", 10))
         try_nb = self.config.get("CM4_ID_script_try_nb", 3)
-        #cm4_id = self.singleCommand("sudo ./CM4_ID_script.sh", timeout=1, try_nb=1, end_flags=["pego@p[0-9]{15}:~$", r"pego@p[0-9]{15}:~\$$", r"Cam_serial\s*:\s*([0-9]{8})"])
         command = "sudo ./CM4_ID_script.sh"
-        read_retry = self.config.get("read_cm4_id_nb_retry", 10)
+
+        # The valid values are kept between the reads, only the missing or truncated ones are taken from the next read.
+        # The script can't print a single value : each read runs the whole script.
+        fields = {}
         while try_nb > 0:
-            self.logger.debug(f"TX: {command}")
-            self.port.write(f"{command}\n".encode())
             try:
-                is_empty = True
-                while is_empty or read_retry>0:
-                    cm4_id = self.read_lines(timeout=timeout, end_flags=[r"pego@CM4:~$", r"pego@CM4:~\$$", r"Cam_serial\s*:\s*([0-9]{8})"])
-                    try:
-                        if len(cm4_id) >1:
-                            data= ""
-                            for e in cm4_id:
-                                data = data+str(e)
-                            cm4_id[0] = data
-                        if len(cm4_id) >0 and re.search(r"Cam_serial\s*:\s*([0-9]{8})", cm4_id[0]):
-                            is_empty = False
-                            break
-                    except:
-                        pass
-                    read_retry-=1
-
-                cm4_id = cm4_id[0]
-
-                cpu_serial = (re.search(r"CPU_Serial\s*:\s*([0-9a-fA-F]{16})", cm4_id)).group(1)
-                ethernet_mac_address = (re.search(r"Ethermet_mac_address\s*:\s*([0-9a-fA-F]{2}:[0-9a-fA-F]{2}:[0-9a-fA-F]{2}:[0-9a-fA-F]{2}:[0-9a-fA-F]{2}:[0-9a-fA-F]{2})", cm4_id)).group(1)
-                try:
-                    wifi_mac_address = (re.search(r"Wifi_mac_address\s*:\s*([0-9a-fA-F]{2}:[0-9a-fA-F]{2}:[0-9a-fA-F]{2}:[0-9a-fA-F]{2}:[0-9a-fA-F]{2}:[0-9a-fA-F]{2})", cm4_id)).group(1)
-                except:
-                    wifi_mac_address = (re.search(r"Wifi_mac_address\s*:\s*(WIFI NOT ENABLED)", cm4_id)).group(1)
-                registration_id = (re.search(r"Registration_ID\s*:\s*([0-9a-zA-Z]{52})", cm4_id)).group(1)
-                endorsment_key = (re.search(r"Endorsment_Key\s*:\s*(.{424})", cm4_id)).group(1)
-                cam_serial = (re.search(r"Cam_serial\s*:\s*([0-9]{8})", cm4_id)).group(1)
-                self.logger.info(f"CM4 values returned :{cm4_id}")
-                return cm4_id
+                self.flush_input()
+                (output, exit_status) = self.session.run(command, timeout)
+                if exit_status is None:
+                    self.session.send(b"\x03")
+                fields = CommTest.parse_cm4_identity(output.split("\n"), fields)
             except Exception as ex:
                 self.logger.error(ex)
-            self.logger.warning("Retry CM4_ID_script")
+
+            missing = [name for name in CommTest.CM4Identity._fields if name not in fields]
+            if len(missing) == 0:
+                identity = CommTest.CM4Identity(**fields)
+                self.logger.info(f"CM4 values returned :{identity}")
+                return identity
+
+            self.logger.warning(f"Retry CM4_ID_script, missing {missing}")
             try_nb -= 1
-        return cm4_id
+        return None
+
+    @staticmethod
+    def parse_cm4_identity(lines, fields={}):
+        # Single pass over the lines, each value is validated as it is read. Returns the valid values by field name.
+        fields = dict(fields)
+        for line in lines:
+            keys = list(CommTest.CM4_ID_KEY_PATTERN.finditer(line))
+            for (n, key) in enumerate(keys):
+                end = (keys[n + 1].start() if (n + 1) < len(keys) else len(line))
+                (name, pattern) = CommTest.CM4_ID_FIELDS[key.group(1)]
+                value = pattern.match(line, key.end(), end)
+                if (value is not None) and (name not in fields):
+                    fields[name] = value.group(0)
+        return fields
 
     def cancel_script(self,try_nb=None, timeout=None):
         canceled = self.singleCommand('b\x03', timeout=1, try_nb=try_nb, end_flags=[r"^C$", r"pego@CM4:~"])
@@ -372,27 +409,102 @@ class CommTest():
     def get_CM4_state(self):
         return self.cm4_is_boot
 
+    def get_boot_milestones(self):
+        # Seconds since connectSOM() of each milestone reached during the last boot, "start" is the time of connectSOM()
+        return dict(self.boot_milestones)
+
+    def reset_boot_milestones(self):
+        self.boot_milestones = {}
+
+    def check_console(self, timeout=None):
+        # Loopback check : the string echoed by the CM4 must come back unaltered
+        if timeout is None:
+            timeout = self.config.get("comm_CM4_timeout", 2)
+        self.flush_input()
+        (output, exit_status) = self.session.run(f"echo {CommTest.CONSOLE_CHECK}", timeout, log=False)
+        return ((exit_status == 0) and (output.strip() == CommTest.CONSOLE_CHECK))
+
+    def reset_console(self, try_nb=2):
+        # Ctrl-C until the prompt is back, what was received at a wrong rate may have left an unfinished command line
+        # or stopped the output (XOFF), XON restarts it
+        for _ in range(try_nb):
+            self.session.send(b"\x11\x03")
+            time.sleep(0.1)
+            if self.check_console():
+                return True
+        return False
+
+    def set_baudrate(self, baudrate, ack_timeout):
+        # stty only applies the new rate once the echo of the command line is sent. The CM4 then waits for the
+        # acknowledge at the new rate and goes back to the default rate by itself if it doesn't receive it,
+        # dropping what it received at the wrong rate.
+        default = self.config.get("comm_test_CM4_default_baudrate", 115200)
+        self.flush_input()
+        self.session.send(f'stty {baudrate}; read -r -t {ack_timeout} ack; '
+                          f'[ "$ack" = "@@BAUD{baudrate}" ] || {{ stty {default}; while read -r -t 0.2 junk; do :; done; }}')
+        self.port.flush()
+        time.sleep(self.config.get("comm_test_CM4_baudrate_switch_delay", 0.2))
+        self.port.baudrate = baudrate
+        self.flush_input()  # Garbage received during the switch
+        self.session.send(f"@@BAUD{baudrate}")
+
+    def negotiate_baudrate(self):
+        # Both ends switch to the highest rate passing the loopback check, returns the rate used (None if the console is lost)
+        default = self.config.get("comm_test_CM4_default_baudrate", 115200)
+        ack_timeout = self.config.get("comm_test_CM4_baudrate_ack_timeout", 2)
+        for baudrate in sorted(self.config.get("comm_test_CM4_baudrates", [921600, 460800, 230400]), reverse=True):
+            if baudrate <= default:
+                continue
+
+            self.set_baudrate(baudrate, ack_timeout)
+            if self.check_console():
+                self.logger.info(f"CM4 console switched to {baudrate} bauds")
+                return baudrate
+            self.logger.warning(f"CM4 console loopback check failed at {baudrate} bauds")
+
+            # Back to the default rate, the CM4 is already there unless it received the acknowledge
+            self.port.baudrate = default
+            time.sleep(ack_timeout)
+            if not self.reset_console():
+                self.port.baudrate = baudrate
+                self.session.send(b"\x11\x03")
+                time.sleep(0.1)
+                self.session.send(f"stty {default}")
+                self.port.flush()
+                time.sleep(self.config.get("comm_test_CM4_baudrate_switch_delay", 0.2))
+                self.port.baudrate = default
+                if not self.reset_console():
+                    self.logger.error(f"CM4 console lost while switching to {baudrate} bauds !")
+                    return None
+        return default
+
     def connectSOM(self, exit_signal=lambda: False, stop_cm4_thread=lambda: False):
         """if not self.port.isOpen():
             self.port.open()"""
         self.logger.info("Boot CM4...")
+        # The CM4 console always boots at the default rate
+        self.port.baudrate = self.config.get("comm_test_CM4_default_baudrate", 115200)
+        def milestone(self, name):
+            self.boot_milestones[name] = round((time.time() - self.boot_milestones["start"]), 3)
+            self.logger.info(f"CM4 boot : {name} after {self.boot_milestones[name]}s")
+
         def bootCM4(self, exit_signal, stop_cm4_thread):
             #default-> login: pi | password: raspberry
-            output = []
             enter_login= False
 
-            result= ""
+            # Only the new lines are searched, for the milestones not reached yet
+            patterns = {pattern: name for (name, pattern) in CommTest.BOOT_MILESTONES.items()}
             while not (enter_login or stop_cm4_thread()):
-                output=output + self.read_lines(timeout=1, end_flags=["CM4 login:", r"p[0-9]{15} login:"])
-                for line in output:
-                    result = result + line
-                if re.search("CM4 login:", result):
-                    enter_login = True
-                    break
-                if re.search(r"p[0-9]{15} login:", result):
+                (match, lines) = self.session.expect(list(patterns), timeout=1)
+                if match is None:
+                    continue
+
+                name = patterns.pop(match.re.pattern)
+                milestone(self, name)
+                if name == "login_prompt":
                     enter_login = True
                     break
-                if re.search("Kernel panic:", result):
+                if name == "kernel_panic":
                     self.logger.error("Kernal panic detected ! The SOM will reboot")
                     break
                 if stop_cm4_thread():
@@ -411,19 +523,29 @@ class CommTest():
             self.singleCommand_withoutLogs("GTa@XiM7_v$KR9a^Bs63YAz2", timeout=2, end_flags=[r"pego@CM4"]) #this password must never be seen by anyone
             if stop_cm4_thread():
                 return
+            milestone(self, "logged_in")
             time.sleep(1.2)
+            # Opt-in, like the STM side : the console stays at the default rate unless enabled
+            if self.config.get("comm_test_CM4_baudrate_negotiation", False):
+                if self.negotiate_baudrate() is None:
+                    self.cm4_is_boot = False
+                    return
+                if stop_cm4_thread():
+                    return
             output_lines = self.singleCommand("ls -l", timeout=1, end_flags=["CM4_ID_script.sh",r"pego@CM4:~"])
             if stop_cm4_thread():
                 return
             if not bool(re.search("CM4_ID_script.sh", output_lines)):
                 self.logger.error("Fail to initiated SOM")
-                self.logger.error(f"ls -l output: {output}")
+                self.logger.error(f"ls -l output: {output_lines}")
                 self.cm4_is_boot = False
                 return
             self.cm4_is_boot = True
+            milestone(self, "ready")
             self.logger.info("CM4 well boot")
 
         self.cm4_is_boot=False
+        self.boot_milestones = {"start": time.time()}
         t = threading.Thread(name="CommCM4_Thread", target=bootCM4, args=(self, exit_signal, stop_cm4_thread))
         t.start()
 
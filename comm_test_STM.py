@@ -6,6 +6,8 @@ import time
 import re
 import collections
 
+import serial_console
+
 
 class CommTest():
     class CommTestException(Exception):
@@ -22,6 +24,14 @@ class CommTest():
     CommResult = collections.namedtuple(
         typename="CommResult", field_names=["raw", "data"])
 
+    # Answer of the firmware to the AT style commands, it may come in the same read as the echo
+    OK_PATTERN = re.compile(r"^\s*OK\s*$", re.MULTILINE)
+    CMD_FLAG_PATTERN = re.compile(r"^\s*\w+\+(\w+)(?:\s*=\s*<.*>)?\s*$")
+
+    # Regexes of a command, compiled the first time it is sent. verdicts : last line of the answer to an AT style command.
+    CommandPatterns = collections.namedtuple(
+        typename="CommandPatterns", field_names=["badarg", "fail", "end_flags", "verdicts"])
+
     @staticmethod
     def list():
         DEFAULT_USB_IDS = [
@@ -58,10 +68,16 @@ class CommTest():
         # self.logger.debug("CommTest port : {}".format(port))
 
         # This already opens the port
-        self.port = serial.Serial(port, 115200)
+        self.port = serial.Serial(port, self.config.get("comm_test_STM_default_baudrate", 115200))
+        self.baudrate_negotiated = False
+
+        # Only the console reader reads the port
+        self.console = serial_console.ConsoleReader(self.port, name="STM", config=self.config, logger=self.logger).start()
+        self.command_patterns = {}
 
     def __del__(self):
         try:
+            self.console.stop()
             if self.port.is_open:
                 self.port.close()
         except AttributeError as ex:
@@ -71,127 +87,163 @@ class CommTest():
         return self.port.port
 
     def flush_input(self):
-        self.port.reset_input_buffer()
+        self.console.flush()
 
     def read_lines(self, timeout=1, end_flags=[]):
-        lines = []
-
-        now = time.time()
-        timeout = (now + timeout)
-        while now < timeout:
-            self.port.timeout = (timeout - now)
-            line = self.port.read_until(b"\r\n")
-            if len(line) > 1:
-                try:
-                    line = line.decode()
-                except UnicodeDecodeError as ex:
-                    self.logger.exception(ex)
-                    self.logger.error(f"Received : {line}")
-                    continue
-                line = line.strip()
-
-                self.logger.debug(f"RX: {line}")
+        lines = self.console.read_lines(timeout=timeout, end_flags=[f"^\\s*(?:{flag})" for flag in end_flags])
+        for line in lines:
+            self.logger.debug(f"RX: {line}")
+        return lines
 
-                lines.append(line)
+    def compile_command(self, command, end_flags):
+        key = (command, tuple(end_flags))
+        patterns = self.command_patterns.get(key)
+        if patterns is not None:
+            return patterns
 
-                if any([re.match(r, line) for r in end_flags]):
-                    return lines
+        cmd_flag = None
+        try:
+            if type(command) is str:
+                cmd_flag = CommTest.CMD_FLAG_PATTERN.match(command)
+            elif type(command) is bytes:
+                cmd_flag = CommTest.CMD_FLAG_PATTERN.match(command.decode())
+        except Exception as ex:
+            self.logger.exception(ex)
+
+        if cmd_flag is not None:
+            cmd_flag = cmd_flag.group(1)
+            badarg = re.compile(fr"^\s*\+{cmd_flag}\s*:\s*BADARG\s*$")
+            fail = re.compile(fr"^\s*\+{cmd_flag}\s*:\s*FAIL\s*$")
+            verdicts = [CommTest.OK_PATTERN, badarg, fail]
+        else:
+            (badarg, fail, verdicts) = (None, None, [])
+
+        patterns = self.command_patterns[key] = CommTest.CommandPatterns(badarg, fail, [self.console.compile(flag) for flag in end_flags], verdicts)
+        return patterns
+
+    def reset_baudrate(self):
+        # The STM32 is back to the default rate after a power cycle, the rate is negotiated again before the next command
+        self.port.baudrate = self.config.get("comm_test_STM_default_baudrate", 115200)
+        self.baudrate_negotiated = False
+
+    def negotiate_baudrate(self):
+        # The firmware switches to the rate of comm_test_STM_baudrate_command ("{}" is replaced by the rate) after
+        # answering OK at the current rate. It goes back to the default rate unless the same command is received
+        # at the new rate within comm_test_STM_baudrate_ack_timeout, the OK answered to it is the loopback check.
+        # Nothing is negotiated if the firmware has no such command.
+        self.baudrate_negotiated = True
+        command = self.config.get("comm_test_STM_baudrate_command", None)
+        default = self.config.get("comm_test_STM_default_baudrate", 115200)
+        if command is None:
+            return self.port.baudrate
+
+        for baudrate in sorted(self.config.get("comm_test_STM_baudrates", [921600, 460800, 230400]), reverse=True):
+            if baudrate <= default:
+                continue
 
-            now = time.time()
+            try:
+                lines = self.send_command(command, args=[baudrate], try_nb=1)
+                if not any(CommTest.OK_PATTERN.search(l) for l in lines):
+                    self.logger.warning(f"STM32 refused {baudrate} bauds")
+                    continue
+                self.port.flush()
+                time.sleep(self.config.get("comm_test_STM_baudrate_switch_delay", 0.05))
+                self.port.baudrate = baudrate
+                lines = self.send_command(command, args=[baudrate], try_nb=1)
+                if any(CommTest.OK_PATTERN.search(l) for l in lines):
+                    self.logger.info(f"STM32 console switched to {baudrate} bauds")
+                    return baudrate
+            except CommTest.CommTestException as ex:
+                self.logger.warning(str(ex))
+            self.logger.warning(f"STM32 console loopback check failed at {baudrate} bauds")
 
-        return lines
+            self.port.baudrate = default
+            time.sleep(self.config.get("comm_test_STM_baudrate_ack_timeout", 1))
+        return default
 
     def send_command(self, command, timeout=None, args=[], try_nb=None, end_flags=[]):
         if try_nb is None:
             try_nb = self.config.get("comm_test_STM_try_nb", 5)
         if timeout is None:
             timeout= self.config.get("comm_STM_timeout", 2)
+        if not self.baudrate_negotiated:
+            self.negotiate_baudrate()
 
-        def try_send_command(self, command, timeout=1, args=[]):
+        def try_send_command(self, command, patterns, timeout=1, args=[]):
             self.flush_input()
+            start = self.console.position()
 
             if type(command) is str:
                 command = command.format(*args)
                 self.logger.debug(f"TX: {command}")
                 self.port.write(f"{command}".encode())
+                echo = command
             elif type(command) is bytes:
                 self.logger.debug(f"TX: {command}")
                 self.port.write(command)
+                echo = command.decode(errors="replace")
             else:
                 raise CommTest.CommTestException(
                     f"Invalid command type ({type(command)}) !")
 
+            # Woken up by the console reader as soon as something is received, the verdict ('z' or an end flag)
+            # is searched in the last line before its end of line. After the echo, the answer is complete at the end of line
+            # of its verdict (OK, BADARG, FAIL) for an AT style command, of its first line otherwise.
+            # A firmware answering without a verdict is only waited for until the console is quiet.
+            quiet = self.config.get("comm_test_STM_quiet_time", 0.05)
             lines = []
-
-            now = time.time()
-            timeout = (now + timeout)
-            while now < timeout:
-                self.port.timeout = (timeout - now)
-                time.sleep(0.1)
-                line = self.port.read_all()
-                if len(line) >= 1:
-                    try:
-                        line = line.decode("utf-8")
-                    except UnicodeDecodeError as ex:
-                        self.logger.exception(ex)
-                        self.logger.error(f"Received : {line}")
-                        continue
-                    line = line.strip()
-
-                    self.logger.debug(f"RX: {line}")
-
-                    lines.append(line)
+            timeout = (time.time() + timeout)
+            try:
+                while True:
+                    position = self.console.position()
+                    received = self.console.lines_since(start, position)
+                    lines = serial_console.ConsoleReader.strip_lines(received)
+                    remaining = (timeout - time.time())
 
                     if any(['z' in l for l in lines]):
                         self.logger.info("Get 'z', error raise !")
                         #raise CommTest.CommTestException("fail was return")
                         return lines
-                    elif any([command in l for l in lines]):
+                    elif any([flag.match(l) for flag in patterns.end_flags for l in lines]):
                         return lines
-                    elif any([re.match(r, line) for r in end_flags]):
-                        return lines
-                    else:
+                    elif any([echo in l for l in lines]):
+                        echo_index = next(n for (n, l) in enumerate(received) if echo in l)
+                        answer = serial_console.ConsoleReader.strip_lines(received[(echo_index + 1):-1])
+                        if len(patterns.verdicts) > 0:
+                            if any([verdict.match(l) for verdict in patterns.verdicts for l in answer]):
+                                return lines
+                        elif len(answer) > 0:
+                            return lines
+                        if not self.console.wait_data(position, min(quiet, max(remaining, 0))):
+                            return lines
+                        continue
+                    elif len(serial_console.ConsoleReader.strip_lines(received[:-1])) > 0:
                         self.logger.info("Get unexpected RX, retry send command !")
-                        time.sleep(0.250)
+                        # The rest of it is dropped by the next try
+                        self.console.wait_quiet(quiet, 0.25)
                         raise CommTest.CommTestException(
                             "Unexpected RX !")
 
-                now = time.time()
-            time.sleep(0.250)
-            raise CommTest.CommTestException("Test communication timeout !")
+                    if (remaining <= 0) or not self.console.wait_data(position, remaining):
+                        raise CommTest.CommTestException("Test communication timeout !")
+            finally:
+                for line in lines:
+                    self.logger.debug(f"RX: {line}")
 
-        if self.config.get("comm_test_STM_retry_on_badarg", True) or self.config.get("comm_test_STM_retry_on_fail", True):
-            try:
-                if type(command) is str:
-                    cmd_flag = re.match(
-                        fr"^\s*\w+\+(\w+)(?:\s*=\s*<.*>)?\s*$", command)
-                elif type(command) is bytes:
-                    cmd_flag = re.match(
-                        fr"^\s*\w+\+(\w+)(?:\s*=\s*<.*>)?\s*$", command.decode())
-                else:
-                    cmd_flag = None
-
-                if cmd_flag is not None:
-                    cmd_flag = cmd_flag.group(1)
-            except Exception as ex:
-                self.logger.exception(ex)
-                cmd_flag = None
-        else:
-            cmd_flag = None
+        patterns = self.compile_command(command, end_flags)
 
         while try_nb > 0:
             try:
                 lines = try_send_command(
-                    self=self, command=command, timeout=timeout, args=args)
-                if cmd_flag:
-                    if self.config.get("comm_test_STM_retry_on_badarg", True):
-                        if any(re.match(fr"^\s*\+{cmd_flag}\s*:\s*BADARG\s*$", l) for l in lines):
-                            raise CommTest.CommTestException(
-                                "Test communication error !")
-                    if self.config.get("comm_test_STM_retry_on_fail", True):
-                        if any(re.match(fr"^\s*\+{cmd_flag}\s*:\s*FAIL\s*$", l) for l in lines):
-                            raise CommTest.CommTestException(
-                                "Test communication error !")
+                    self=self, command=command, patterns=patterns, timeout=timeout, args=args)
+                if self.config.get("comm_test_STM_retry_on_badarg", True) and (patterns.badarg is not None):
+                    if any(patterns.badarg.match(l) for l in lines):
+                        raise CommTest.CommTestException(
+                            "Test communication error !")
+                if self.config.get("comm_test_STM_retry_on_fail", True) and (patterns.fail is not None):
+                    if any(patterns.fail.match(l) for l in lines):
+                        raise CommTest.CommTestException(
+                            "Test communication error !")
 
                 return lines
             except CommTest.CommTestException as ex:
@@ -208,13 +260,14 @@ class CommTest():
             return CommTest.CommResult(lines, False)
         if not check in lines:
             return CommTest.CommResult(lines, False)
-        return CommTest.CommResult(lines, any(re.match(fr"^\s*{check}\s*$", l) for l in lines))
+        pattern = self.console.compile(fr"^\s*{check}\s*$")
+        return CommTest.CommResult(lines, any(pattern.match(l) for l in lines))
 
     def simple_int(self, base, check, **kwargs):
         lines = self.send_command(f"{base}+{check}", **kwargs)
         if not "OK" in lines:
             return CommTest.CommResult(lines, None)
-        r = re.compile(fr"^\s*\+{check}\s*:\s*<\s*(-?\d+)\s*>\s*$")
+        r = self.console.compile(fr"^\s*\+{check}\s*:\s*<\s*(-?\d+)\s*>\s*$")
         l = list(filter(lambda l: r.match(l), lines))
         if len(l) <= 0:
             return CommTest.CommResult(lines, None)
@@ -0,0 +1,153 @@
+import array
+import base64
+import logging
+import sys
+import threading
+import time
+
+
+class CurrentTrace():
+    # Current drawn by the board from power on to the end of the CM4 boot.
+    # Samples are stored as float32 arrays : seconds since the start and mA.
+    # The source is either a function returning the current (polled) or a streaming DPM802 ammeter.
+    # Neither samples faster than a few times per second : early_peak is the highest sample of the first
+    # current_trace_early_window seconds, it shows a sustained power on overload, not the inrush spike itself.
+
+    def __init__(self, read_current=None, meter=None, name="", config={}, logger=None):
+        self.config = config
+
+        if logger is None:
+            self.logger = logging.getLogger(__name__)
+        else:
+            self.logger = logger.getChild(__name__)
+        self.logger.setLevel(self.config.get("log_level", "INFO"))
+
+        self.read_current = read_current
+        self.meter = meter
+        self.name = name
+
+        self.times = array.array("f")
+        self.currents = array.array("f")
+        self.markers = {}
+        self.read_errors = 0
+
+        self.start_time = None
+        self.stop_condition = None
+        self.stop_request = threading.Event()
+        self.thread = None
+
+    def start(self):
+        def trace_thread(self):
+            # The polled source shares its port with the test sequence, a few samples per second are enough
+            period = self.config.get("current_trace_period", 0.1)
+            timeout = (self.start_time + self.config.get("current_trace_max_duration", 90))
+            while not self.stop_request.is_set():
+                now = time.time()
+                if now >= timeout:
+                    self.logger.warning("Current trace stopped, maximum duration reached")
+                    break
+                if (self.stop_condition is not None) and self.stop_condition():
+                    break
+
+                if self.read_current is not None:
+                    try:
+                        current = self.read_current()
+                    except Exception as ex:
+                        self.read_errors += 1
+                        self.logger.debug(f"Current read failed : {ex}")
+                    else:
+                        if current is not None:
+                            self.times.append(now - self.start_time)
+                            self.currents.append(current)
+
+                self.stop_request.wait(period)
+
+            if self.meter is not None:
+                for sample in self.meter.samples_since(self.start_time):
+                    self.times.append(sample.timestamp - self.start_time)
+                    self.currents.append(sample.value)
+
+            self.mark("end")
+
+        self.start_time = time.time()
+        self.thread = threading.Thread(name="CurrentTraceThread", target=trace_thread, args=(self,), daemon=True)
+        self.thread.start()
+        return self
+
+    def mark(self, name):
+        # Event of the power sequence, in seconds since the start
+        self.markers[name] = (time.time() - self.start_time)
+
+    def stop_when(self, condition):
+        # The trace stops by itself as soon as condition() returns True
+        self.stop_condition = condition
+
+    def stop(self):
+        if self.thread is not None:
+            self.stop_request.set()
+            self.thread.join()
+            self.thread = None
+
+    def is_running(self):
+        return ((self.thread is not None) and self.thread.is_alive())
+
+    def features(self):
+        if len(self.currents) <= 0:
+            return None
+
+        # Times are relative to the power on if it was marked
+        origin = self.markers.get("power_on", 0.0)
+        early_window = self.config.get("current_trace_early_window", 0.5)
+        steady_window = self.config.get("current_trace_steady_window", 2.0)
+
+        samples = [(t - origin, i) for (t, i) in zip(self.times, self.currents) if t >= origin]
+        if len(samples) <= 0:
+            return None
+
+        early = [i for (t, i) in samples if t <= early_window]
+        end = samples[-1][0]
+        steady = [i for (t, i) in samples if t >= (end - steady_window)]
+        steady_state = (sum(steady) / len(steady))
+
+        # Settled once the current stays around the steady state
+        tolerance = max(self.config.get("current_trace_settle_tolerance", 10.0),
+                        (abs(steady_state) * self.config.get("current_trace_settle_ratio", 0.1)))
+        settle_time = 0.0
+        for (n, (t, i)) in enumerate(samples):
+            if abs(i - steady_state) > tolerance:
+                settle_time = samples[min((n + 1), (len(samples) - 1))][0]
+
+        return {
+            "early_peak": (max(early) if len(early) > 0 else None),
+            "peak": max([i for (t, i) in samples]),
+            "settle_time": settle_time,
+            "steady_state": steady_state,
+        }
+
+    @staticmethod
+    def encode(values):
+        if sys.byteorder != "little":
+            values = array.array(values.typecode, values)
+            values.byteswap()
+        return base64.b64encode(values.tobytes()).decode("ascii")
+
+    @staticmethod
+    def decode(buff):
+        values = array.array("f")
+        values.frombytes(base64.b64decode(buff))
+        if sys.byteorder != "little":
+            values.byteswap()
+        return values
+
+    def dump(self):
+        # JSON serializable, the samples are little endian float32 encoded in base64
+        return {
+            "source": self.name,
+            "start_time": self.start_time,
+            "nb_samples": len(self.currents),
+            "read_errors": self.read_errors,
+            "markers": self.markers,
+            "features": self.features(),
+            "times": CurrentTrace.encode(self.times),
+            "currents_ma": CurrentTrace.encode(self.currents),
+        }
@@ -0,0 +1,352 @@
+import logging
+import serial
+import serial.tools.list_ports
+import time
+import enum
+import collections
+import threading
+import bisect
+import numpy
+
+
+class DPM802():
+    # Driver shared by every DPM802 meter, the frames are decoded through tables computed once
+    NAME = "DPM802"
+
+    class DPM802Exception(Exception):
+        def __init__(self, msg):
+            super().__init__(msg)
+
+    class Function(enum.Enum):
+        VOLTAGE = 0b0111011
+        CURRENT_UA = 0b0111101
+        CURRENT_MA = 0b0111001
+        CURRENT_A = 0b0111111
+        ADP0 = 0b0111110
+        ADP1 = 0b0111100
+        ADP2 = 0b0111000
+        ADP3 = 0b0111010
+
+    Measure = collections.namedtuple(
+        typename="Measure", field_names=["function", "value"])
+
+    # Measure of the streaming mode, timestamped when its frame was received
+    Sample = collections.namedtuple(
+        typename="Sample", field_names=["timestamp", "function", "value"])
+
+    # range, 4 digits, function, status, 2 option bytes and "\r\n"
+    FRAME_SIZE = 11
+
+    DIGITS = {
+        0b0110000: 0,
+        0b0110001: 1,
+        0b0110010: 2,
+        0b0110011: 3,
+        0b0110100: 4,
+        0b0110101: 5,
+        0b0110110: 6,
+        0b0110111: 7,
+        0b0111000: 8,
+        0b0111001: 9,
+    }
+
+    FACTORS = {
+        0b0110000: {Function.VOLTAGE: 0.0001, Function.CURRENT_UA: 0.1, Function.CURRENT_MA: 0.01, Function.CURRENT_A: 0.01},
+        0b0110001: {Function.VOLTAGE: 0.001,  Function.CURRENT_UA: 1,  Function.CURRENT_MA: 0.1},
+        0b0110010: {Function.VOLTAGE: 0.01},
+        0b0110011: {Function.VOLTAGE: 0.1},
+        0b0110100: {Function.VOLTAGE: 1},
+        0b0110101: {},
+    }
+
+    # Convert all function to the same unit...
+    UNITS = {
+        Function.CURRENT_UA: (0.001, Function.CURRENT_MA),
+        Function.CURRENT_A: (1000, Function.CURRENT_MA),
+    }
+
+    # Any invalid digit makes the decoded value negative
+    INVALID_DIGIT = -100000
+
+    # Filled below the class : DIGIT_TABLE[byte] -> digit, SCALE_TABLE[range << 8 | function] -> (factor, unit factor, function)
+    # and the same scales as arrays for decode_many(), function is -1 for invalid keys
+    DIGIT_TABLE = None
+    SCALE_TABLE = None
+    SCALE_ARRAYS = None
+
+    @staticmethod
+    def list():
+        DEFAULT_USB_IDS = [
+            {"VID": 0x0403, "PID": 0x6001},
+        ]
+
+        def list_serial_ports(vid, pid):
+            return [port.device for port in serial.tools.list_ports.comports()
+                    if ((vid == port.vid) and (pid == port.pid))]
+
+        for usb_ids in DEFAULT_USB_IDS:
+            ports = list_serial_ports(usb_ids["VID"], usb_ids["PID"])
+            if len(ports) > 0:
+                return ports
+
+        return []
+
+    def __init__(self, port=None, config={}, logger=None):
+        self.config = config
+
+        if logger is None:
+            self.logger = logging.getLogger(__name__)
+        else:
+            self.logger = logger.getChild(__name__)
+
+        self.logger.setLevel(self.config.get("log_level", "INFO"))
+
+        if port == None:
+            ports = type(self).list()
+            if len(ports) > 0:
+                port = ports[0]
+
+            if port == None:
+                raise DPM802.DPM802Exception(f"{self.NAME} serial port not found !")
+
+        # Streaming mode : a background thread decodes every frame into a ring buffer
+        self.samples = collections.deque(maxlen=self.config.get("dpm802_stream_buffer_size", 1024))
+        self.samples_condition = threading.Condition()
+        self.stream_stop = threading.Event()
+        self.stream_thread = None
+
+        # self.logger.debug(f"DPM802 port : {port}")
+
+        # This already opens the port
+        self.port = serial.Serial(
+            port, 2400, bytesize=serial.SEVENBITS, parity=serial.PARITY_ODD)
+
+    def __del__(self):
+        try:
+            self.stop_streaming()
+            if self.port.is_open:
+                self.port.close()
+        except AttributeError as ex:
+            pass
+
+    def port_name(self):
+        return self.port.port
+
+    def read_measure(self, timeout=2.5):
+        if self.streaming():
+            # Same freshness as the flush below : the frame must end after the 50 ms delay
+            sample = self.wait_sample((time.time() + 0.05), timeout)
+            measure = DPM802.Measure(sample.function, sample.value)
+            self.logger.debug(f"{self.NAME} : {measure.function} --> {measure.value}")
+            return measure
+
+        self.port.reset_input_buffer()
+
+        time.sleep(0.05)
+
+        now = time.time()
+        timeout = (now + timeout)
+        while now < timeout:
+            self.port.timeout = (timeout - now)
+            buff = (self.port.read_until(serial.to_bytes(b"\r\n")))
+            now = time.time()
+
+            if len(buff) == DPM802.FRAME_SIZE:
+                measure = DPM802.decode_frame(buff)
+                self.logger.debug(f"{self.NAME} : {measure.function} --> {measure.value}")
+                return measure
+
+        raise TimeoutError(f"{self.NAME} timeout !")
+
+    @staticmethod
+    def decode_frame(buff, offset=0):
+        # Works on bytes or a memoryview of a capture, the frame starts at offset
+        digits = DPM802.DIGIT_TABLE
+        value = ((digits[buff[offset + 1]] * 1000) + (digits[buff[offset + 2]] * 100) +
+                 (digits[buff[offset + 3]] * 10) + digits[buff[offset + 4]])
+        scale = DPM802.SCALE_TABLE.get((buff[offset] << 8) | buff[offset + 5])
+        if (value < 0) or (scale is None):
+            raise DPM802.DPM802Exception(f"Invalid frame ({bytes(buff[offset:(offset + DPM802.FRAME_SIZE)])}) !")
+
+        if buff[offset + 6] & (1 << 2):  # Check sign
+            value = -value
+
+        (factor, unit_factor, function) = scale
+        return DPM802.Measure(function, ((value * factor) * unit_factor))
+
+    @staticmethod
+    def decode_many(buff):
+        # Decode a whole capture at once, returns the arrays of function codes and values.
+        # Like read_measure(), only the 11 bytes long lines are frames.
+        data = numpy.frombuffer(buff, dtype=numpy.uint8)
+        ends = (numpy.flatnonzero((data[:-1] == 0x0D) & (data[1:] == 0x0A)) + 2)
+        starts = numpy.concatenate(([0], ends))[:len(ends)]
+        starts = starts[(ends - starts) == DPM802.FRAME_SIZE]
+
+        frames = data[starts[:, None] + numpy.arange(DPM802.FRAME_SIZE - 2)].astype(numpy.int64)
+
+        digits = numpy.array(DPM802.DIGIT_TABLE, dtype=numpy.int64)
+        values = ((digits[frames[:, 1]] * 1000) + (digits[frames[:, 2]] * 100) + (digits[frames[:, 3]] * 10) + digits[frames[:, 4]])
+
+        (factors, unit_factors, functions) = DPM802.SCALE_ARRAYS
+        keys = ((frames[:, 0] << 8) | frames[:, 5])
+        valid = ((values >= 0) & (functions[keys] >= 0))
+
+        values = numpy.where((frames[:, 6] & (1 << 2)) != 0, -values, values)
+        values = ((values * factors[keys]) * unit_factors[keys])
+        return (functions[keys][valid], values[valid])
+
+    def streaming(self):
+        return (self.stream_thread is not None)
+
+    def start_streaming(self):
+        if self.streaming():
+            return
+
+        def stream_thread(self):
+            while not self.stream_stop.is_set():
+                try:
+                    buff = self.port.read_until(serial.to_bytes(b"\r\n"))
+                except serial.SerialException as ex:
+                    self.logger.error(f"{self.NAME} read failed : {ex}")
+                    time.sleep(0.5)
+                    continue
+
+                if len(buff) != DPM802.FRAME_SIZE:
+                    continue
+
+                timestamp = time.time()
+                try:
+                    measure = DPM802.decode_frame(buff)
+                except DPM802.DPM802Exception as ex:
+                    self.logger.debug(ex)
+                    continue
+
+                with self.samples_condition:
+                    self.samples.append(DPM802.Sample(timestamp, measure.function, measure.value))
+                    self.samples_condition.notify_all()
+
+        self.port.reset_input_buffer()
+        # Short timeout to check the stop request
+        self.port.timeout = 0.5
+        self.stream_stop.clear()
+        self.stream_thread = threading.Thread(name=f"{type(self).__name__}_StreamThread", target=stream_thread, args=(self,), daemon=True)
+        self.stream_thread.start()
+
+    def stop_streaming(self):
+        if not self.streaming():
+            return
+
+        self.stream_stop.set()
+        self.stream_thread.join()
+        self.stream_thread = None
+
+    def latest(self):
+        with self.samples_condition:
+            return (self.samples[-1] if len(self.samples) > 0 else None)
+
+    def samples_since(self, timestamp):
+        samples = []
+        with self.samples_condition:
+            for sample in reversed(self.samples):
+                if sample.timestamp < timestamp:
+                    break
+                samples.append(sample)
+
+        samples.reverse()
+        return samples
+
+    def mean_over(self, window):
+        samples = self.samples_since(time.time() - window)
+        if len(samples) <= 0:
+            return None
+        return (sum([sample.value for sample in samples]) / len(samples))
+
+    def wait_sample(self, timestamp, timeout=2.5):
+        # Wait for a sample received after timestamp
+        timeout = (time.time() + timeout)
+        with self.samples_condition:
+            while True:
+                if (len(self.samples) > 0) and (self.samples[-1].timestamp >= timestamp):
+                    return self.samples[-1]
+
+                remaining = (timeout - time.time())
+                if remaining <= 0:
+                    raise TimeoutError(f"{self.NAME} timeout !")
+                self.samples_condition.wait(remaining)
+
+
+class DPM802Group():
+    # Meters sampled in parallel, each one streams on its own port and thread.
+    # Every sample is timestamped with the same clock, so the meters share a timeline.
+    def __init__(self, meters, config={}, logger=None):
+        self.meters = dict(meters)
+        self.config = config
+
+        if logger is None:
+            self.logger = logging.getLogger(__name__)
+        else:
+            self.logger = logger.getChild(__name__)
+        self.logger.setLevel(self.config.get("log_level", "INFO"))
+
+    def __getitem__(self, name):
+        return self.meters[name]
+
+    def start(self):
+        for meter in self.meters.values():
+            meter.start_streaming()
+
+    def stop(self):
+        for meter in self.meters.values():
+            meter.stop_streaming()
+
+    def window(self, start, end=None):
+        # Samples of each meter received between start and end
+        if end is None:
+            end = time.time()
+        return {name: [sample for sample in meter.samples_since(start) if sample.timestamp <= end] for (name, meter) in self.meters.items()}
+
+    def means(self, start, end=None):
+        means = {}
+        for (name, samples) in self.window(start, end).items():
+            means[name] = ((sum([sample.value for sample in samples]) / len(samples)) if len(samples) > 0 else None)
+        return means
+
+    def capture(self, duration):
+        # Every meter over the same window
+        start = time.time()
+        time.sleep(duration)
+        return self.window(start)
+
+    def timeline(self, start, end=None, period=None):
+        # Values of every meter on a common time grid, each meter holds its last value between two samples
+        if end is None:
+            end = time.time()
+        if period is None:
+            period = self.config.get("dpm802_group_period", 0.1)
+
+        # The sample just before start gives the value at the beginning of the window
+        samples = {name: meter.samples_since(start - self.config.get("dpm802_group_hold", 1.0)) for (name, meter) in self.meters.items()}
+        timestamps = numpy.arange(start, end, period).tolist()
+
+        timeline = {"timestamp": timestamps}
+        for (name, meter_samples) in samples.items():
+            sample_timestamps = [sample.timestamp for sample in meter_samples]
+            values = []
+            for timestamp in timestamps:
+                i = bisect.bisect_right(sample_timestamps, timestamp)
+                values.append(meter_samples[i - 1].value if i > 0 else None)
+            timeline[name] = values
+        return timeline
+
+
+DPM802.DIGIT_TABLE = [DPM802.DIGITS.get(b, DPM802.INVALID_DIGIT) for b in range(256)]
+
+DPM802.SCALE_TABLE = {((range_code << 8) | function.value): (factor, *DPM802.UNITS.get(function, (1, function)))
+                      for (range_code, factors) in DPM802.FACTORS.items() for (function, factor) in factors.items()}
+
+DPM802.SCALE_ARRAYS = (numpy.zeros(0x10000), numpy.zeros(0x10000), numpy.full(0x10000, -1, dtype=numpy.int16))
+for (key, (factor, unit_factor, function)) in DPM802.SCALE_TABLE.items():
+    DPM802.SCALE_ARRAYS[0][key] = factor
+    DPM802.SCALE_ARRAYS[1][key] = unit_factor
+    DPM802.SCALE_ARRAYS[2][key] = function.value
@@ -0,0 +1,34 @@
+import io
+
+import numpy
+from PIL import Image
+
+
+# Same verdicts as image_check.py on the CM4, TAKE_PICTURE_check looks for "Image ok"
+IMAGE_OK = "Image ok"
+TOO_MANY_BLACK_PIXELS = "Too many black pixels"
+TOO_MANY_WHITE_PIXELS = "Too many white pixels"
+
+
+def analyze(data, config={}):
+    # Share of black and white pixels of the image (any format Pillow can decode), on its luminance
+    pixels = numpy.asarray(Image.open(io.BytesIO(data)).convert("L"))
+
+    black_ratio = numpy.count_nonzero(pixels <= config.get("image_black_level", 20)) / pixels.size
+    white_ratio = numpy.count_nonzero(pixels >= config.get("image_white_level", 235)) / pixels.size
+
+    if black_ratio > config.get("image_max_black_ratio", 0.5):
+        message = TOO_MANY_BLACK_PIXELS
+    elif white_ratio > config.get("image_max_white_ratio", 0.5):
+        message = TOO_MANY_WHITE_PIXELS
+    else:
+        message = IMAGE_OK
+
+    return {
+        "message": message,
+        "width": pixels.shape[1],
+        "height": pixels.shape[0],
+        "mean": round(float(pixels.mean()), 2),
+        "black_ratio": round(float(black_ratio), 4),
+        "white_ratio": round(float(white_ratio), 4),
+    }
@@ -7,6 +7,10 @@ import time
 import struct
 import logging
 import collections
+import re
+import threading
+import queue
+import concurrent.futures
 
 
 class IOBoard():
@@ -14,6 +18,12 @@ class IOBoard():
     ESC = 0x33
     EOF = 0xCC
 
+    # Protocol v2 : bit 7 of the command code is set and a sequence number follows it
+    V2_FLAG = 0x80
+
+    # Frames are decoded as (code, data, seq) plain tuples, seq is None for v1 frames.
+    # A namedtuple would cost more than the whole decoding of a short response.
+
     class IOBoardException(Exception):
         def __init__(self, msg):
             super().__init__(msg)
@@ -30,6 +40,13 @@ class IOBoard():
         DPM_AMMETER2 = enum.auto()
         DPM_VOLTMETER = enum.auto()
         CURRENT = enum.auto() #Read current with SN0291 module
+        GPIOS = enum.auto() #Write several GPIOs in a single frame
+        GPIO_SNAPSHOT = enum.auto() #Read the state of every GPIO as a bitmap
+        GPIO_NOTIFY = enum.auto() #Enable/disable the notification of a GPIO changes
+        GPIO_EVENT = enum.auto() #Unsolicited frame sent by the board when a notified GPIO changes
+        ADC = enum.auto() #Read one sample of an ADC channel
+        ADC_BLOCK = enum.auto() #Read N consecutive samples of an ADC channel in a single frame
+        SCAN = enum.auto() #Step the voltage measure multiplexer through a list of addresses, one ADC result per address
 
     class CommandRetCode(enum.Enum):
         OK = 0xFF  # -1
@@ -37,11 +54,11 @@ class IOBoard():
         NONE = 0
 
         GENERIC = 1
-        CHKSM = enum.auto()
-        CMD_UNKNOW = enum.auto()
-        CMD_NOT_IMPLEMENTED = enum.auto()
-        BUSY = enum.auto()
-        INVALID_ARGUMENT = enum.auto()
+        CHKSM = 2
+        CMD_UNKNOW = 3
+        CMD_NOT_IMPLEMENTED = 4
+        BUSY = 5
+        INVALID_ARGUMENT = 6
 
     class GPIO(enum.Enum):
         # Expanders
@@ -109,8 +126,317 @@ class IOBoard():
         A1_SWA = enum.auto()
         EN_SWA = enum.auto()
 
+    class ADCChannel(enum.Enum):
+        VOLT_MEAS = 0 # Output of the voltage measure multiplexer, same input as the DPM802 voltmeter
+
+    # 12 bits ADC, 1.2V reference, behind a 33k/16.5k divider
+    ADC_REFERENCE_MV = 1200
+    ADC_RESOLUTION = 4096
+    ADC_DIVIDER = ((33000 + 16500) / 16500)
+    # 2 bytes per sample, the frame stays below the size of the firmware buffer
+    ADC_BLOCK_MAX_SAMPLES = 64
+
+    # Address of each rail on the voltage measure multiplexer : A0 is bit 0, A1 bit 1, A2 bit 2
+    RAIL_MUX_ADDRESSES = {
+        "5V": 0b001,  # TP18
+        "3V3": 0b011,  # TP11
+        "3V3_RADAR": 0b010,  # TP17
+    }
+    MUX_ADDRESS_GPIOS = ["A0_SWA", "A1_SWA", "A2_SWA"]
+
+    RailScan = collections.namedtuple("RailScan", ["mean_mv", "stdev_mv", "nb_samples"])
+
+    # One bit per GPIO, bit n of the bitmap is the GPIO of value n (LSB first)
+    GPIO_SNAPSHOT_SIZE = ((len(GPIO) + 7) // 8)
+
+    # Outputs the firmware drives itself while running these commands, their shadow is invalidated (None : every GPIO)
+    FIRMWARE_DRIVEN_GPIOS = {
+        CommandCode.RESET: None,
+        CommandCode.DPM_AMMETER1: [gpio for gpio in GPIO if gpio.name.endswith("_DMM1")],
+        CommandCode.DPM_AMMETER2: [gpio for gpio in GPIO if gpio.name.endswith("_DMM2")],
+        CommandCode.DPM_VOLTMETER: [gpio for gpio in GPIO if gpio.name.endswith("_DMM3")],
+        CommandCode.SCAN: [GPIO.A0_SWA, GPIO.A1_SWA, GPIO.A2_SWA],  # Left on the last scanned address
+    }
+
+    class FrameDecoder():
+        # Streaming decoder : raw bytes are fed as they are read, complete frames are queued.
+        # Only the special bytes are handled in Python, runs of regular bytes are copied at once.
+        SPECIAL_BYTE_PATTERN = re.compile(b"[\\xFF\\x33\\xCC]")
+        SPECIAL_BYTES = b"\xFF\x33\xCC"
+        FRAME_DELIMITERS = (0xFF + 0xCC)  # SOF + EOF, summed with the payload by the fast path
+
+        def __init__(self, stats_lock=None):
+            self.frames = collections.deque()
+            self.payload = bytearray()
+            self.in_frame = False
+            self.escaped = False
+            # Fed from the reader thread with protocol v2, crc_errors is read with the other statistics under stats_lock
+            self.crc_errors = 0
+            self.stats_lock = (threading.Lock() if stats_lock is None else stats_lock)
+            self.command_codes = {code.value: code for code in IOBoard.CommandCode}
+
+        def reset(self):
+            self.frames.clear()
+            self.payload.clear()
+            self.in_frame = False
+            self.escaped = False
+
+        def feed(self, data):
+            # Fast path : the read is a single frame without any escaped byte, the usual short response.
+            # No payload copy, no scan in Python : a v1 frame is checked and queued at once.
+            size = len(data)
+            if ((not self.in_frame) and (size >= 4) and (data[0] == IOBoard.SOF) and (data[-1] == IOBoard.EOF) and
+                    (len(data.translate(None, self.SPECIAL_BYTES)) == (size - 2))):
+                cmd_code = self.command_codes.get(data[1])
+                crc = data[-2]
+                if (cmd_code is not None) and (crc == ((sum(data) - self.FRAME_DELIMITERS - crc) & 0xFF)):
+                    self.frames.append((cmd_code, list(data[2:-2]), None))
+                else:  # v2 frames, CRC errors and unknown codes
+                    self.queue_frame(data[1:-1])
+                return len(self.frames)
+
+            SOF = IOBoard.SOF
+            ESC = IOBoard.ESC
+            EOF = IOBoard.EOF
+            search = self.SPECIAL_BYTE_PATTERN.search
+            find = data.find
+            payload = self.payload
+            view = memoryview(data)
+
+            pos = 0
+            while pos < size:
+                if not self.in_frame:
+                    pos = find(SOF, pos)
+                    if pos < 0:
+                        break
+                    pos += 1
+
+                    # Fast path : complete frame without any escaped byte
+                    end = find(EOF, pos)
+                    if (end >= 0) and (find(ESC, pos, end) < 0) and (find(SOF, pos, end) < 0):
+                        self.queue_frame(data[pos:end])
+                        pos = end + 1
+                        continue
+
+                    payload.clear()
+                    self.in_frame = True
+                    continue
+
+                if self.escaped:
+                    payload.append(data[pos])
+                    self.escaped = False
+                    pos += 1
+                    continue
+
+                match = search(data, pos)
+                if match is None:
+                    payload += view[pos:]
+                    break
+
+                special = match.start()
+                payload += view[pos:special]
+                b = data[special]
+                if b == ESC:
+                    self.escaped = True
+                elif b == EOF:
+                    self.queue_frame(payload)
+                    self.in_frame = False
+                else:  # Unescaped SOF, restart a new frame
+                    payload.clear()
+                pos = special + 1
+
+            return len(self.frames)
+
+        def queue_frame(self, payload):
+            if len(payload) < 2:  # At least the command code and the CRC
+                return
+
+            crc = payload[-1]
+            if crc != ((sum(payload) - crc) & 0xFF):
+                with self.stats_lock:
+                    self.crc_errors += 1
+                self.frames.append(IOBoard.IOBoardException("Invalid CRC !"))
+                return
+
+            code = payload[0]
+            if code & IOBoard.V2_FLAG:
+                if len(payload) < 3:  # The sequence number is missing
+                    self.frames.append(IOBoard.IOBoardException("Truncated v2 frame !"))
+                    return
+                (code, seq, start) = ((code ^ IOBoard.V2_FLAG), payload[1], 2)
+            else:
+                (seq, start) = (None, 1)
+
+            cmd_code = self.command_codes.get(code)
+            if cmd_code is None:
+                self.frames.append(IOBoard.IOBoardException(f"Unknown command code ({code}) !"))
+                return
+
+            self.frames.append((cmd_code, list(payload[start:-1]), seq))
+
+        def pop(self):
+            if not self.frames:
+                return None
+
+            frame = self.frames.popleft()
+            if isinstance(frame, Exception):
+                raise frame
+            return frame
+
+        def __iter__(self):
+            while self.frames:
+                yield self.pop()
+
+    class FrameEncoder():
+        # Frames are built in a reusable buffer, every byte is escaped through a lookup table.
+        # Frames of the fixed commands and of every single GPIO access are built only once.
+        FIXED_COMMANDS = ["VERSION", "ID", "RESET"]
+
+        def __init__(self):
+            self.escaped_bytes = [(bytes([IOBoard.ESC, b]) if IOBoard.byte_is_special(b) else bytes([b])) for b in range(256)]
+            self.buff = bytearray()
+
+            self.frames = {}
+            for name in IOBoard.FrameEncoder.FIXED_COMMANDS:
+                cmd_code = IOBoard.CommandCode[name]
+                self.frames[(cmd_code,)] = bytes(self.build(cmd_code, []))
+            for gpio in IOBoard.GPIO:
+                self.frames[(IOBoard.CommandCode.GPIO, gpio.value)] = bytes(self.build(IOBoard.CommandCode.GPIO, [gpio.value]))
+                for value in [0, 1]:
+                    self.frames[(IOBoard.CommandCode.GPIO, gpio.value, value)] = bytes(self.build(IOBoard.CommandCode.GPIO, [gpio.value, value]))
+
+        def build(self, cmd_code, data, seq=None):
+            # The returned buffer is overwritten by the next call
+            escaped_bytes = self.escaped_bytes
+            cmd_code = cmd_code.value
+
+            buff = self.buff
+            buff.clear()
+            buff.append(IOBoard.SOF)
+            if seq is not None:
+                buff += escaped_bytes[cmd_code | IOBoard.V2_FLAG]
+                buff += escaped_bytes[seq]
+                cmd_code += (IOBoard.V2_FLAG + seq)  # Both are part of the CRC
+            else:
+                buff += escaped_bytes[cmd_code]
+            for b in data:
+                buff += escaped_bytes[b]
+            buff += escaped_bytes[(cmd_code + sum(data)) & 0xFF]
+            buff.append(IOBoard.EOF)
+
+            return buff
+
+        def encode(self, cmd_code, data, seq=None):
+            if (seq is None) and (len(data) <= 2):
+                frame = self.frames.get((cmd_code, *data))
+                if frame is not None:
+                    return frame
+
+            return self.build(cmd_code, data, seq)
+
+    class LatencyHistogram():
+        # Fixed size, bucket n counts the latencies in [2^(n-1), 2^n[ microseconds, the last one everything above
+        NB_BUCKETS = 24
+
+        def __init__(self):
+            self.reset()
+
+        def reset(self):
+            self.buckets = [0] * IOBoard.LatencyHistogram.NB_BUCKETS
+            self.count = 0
+            self.total = 0.0
+            self.max = 0.0
+
+        def record(self, elapsed):
+            self.buckets[min(int(elapsed * 1000000).bit_length(), (IOBoard.LatencyHistogram.NB_BUCKETS - 1))] += 1
+            self.count += 1
+            self.total += elapsed
+            if elapsed > self.max:
+                self.max = elapsed
+
+        def percentile(self, percent):
+            # Upper bound of the bucket reaching the percentile, in ms
+            threshold = (self.count * percent / 100)
+            count = 0
+            for (n, nb) in enumerate(self.buckets):
+                count += nb
+                if (count >= threshold) and (nb > 0):
+                    return min(((1 << n) / 1000), (self.max * 1000))
+            return (self.max * 1000)
+
+        def dump(self):
+            last = (IOBoard.LatencyHistogram.NB_BUCKETS - 1)
+            return {
+                "count": self.count,
+                "mean_ms": round(((self.total * 1000) / max(1, self.count)), 3),
+                "p50_ms": round(self.percentile(50), 3),
+                "p99_ms": round(self.percentile(99), 3),
+                "max_ms": round((self.max * 1000), 3),
+                "buckets_us": {(f"<{1 << n}" if n < last else f">={1 << (n - 1)}"): nb for (n, nb) in enumerate(self.buckets) if nb > 0},
+            }
+
+    class GPIOShadow():
+        # Last value written to each output, used to skip writes that wouldn't change anything.
+        # Shared by IOBoard and AsyncIOBoard, called from the reader thread and the callers.
+        # writes_avoided counts the GPIO/GPIOS frames not sent, not the GPIOs skipped.
+        def __init__(self, enabled=True):
+            self.enabled = enabled
+            self.values = {}
+            self.writes_avoided = 0
+            self.lock = threading.Lock()
+
+        def invalidate(self, gpios=None):
+            # The next write of these GPIOs (every GPIO if None) is sent even if the value is the same
+            with self.lock:
+                if gpios is None:
+                    self.values.clear()
+                    return
+
+                for gpio in gpios:
+                    self.values.pop(gpio, None)
+
+        def invalidate_driven(self, commands):
+            for (cmd_code, data) in commands:
+                if cmd_code in IOBoard.FIRMWARE_DRIVEN_GPIOS:
+                    self.invalidate(IOBoard.FIRMWARE_DRIVEN_GPIOS[cmd_code])
+
+        def update(self, gpio_values):
+            with self.lock:
+                self.values.update(gpio_values)
+
+        def filter(self, gpio_values, force=False):
+            if force or (not self.enabled):
+                return list(gpio_values)
+
+            gpio_writes = []
+            with self.lock:
+                shadow = dict(self.values)
+                for (gpio, value) in gpio_values:
+                    if shadow.get(gpio) == value:
+                        continue
+                    shadow[gpio] = value
+                    gpio_writes.append((gpio, value))
+            return gpio_writes
+
+        def count_avoided(self, frames_nb):
+            with self.lock:
+                self.writes_avoided += frames_nb
+
+        def check_write_ok(self, code, data):
+            try:
+                return IOBoard.check_return_ok(code, data)
+            except IOBoard.IOBoardException:
+                self.invalidate()
+                raise
+
     SILENCED_COMMANDS = []
 
+    # ECHO with the v2 flag, see probed_protocol()
+    PROTOCOL_PROBE = (CommandCode.ECHO, [SOF])
+
+    # Fixed delay previously slept between each command and its response
+    LEGACY_TURNAROUND = 0.01
+
     @staticmethod
     def byte_is_special(byte):
         return byte in [IOBoard.SOF, IOBoard.ESC, IOBoard.EOF]
@@ -142,6 +468,49 @@ class IOBoard():
         else:
             self.logger = logger.getChild(__name__)
         self.logger.setLevel(self.config.get("log_level", "INFO"))
+
+        # Cleared as soon as the firmware answers it doesn't know the GPIOS command
+        self.batched_gpios_supported = self.config.get("io_board_batched_gpios", True)
+        self.gpio_snapshot_supported = self.config.get("io_board_gpio_snapshot", True)
+        self.gpio_notify_supported = self.config.get("io_board_gpio_notify", True)
+        self.current_supported = self.config.get("io_board_current", True)
+        self.adc_block_supported = self.config.get("io_board_adc_block", True)
+        self.scan_supported = self.config.get("io_board_scan", True)
+
+        # Callbacks called with (gpio, value) when a GPIO_EVENT frame is received
+        self.gpio_listeners = {}
+
+        # Minimum time between a command and its response, per command code.
+        # turnaround_saved : time the exchanges would at least have taken with the former fixed sleep, minus the time they took.
+        self.turnaround = {}
+        self.turnaround_saved = 0.0
+
+        self.gpio_shadow = IOBoard.GPIOShadow(self.config.get("io_board_gpio_shadow", True))
+
+        # Latency of every exchange per command code and per GPIO, errors counters (CRC errors are counted by the decoder)
+        self.latency = {code: IOBoard.LatencyHistogram() for code in IOBoard.CommandCode}
+        self.gpio_latency = {gpio.value: IOBoard.LatencyHistogram() for gpio in IOBoard.GPIO}
+        self.retries = 0
+        self.timeouts = 0
+        # The statistics are updated from the callers and the pipeline threads
+        self.stats_lock = threading.Lock()
+
+        self.encoder = IOBoard.FrameEncoder()
+        self.decoder = IOBoard.FrameDecoder(self.stats_lock)
+
+        # v1 : one command at a time, the lock serializes the threads sharing the board
+        # v2 : requests are tagged with a sequence number, several of them can be in flight
+        self.protocol = "v1"
+        self.lock = threading.RLock()
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        self.next_seq = 1
+        self.max_in_flight = self.config.get("io_board_max_in_flight", 8)
+        self.in_flight = threading.BoundedSemaphore(self.max_in_flight)
+        self.tx_queue = queue.Queue()
+        self.pipeline_stop = threading.Event()
+        self.pipeline_threads = []
+
         if port == None:
             ports = IOBoard.list()
             if len(ports) > 0:
@@ -157,7 +526,11 @@ class IOBoard():
         self.port = serial.Serial(port, 115200)
 
     def __del__(self):
+        self.close()
+
+    def close(self):
         try:
+            self.stop_pipeline()
             if self.port.is_open:
                 self.port.close()
         except AttributeError as ex:
@@ -166,105 +539,469 @@ class IOBoard():
     def port_name(self):
         return self.port.port
 
-    def send(self, cmd_code, data=None):
+    def log_tx(self, cmd_code, data, seq=None):
+        if self.logger.isEnabledFor(logging.DEBUG):
+            # if not cmd_code in IOBoard.SILENCED_COMMANDS:
+            if not ((cmd_code == IOBoard.CommandCode.GPIO) and (data[0] == IOBoard.GPIO.SW_JIG_2.value)):
+                self.logger.debug(f"TX {cmd_code} : {data}" + ("" if seq is None else f" (#{seq})"))
+
+    def log_rx(self, frame):
+        (code, data, seq) = frame
+        # if not cmd_code in IOBoard.SILENCED_COMMANDS:
+        if (not (code == IOBoard.CommandCode.GPIO)) and self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(f"RX {code} : {data}" + ("" if seq is None else f" (#{seq})"))
+
+    def send(self, cmd_code, data=None, seq=None):
         if data is None:
             data = []
 
-        # if not cmd_code in IOBoard.SILENCED_COMMANDS:
-        if not ((cmd_code == IOBoard.CommandCode.GPIO) and (data[0] == IOBoard.GPIO.SW_JIG_2.value)):
-            self.logger.debug(f"TX {cmd_code} : {data}")
+        self.log_tx(cmd_code, data, seq)
+        self.port.write(self.encoder.encode(cmd_code, data, seq))
+
+    def receive(self, timeout=1):
+        (code, data, seq) = self.receive_frame(timeout)
+        return (code, data)
+
+    def receive_frame(self, timeout=1):
+        now = time.time()
+        timeout = (now + timeout)
+        while True:
+            frame = self.decoder.pop()
+            if frame is not None:
+                if frame[0] == IOBoard.CommandCode.GPIO_EVENT:
+                    self.dispatch_gpio_event(frame[1])
+                    continue
 
-        cmd_code = cmd_code.value
+                self.log_rx(frame)
+                return frame
 
-        buff = [IOBoard.SOF]
+            if now >= timeout:
+                break
 
-        if IOBoard.byte_is_special(cmd_code):
-            buff.append(IOBoard.ESC)
+            self.port.timeout = (timeout - now)
+            self.decoder.feed(self.port.read(max(1, self.port.in_waiting)))
+            now = time.time()
 
-        buff.append(cmd_code)
+        raise TimeoutError("IO Board timeout !")
 
-        chksm = cmd_code
-        for b in data:
-            chksm += b
-            if IOBoard.byte_is_special(b):
-                buff.append(IOBoard.ESC)
-            buff.append(b)
-        chksm = chksm & 0xFF
+    @staticmethod
+    def check_return_ok(code, data):
+        if (code == IOBoard.CommandCode.RETURN) and (len(data) == 1):
+            if (data[0] == IOBoard.CommandRetCode.OK.value):
+                return True
 
-        if IOBoard.byte_is_special(chksm):
-            buff.append(IOBoard.ESC)
-        buff.append(chksm)
+        raise IOBoard.IOBoardException(f"Invalid response ({code}:{data}) !")
 
-        buff.append(IOBoard.EOF)
+    @staticmethod
+    def is_not_supported(code, data):
+        return ((code == IOBoard.CommandCode.RETURN) and (len(data) == 1) and
+                (data[0] in [IOBoard.CommandRetCode.CMD_UNKNOW.value, IOBoard.CommandRetCode.CMD_NOT_IMPLEMENTED.value]))
 
-        self.port.write(buff)
+    @staticmethod
+    def probed_protocol(code, seq=None, expected_seq=None):
+        # v1 firmware answers CMD_UNKNOW to a command code with the v2 flag, v2 firmware echoes it
+        if (code == IOBoard.CommandCode.ECHO) and (seq == expected_seq):
+            return "v2"
+        return "v1"
 
-    def receive(self, timeout=1):
-        buff = []
+    @staticmethod
+    def parse_gpio_event(data, logger):
+        # (gpio, value) of a GPIO_EVENT frame, None if it is invalid
+        if len(data) != 2:
+            logger.warning(f"Invalid GPIO event : {data}")
+            return None
 
-        now = time.time()
-        timeout = (now + timeout)
-        while now < timeout:
-            self.port.timeout = (timeout - now)
-            buff.extend(self.port.read_until(serial.to_bytes([IOBoard.EOF])))
-            now = time.time()
+        try:
+            gpio = IOBoard.GPIO(data[0])
+        except ValueError:
+            logger.warning(f"GPIO event for an unknown GPIO : {data}")
+            return None
 
-            try:
-                buff = buff[buff.index(IOBoard.SOF):]
-            except:
-                pass
-
-            if len(buff) >= 4:
-                if (buff[0] == IOBoard.SOF) and (buff[-1] == IOBoard.EOF):
-                    i = 2
-                    while (i < len(buff)) and (buff[-i] == IOBoard.ESC):
-                        i += 1
-                    if i % 2:
-                        continue
+        value = (data[1] != 0)
+        logger.debug(f"GPIO event {gpio} : {value}")
+        return (gpio, value)
 
-                    buff = buff[1:-1]  # Keep only payload and CRC
+    # The GPIO commands sequences are shared with AsyncIOBoard : these generators yield the list of
+    # (cmd_code, data) commands to send, get back their (code, data) responses and return the result.
+    @staticmethod
+    def read_gpio_snapshot_steps(board):
+        if not board.gpio_snapshot_supported:
+            return None
 
-                    # Unescape
-                    i = 0
-                    while i < len(buff):
-                        if buff[i] == IOBoard.ESC:
-                            buff.pop(i)
-                        i += 1
+        [(code, data)] = yield [(IOBoard.CommandCode.GPIO_SNAPSHOT, [])]
+        if (code == IOBoard.CommandCode.GPIO_SNAPSHOT) and (len(data) >= IOBoard.GPIO_SNAPSHOT_SIZE):
+            return {gpio: ((data[gpio.value >> 3] & (1 << (gpio.value & 0x07))) != 0) for gpio in IOBoard.GPIO}
 
-                    crc = buff.pop(-1)
+        if not IOBoard.is_not_supported(code, data):
+            raise IOBoard.IOBoardException(f"Invalid response ({code}:{data}) !")
 
-                    # Check CRC and format result
-                    if crc == (sum(buff) & 0xFF):
-                        cmd_code = IOBoard.CommandCode(buff.pop(0))
-                        data = buff
+        # Older firmware, fallback to one frame per GPIO
+        board.logger.warning("IO Board doesn't support GPIOs snapshot, fallback to single reads")
+        board.gpio_snapshot_supported = False
+        return None
 
-                        # if not cmd_code in IOBoard.SILENCED_COMMANDS:
-                        if not (cmd_code == IOBoard.CommandCode.GPIO):
-                            self.logger.debug(f"RX {cmd_code} : {data}")
+    @staticmethod
+    def read_gpios_steps(board, gpios):
+        gpios = list(gpios)
 
-                        return (cmd_code, data)
+        if len(gpios) > 1:
+            snapshot = yield from IOBoard.read_gpio_snapshot_steps(board)
+            if snapshot is not None:
+                return {gpio: snapshot[gpio] for gpio in gpios}
 
-                    raise IOBoard.IOBoardException("Invalid CRC !")
+        responses = yield [(IOBoard.CommandCode.GPIO, [gpio.value]) for gpio in gpios]
 
-        raise TimeoutError("IO Board timeout !")
+        values = {}
+        for (gpio, (code, data)) in zip(gpios, responses):
+            if (code != IOBoard.CommandCode.GPIO) or (len(data) != 1):
+                raise IOBoard.IOBoardException(f"Invalid response ({code}:{data}) !")
+            values[gpio] = (data[0] != 0)
+        return values
 
     @staticmethod
-    def check_return_ok(code, data):
-        if (code == IOBoard.CommandCode.RETURN) and (len(data) == 1):
-            if (data[0] == IOBoard.CommandRetCode.OK.value):
+    def write_gpios_steps(board, gpio_values, force=False):
+        max_gpios = board.config.get("io_board_max_gpios_per_frame", 16)
+
+        def frames_nb(gpios_nb):
+            # GPIOS frames of max_gpios GPIOs, or one GPIO frame per GPIO
+            if board.batched_gpios_supported and (gpios_nb > 1):
+                return ((gpios_nb + max_gpios - 1) // max_gpios)
+            return gpios_nb
+
+        gpio_values = list(gpio_values)
+        requested_nb = len(gpio_values)
+        gpio_values = board.gpio_shadow.filter(gpio_values, force)
+        board.gpio_shadow.count_avoided(frames_nb(requested_nb) - frames_nb(len(gpio_values)))
+        if len(gpio_values) <= 0:
+            return True
+
+        if board.batched_gpios_supported and (len(gpio_values) > 1):
+            for i in range(0, len(gpio_values), max_gpios):
+                data = []
+                for (gpio, value) in gpio_values[i:(i + max_gpios)]:
+                    data.extend([gpio.value, value])
+
+                [(code, data)] = yield [(IOBoard.CommandCode.GPIOS, data)]
+                if IOBoard.is_not_supported(code, data):
+                    break
+                board.gpio_shadow.check_write_ok(code, data)
+                board.gpio_shadow.update(gpio_values[i:(i + max_gpios)])
+            else:
                 return True
 
-        raise IOBoard.IOBoardException(f"Invalid response ({code}:{data}) !")
+            # Older firmware, fallback to one frame per GPIO
+            board.logger.warning("IO Board doesn't support batched GPIOs write, fallback to single writes")
+            board.batched_gpios_supported = False
+            gpio_values = gpio_values[i:]
 
-    def send_and_receive(self, cmd_code, data=None, timeout=1):
-        self.port.reset_output_buffer()
-        self.port.reset_input_buffer()
+        responses = yield [(IOBoard.CommandCode.GPIO, [gpio.value, value]) for (gpio, value) in gpio_values]
+        for ((gpio, value), (code, data)) in zip(gpio_values, responses):
+            board.gpio_shadow.check_write_ok(code, data)
+            board.gpio_shadow.update([(gpio, value)])
+        return True
 
-        self.send(cmd_code, data)
+    def run_steps(self, steps):
+        # A single round trip per command with protocol v1, pipelined with v2
+        try:
+            commands = next(steps)
+            while True:
+                commands = steps.send(self.send_and_receive_many(commands))
+        except StopIteration as ex:
+            return ex.value
+
+    def send_and_receive(self, cmd_code, data=None, timeout=1, stats=True):
+        return self.send_and_receive_many([(cmd_code, data)], timeout, stats)[0]
+
+    def send_and_receive_many(self, commands, timeout=1, stats=True):
+        # stats=False leaves the exchange out of the statistics (background polling)
+        # Returns the (code, data) responses in the order of the commands.
+        # With protocol v2 all the commands are sent before waiting for the first response.
+        try_nb = self.config.get("io_board_try_nb", 1)
+        for attempt in range(try_nb):
+            try:
+                responses = self.exchange(commands, timeout, stats)
+                self.gpio_shadow.invalidate_driven(commands)
+                return responses
+            except (IOBoard.IOBoardException, TimeoutError) as ex:
+                # The board state is unknown after a protocol error
+                self.invalidate_gpio_shadow()
+                if stats:
+                    with self.stats_lock:
+                        if isinstance(ex, TimeoutError):
+                            self.timeouts += 1
+                        if (attempt + 1) < try_nb:
+                            self.retries += 1
+                if (attempt + 1) >= try_nb:
+                    raise
+                self.logger.warning(f"IO Board exchange failed ({ex}), retrying...")
+
+    def exchange(self, commands, timeout, stats=True):
+        exchange_start = time.perf_counter()
+        if self.pipeline_running():
+            # Sent by windows of max_in_flight requests, a window is sent once the previous one is answered
+            responses = []
+            for n in range(0, len(commands), self.max_in_flight):
+                requests = []
+                try:
+                    for (cmd_code, data) in commands[n:(n + self.max_in_flight)]:
+                        requests.append((cmd_code, data, time.perf_counter(), self.submit(cmd_code, data, timeout)))
+                except IOBoard.IOBoardException:
+                    for (_, _, _, future) in requests:
+                        self.cancel(future)
+                    raise
+
+                for (i, (cmd_code, data, start, future)) in enumerate(requests):
+                    try:
+                        (code, response, seq) = future.result(timeout)
+                    except concurrent.futures.TimeoutError:
+                        for (_, _, _, remaining) in requests[i:]:
+                            self.cancel(remaining)
+                        raise TimeoutError("IO Board timeout !")
+                    except concurrent.futures.CancelledError:
+                        # stop_pipeline() cancelled the pending requests
+                        for (_, _, _, remaining) in requests[i:]:
+                            self.cancel(remaining)
+                        raise IOBoard.IOBoardException("IO Board request cancelled !")
+                    # Only a lone request measures the board turnaround
+                    if stats:
+                        self.record_latency(cmd_code, data, start, (len(commands) == 1))
+                    responses.append((code, response))
+            if stats:
+                self.record_saved_time(len(commands), exchange_start)
+            return responses
+
+        with self.lock:
+            responses = []
+            for (cmd_code, data) in commands:
+                # Stale bytes go through the decoder : notifications are dispatched, old responses dropped
+                self.process_pending_events()
+                if len(self.gpio_listeners) <= 0:
+                    self.decoder.reset()
+
+                start = time.perf_counter()
+                self.send(cmd_code, data)
+
+                # Blocking reads return as soon as the response is there, no need to wait before
+                responses.append(self.receive(timeout))
+                if stats:
+                    self.record_latency(cmd_code, data, start)
+            if stats:
+                self.record_saved_time(len(commands), exchange_start)
+            return responses
+
+    def record_latency(self, cmd_code, data, start, turnaround=True):
+        elapsed = (time.perf_counter() - start)
+        with self.stats_lock:
+            self.latency[cmd_code].record(elapsed)
+            if (cmd_code == IOBoard.CommandCode.GPIO) and data:
+                histogram = self.gpio_latency.get(data[0])
+                if histogram is not None:
+                    histogram.record(elapsed)
+
+            if turnaround:
+                turnaround = min(self.turnaround.get(cmd_code, elapsed), elapsed)
+                self.turnaround[cmd_code] = turnaround
+
+    def record_saved_time(self, nb_commands, start):
+        # Measured on the whole exchange, the requests of a v2 batch overlap
+        elapsed = (time.perf_counter() - start)
+        with self.stats_lock:
+            self.turnaround_saved += max(0.0, ((nb_commands * IOBoard.LEGACY_TURNAROUND) - elapsed))
+
+    def reset_stats(self):
+        # The turnaround per command code is kept, it is the calibration of the board
+        with self.stats_lock:
+            for histogram in [*self.latency.values(), *self.gpio_latency.values()]:
+                histogram.reset()
+            self.retries = 0
+            self.timeouts = 0
+            self.decoder.crc_errors = 0
+            with self.gpio_shadow.lock:
+                self.gpio_shadow.writes_avoided = 0
+            self.turnaround_saved = 0.0
+
+    def dump_stats(self):
+        with self.stats_lock:
+            return {
+                "protocol": self.protocol,
+                "commands": {code.name: histogram.dump() for (code, histogram) in self.latency.items() if histogram.count > 0},
+                "gpios": {IOBoard.GPIO(value).name: histogram.dump() for (value, histogram) in self.gpio_latency.items() if histogram.count > 0},
+                "retries": self.retries,
+                "timeouts": self.timeouts,
+                "crc_errors": self.decoder.crc_errors,
+                "gpio_writes_avoided": self.gpio_shadow.writes_avoided,
+                "turnaround_saved": round(self.turnaround_saved, 6),
+                "turnaround_ms": {code.name: round((turnaround * 1000), 3) for (code, turnaround) in self.turnaround.items()},
+            }
+
+    def detect_protocol(self, timeout=0.5):
+        protocol = self.config.get("io_board_protocol", "auto")
+
+        if protocol == "auto":
+            protocol = "v1"
+            with self.lock:
+                self.process_pending_events()
+                self.decoder.reset()
+                self.send(*IOBoard.PROTOCOL_PROBE, seq=self.next_seq)
+                try:
+                    (code, data, seq) = self.receive_frame(timeout)
+                    protocol = IOBoard.probed_protocol(code, seq, self.next_seq)
+                except (IOBoard.IOBoardException, TimeoutError) as ex:
+                    self.logger.debug(f"IO Board protocol probe failed : {ex}")
+
+        if protocol == "v2":
+            self.start_pipeline()
+        else:
+            self.stop_pipeline()
+
+        self.protocol = protocol
+        self.logger.info(f"IO Board protocol : {protocol}")
+        return protocol
+
+    def pipeline_running(self):
+        return (len(self.pipeline_threads) > 0)
+
+    def start_pipeline(self):
+        if self.pipeline_running():
+            return
+
+        def writer_thread(self):
+            while not self.pipeline_stop.is_set():
+                try:
+                    frame = self.tx_queue.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+
+                try:
+                    self.port.write(frame)
+                except serial.SerialException as ex:
+                    self.logger.error(f"IO Board write failed : {ex}")
+
+        def reader_thread(self):
+            while not self.pipeline_stop.is_set():
+                try:
+                    self.decoder.feed(self.port.read(max(1, self.port.in_waiting)))
+                except serial.SerialException as ex:
+                    self.logger.error(f"IO Board read failed : {ex}")
+                    time.sleep(0.1)
+                    continue
+
+                while True:
+                    try:
+                        frame = self.decoder.pop()
+                    except IOBoard.IOBoardException as ex:
+                        # Can't tell which request it was, its future will time out
+                        self.logger.warning(f"Invalid frame : {ex}")
+                        continue
 
-        time.sleep(0.01)  # Don't know why it must be here...
+                    if frame is None:
+                        break
+                    self.dispatch_frame(frame)
+
+        with self.lock:
+            self.process_pending_events()
+            self.decoder.reset()
+            # Only the reader thread reads the port from now on, short timeout to check the stop request
+            self.port.timeout = 0.1
+            self.pipeline_stop.clear()
+            self.pipeline_threads = [
+                threading.Thread(name="IOBoardWriterThread", target=writer_thread, args=(self,), daemon=True),
+                threading.Thread(name="IOBoardReaderThread", target=reader_thread, args=(self,), daemon=True),
+            ]
+            for thread in self.pipeline_threads:
+                thread.start()
+
+    def stop_pipeline(self):
+        if not self.pipeline_running():
+            return
+
+        self.pipeline_stop.set()
+        for thread in self.pipeline_threads:
+            if thread is not threading.current_thread():
+                thread.join()
+        self.pipeline_threads = []
+
+        with self.pending_lock:
+            pending = list(self.pending.values())
+            self.pending.clear()
+        for future in pending:
+            future.cancel()
+
+    def submit(self, cmd_code, data=None, timeout=1):
+        # Queue a v2 request, the returned future gets the response frame
+        if data is None:
+            data = []
 
-        return self.receive(timeout)
+        # Slots are only released by responses and cancellations, don't wait for lost ones forever
+        if not self.in_flight.acquire(timeout=timeout):
+            raise IOBoard.IOBoardException(f"Too many IO Board requests in flight ({self.max_in_flight}) !")
+        future = concurrent.futures.Future()
+        future.add_done_callback(lambda _: self.in_flight.release())
+
+        with self.pending_lock:
+            seq = self.next_seq
+            while seq in self.pending:
+                seq = ((seq % 255) + 1)
+            self.next_seq = ((seq % 255) + 1)
+
+            future.seq = seq
+            self.pending[seq] = future
+            # The encoder buffer is shared, copy the frame while holding the lock
+            frame = bytes(self.encoder.encode(cmd_code, data, seq))
+
+        self.log_tx(cmd_code, data, seq)
+        self.tx_queue.put(frame)
+        return future
+
+    def cancel(self, future):
+        with self.pending_lock:
+            if self.pending.get(future.seq) is future:
+                self.pending.pop(future.seq)
+        future.cancel()
+
+    def dispatch_frame(self, frame):
+        (code, data, seq) = frame
+        if code == IOBoard.CommandCode.GPIO_EVENT:
+            try:
+                self.dispatch_gpio_event(data)
+            except Exception as ex:
+                self.logger.error(f"GPIO event callback failed : {ex}")
+            return
+
+        future = None
+        if seq is not None:
+            with self.pending_lock:
+                future = self.pending.pop(seq, None)
+
+        if future is None:
+            self.logger.debug(f"Dropped unexpected frame {code} : {data}")
+            return
+
+        self.log_rx(frame)
+        try:
+            future.set_result(frame)
+        except concurrent.futures.InvalidStateError:
+            pass  # Cancelled by a timeout meanwhile
+
+    def calibrate_turnaround(self, nb_measures=None):
+        if nb_measures is None:
+            nb_measures = self.config.get("io_board_turnaround_calibration_nb", 5)
+
+        # Only commands without side effects
+        for (cmd_code, data) in [
+            (IOBoard.CommandCode.VERSION, []),
+            (IOBoard.CommandCode.ID, []),
+            (IOBoard.CommandCode.ECHO, [0]),
+            (IOBoard.CommandCode.GPIO, [IOBoard.GPIO.SW_JIG_2.value]),
+        ]:
+            for _ in range(nb_measures):
+                self.send_and_receive(cmd_code, data)
+
+        # Calibration exchanges are not part of the statistics
+        self.reset_stats()
+
+        self.logger.debug("IO Board turnaround : " + ", ".join([f"{code.name}={(t * 1000):.2f}ms" for (code, t) in self.turnaround.items()]))
+        return self.turnaround
 
     def read_id(self):
         (code, data) = self.send_and_receive(IOBoard.CommandCode.ID)
@@ -302,18 +1039,84 @@ class IOBoard():
 
         raise IOBoard.IOBoardException(f"Invalid response ({code}:{data}) !")
 
+    @staticmethod
+    def adc_raw_to_mv(raw):
+        return (((raw * IOBoard.ADC_REFERENCE_MV) / IOBoard.ADC_RESOLUTION) * IOBoard.ADC_DIVIDER)
+
+    @staticmethod
+    def adc_saturated(mv):
+        # Above the reference, the measure is clipped to the full scale
+        return (mv >= IOBoard.adc_raw_to_mv(IOBoard.ADC_RESOLUTION - 1))
+
     def read_adc(self, type):
         (code, data) = self.send_and_receive(
             IOBoard.CommandCode.ADC, [type.value], timeout=3)
         if (code == IOBoard.CommandCode.ADC) and (len(data) == 2):
-            raw = struct.unpack("H", bytes(data))[0]
-            raw_mv = ((raw * 1200) / 4096)
-            R1 = 33000
-            R2 = 16500
-            return (raw_mv * ((R1 + R2) / R2))
+            raw = struct.unpack("<H", bytes(data))[0]
+            return IOBoard.adc_raw_to_mv(raw)
 
         raise IOBoard.IOBoardException(f"Invalid response ({code}:{data}) !")
 
+    def read_adc_block(self, type, nb_samples):
+        # Samples in mV, taken back to back by the board
+        if not self.adc_block_supported:
+            return [self.read_adc(type) for _ in range(nb_samples)]
+
+        samples = []
+        while len(samples) < nb_samples:
+            nb = min((nb_samples - len(samples)), IOBoard.ADC_BLOCK_MAX_SAMPLES)
+            (code, data) = self.send_and_receive(
+                IOBoard.CommandCode.ADC_BLOCK, [type.value, nb], timeout=3)
+            if (code == IOBoard.CommandCode.ADC_BLOCK) and (len(data) == (2 * nb)):
+                samples.extend([IOBoard.adc_raw_to_mv(raw) for raw in struct.unpack(f"<{nb}H", bytes(data))])
+                continue
+
+            if not IOBoard.is_not_supported(code, data):
+                raise IOBoard.IOBoardException(f"Invalid response ({code}:{data}) !")
+
+            self.logger.warning("IO Board doesn't support ADC blocks, fallback on single samples")
+            self.adc_block_supported = False
+            return (samples + self.read_adc_block(type, (nb_samples - len(samples))))
+
+        return samples
+
+    def select_rail(self, rail):
+        address = IOBoard.RAIL_MUX_ADDRESSES[rail]
+        return self.write_gpios([(IOBoard.GPIO[name], ((address >> n) & 1)) for (n, name) in enumerate(IOBoard.MUX_ADDRESS_GPIOS)])
+
+    def scan_rails(self, rails, settle=0.1, nb_samples=32):
+        # The board selects each rail, waits settle seconds and averages nb_samples ADC samples.
+        # Request : settle in ms (uint16), nb_samples, then the mux addresses.
+        # Response : mean and standard deviation of each address in 1/16 of ADC LSB (uint16).
+        # The voltage measure multiplexer has to be enabled (EN_SWA) beforehand.
+        if not self.scan_supported:
+            return self.scan_rails_from_host(rails, settle, nb_samples)
+
+        data = list(struct.pack("<HB", round(settle * 1000), nb_samples)) + [IOBoard.RAIL_MUX_ADDRESSES[rail] for rail in rails]
+        (code, data) = self.send_and_receive(IOBoard.CommandCode.SCAN, data, timeout=(1 + (len(rails) * settle)))
+        if (code == IOBoard.CommandCode.SCAN) and (len(data) == (4 * len(rails))):
+            results = struct.unpack(f"<{2 * len(rails)}H", bytes(data))
+            return {rail: IOBoard.RailScan(IOBoard.adc_raw_to_mv(results[2 * n] / 16), IOBoard.adc_raw_to_mv(results[(2 * n) + 1] / 16), nb_samples)
+                    for (n, rail) in enumerate(rails)}
+
+        if not IOBoard.is_not_supported(code, data):
+            raise IOBoard.IOBoardException(f"Invalid response ({code}:{data}) !")
+
+        self.logger.warning("IO Board doesn't support SCAN, fallback on host driven scans")
+        self.scan_supported = False
+        return self.scan_rails_from_host(rails, settle, nb_samples)
+
+    def scan_rails_from_host(self, rails, settle=0.1, nb_samples=32):
+        results = {}
+        for rail in rails:
+            self.select_rail(rail)
+            time.sleep(settle)
+            samples = self.read_adc_block(IOBoard.ADCChannel.VOLT_MEAS, nb_samples)
+            mean = (sum(samples) / len(samples))
+            stdev = ((sum([((sample - mean) ** 2) for sample in samples]) / len(samples)) ** 0.5)
+            results[rail] = IOBoard.RailScan(mean, stdev, len(samples))
+        return results
+
     def toggle_dpm802_1(self):
         (code, data) = self.send_and_receive(IOBoard.CommandCode.DPM_AMMETER1, [])
         return IOBoard.check_return_ok(code, data)
@@ -326,6 +1129,22 @@ class IOBoard():
         (code, data) = self.send_and_receive(IOBoard.CommandCode.DPM_VOLTMETER, [])
         return IOBoard.check_return_ok(code, data)
 
+    def read_current(self, stats=True):
+        # SN0291 module, float in mA. None if the board has no current measure.
+        if not self.current_supported:
+            return None
+
+        (code, data) = self.send_and_receive(IOBoard.CommandCode.CURRENT, stats=stats)
+        if (code == IOBoard.CommandCode.CURRENT) and (len(data) == 4):
+            return struct.unpack("<f", bytes(data))[0]
+
+        if not IOBoard.is_not_supported(code, data):
+            raise IOBoard.IOBoardException(f"Invalid response ({code}:{data}) !")
+
+        self.logger.warning("IO Board doesn't support current measure")
+        self.current_supported = False
+        return None
+
     def set_dpm802_function(self, function):
         (code, data) = self.send_and_receive(
             IOBoard.CommandCode.DPM, [function])
@@ -339,17 +1158,134 @@ class IOBoard():
 
         raise IOBoard.IOBoardException(f"Invalid response ({code}:{data}) !")
 
-    def write_gpio(self, gpio, value):
-        (code, data) = self.send_and_receive(
-            IOBoard.CommandCode.GPIO, [gpio.value, value])
-        return IOBoard.check_return_ok(code, data)
+    def read_gpio_snapshot(self):
+        return self.run_steps(IOBoard.read_gpio_snapshot_steps(self))
 
-    def write_gpios(self, gpio_values):
-        for (gpio, value) in gpio_values:
-            self.write_gpio(gpio, value)
+    def read_gpios(self, gpios):
+        return self.run_steps(IOBoard.read_gpios_steps(self, gpios))
+
+    def read_all_gpios(self):
+        return self.read_gpios(IOBoard.GPIO)
+
+    def invalidate_gpio_shadow(self, gpios=None):
+        self.gpio_shadow.invalidate(gpios)
+
+    def write_gpio(self, gpio, value, force=False):
+        return self.write_gpios([(gpio, value)], force)
+
+    def write_gpios(self, gpio_values, force=False):
+        return self.run_steps(IOBoard.write_gpios_steps(self, gpio_values, force))
+
+    def dispatch_gpio_event(self, data):
+        event = IOBoard.parse_gpio_event(data, self.logger)
+        if event is None:
+            return
+
+        (gpio, value) = event
+        for callback in list(self.gpio_listeners.get(gpio, [])):
+            callback(gpio, value)
+
+    def dispatch_events(self):
+        # Returns True if at least one GPIO event was dispatched, other frames are stale and dropped
+        dispatched = False
+        while True:
+            try:
+                frame = self.decoder.pop()
+            except IOBoard.IOBoardException as ex:
+                self.logger.warning(f"Invalid frame while waiting for events : {ex}")
+                continue
+
+            if frame is None:
+                return dispatched
+
+            (code, data, seq) = frame
+            if code == IOBoard.CommandCode.GPIO_EVENT:
+                self.dispatch_gpio_event(data)
+                dispatched = True
+            else:
+                self.logger.debug(f"Dropped unexpected frame {code} : {data}")
+
+    def process_pending_events(self):
+        if self.pipeline_running():  # The reader thread dispatches them
+            return False
+
+        with self.lock:
+            pending = self.port.in_waiting
+            if pending > 0:
+                self.decoder.feed(self.port.read(pending))
+            return self.dispatch_events()
+
+    def poll_events(self, timeout=0.25):
+        # Wait for unsolicited frames, returns as soon as at least one GPIO event was dispatched
+        now = time.time()
+        timeout = (now + timeout)
+        while now < timeout:
+            with self.lock:
+                self.port.timeout = (timeout - now)
+                self.decoder.feed(self.port.read(max(1, self.port.in_waiting)))
+                if self.dispatch_events():
+                    return True
+            now = time.time()
+
+        return False
+
+    def subscribe_gpio(self, gpio, callback):
+        if not self.gpio_notify_supported:
+            return False
+
+        if len(self.gpio_listeners.get(gpio, [])) <= 0:
+            (code, data) = self.send_and_receive(IOBoard.CommandCode.GPIO_NOTIFY, [gpio.value, 1])
+            if IOBoard.is_not_supported(code, data):
+                self.logger.warning("IO Board doesn't support GPIO notifications, fallback to polling")
+                self.gpio_notify_supported = False
+                return False
+            IOBoard.check_return_ok(code, data)
+
+        self.gpio_listeners.setdefault(gpio, []).append(callback)
+        return True
+
+    def unsubscribe_gpio(self, gpio, callback):
+        callbacks = self.gpio_listeners.get(gpio, [])
+        if callback in callbacks:
+            callbacks.remove(callback)
+
+        if len(callbacks) <= 0:
+            self.gpio_listeners.pop(gpio, None)
+            (code, data) = self.send_and_receive(IOBoard.CommandCode.GPIO_NOTIFY, [gpio.value, 0])
+            return IOBoard.check_return_ok(code, data)
+
+        return True
+
+    def wait_gpio(self, gpio, value, exit_signal=lambda: False, interval_check=0.05):
+        # Wait for a GPIO notification, fallback to polling the GPIO if the board doesn't support it
+        gpio_event = threading.Event()
+
+        def on_gpio_event(gpio, new_value):
+            if new_value == value:
+                gpio_event.set()
+
+        if self.subscribe_gpio(gpio, on_gpio_event):
+            try:
+                # The GPIO may have changed before the notification was enabled
+                if self.read_gpio(gpio) == value:
+                    return True
+
+                poll_timeout = self.config.get("io_board_events_poll_timeout", 0.25)
+                while not exit_signal():
+                    if self.pipeline_running():
+                        gpio_event.wait(poll_timeout)  # Set from the reader thread
+                    else:
+                        self.poll_events(timeout=poll_timeout)
+                    if gpio_event.is_set():
+                        return True
+            finally:
+                self.unsubscribe_gpio(gpio, on_gpio_event)
+            return
 
-    def wait_jig(self, closed, exit_signal=lambda: False, interval_check=0.05):
         while not exit_signal():
-            if self.read_gpio(IOBoard.GPIO.SW_JIG_2) == closed:
+            if self.read_gpio(gpio) == value:
                 return True
             time.sleep(interval_check)
+
+    def wait_jig(self, closed, exit_signal=lambda: False, interval_check=0.05):
+        return self.wait_gpio(IOBoard.GPIO.SW_JIG_2, closed, exit_signal, interval_check)
@@ -0,0 +1,332 @@
+import asyncio
+import logging
+
+import serial_asyncio
+
+from io_board import IOBoard
+
+
+class AsyncIOBoard():
+    # asyncio variant of IOBoard : same frames and commands, the coroutines run on a non blocking serial transport.
+    # Unsolicited frames (GPIO events, late responses) are published in an event stream.
+
+    class Protocol(asyncio.Protocol):
+        def __init__(self, board):
+            self.board = board
+
+        def data_received(self, data):
+            self.board.data_received(data)
+
+        def connection_lost(self, exc):
+            self.board.connection_lost(exc)
+
+    def __init__(self, port="COM27", config={}, logger=None):
+        self.config = config
+
+        if logger is None:
+            self.logger = logging.getLogger(__name__)
+        else:
+            self.logger = logger.getChild(__name__)
+        self.logger.setLevel(self.config.get("log_level", "INFO"))
+
+        if port == None:
+            ports = IOBoard.list()
+            if len(ports) > 0:
+                port = ports[0]
+
+            if port == None:
+                raise IOBoard.IOBoardException(
+                    "IO Board serial port not found !")
+        self.port = port
+
+        self.batched_gpios_supported = self.config.get("io_board_batched_gpios", True)
+        self.gpio_snapshot_supported = self.config.get("io_board_gpio_snapshot", True)
+        self.gpio_notify_supported = self.config.get("io_board_gpio_notify", True)
+        self.gpio_shadow = IOBoard.GPIOShadow(self.config.get("io_board_gpio_shadow", True))
+
+        self.encoder = IOBoard.FrameEncoder()
+        self.decoder = IOBoard.FrameDecoder()
+        self.transport = None
+
+        # v1 : one command at a time, its response resolves self.response
+        # v2 : responses resolve the future of their sequence number
+        self.protocol = "v1"
+        self.lock = None
+        self.response = None
+        self.pending = {}
+        self.next_seq = 1
+
+        # Created by open(), asyncio objects must belong to the running loop
+        self.events = None
+        self.gpio_waiters = {}
+        self.gpio_subscriptions = {}
+
+    async def open(self):
+        loop = asyncio.get_running_loop()
+        self.lock = asyncio.Lock()
+        self.events = asyncio.Queue(maxsize=self.config.get("io_board_events_queue_size", 256))
+        (self.transport, _) = await serial_asyncio.create_serial_connection(
+            loop, lambda: AsyncIOBoard.Protocol(self), self.port, baudrate=115200)
+        return self
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.close()
+
+    def port_name(self):
+        return self.port
+
+    def data_received(self, data):
+        self.decoder.feed(data)
+        while True:
+            try:
+                frame = self.decoder.pop()
+            except IOBoard.IOBoardException as ex:
+                # v1 responses have no sequence number, the pending command gets the error
+                if (self.response is not None) and (not self.response.done()):
+                    self.response.set_exception(ex)
+                else:
+                    self.logger.warning(f"Invalid frame : {ex}")
+                continue
+
+            if frame is None:
+                break
+            self.dispatch_frame(frame)
+
+    def connection_lost(self, exc):
+        ex = IOBoard.IOBoardException(f"IO Board connection lost ({exc}) !")
+        for future in [self.response, *self.pending.values()]:
+            if (future is not None) and (not future.done()):
+                future.set_exception(ex)
+        self.pending.clear()
+
+    def dispatch_frame(self, frame):
+        (code, data, seq) = frame
+        if code == IOBoard.CommandCode.GPIO_EVENT:
+            self.dispatch_gpio_event(frame)
+            return
+
+        future = None
+        if seq is not None:
+            future = self.pending.pop(seq, None)
+        if future is None:
+            future = self.response
+
+        if (future is not None) and (not future.done()):
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug(f"RX {code} : {data}")
+            future.set_result(frame)
+        else:
+            self.publish(frame)
+
+    def dispatch_gpio_event(self, frame):
+        event = IOBoard.parse_gpio_event(frame[1], self.logger)
+        if event is None:
+            return
+
+        (gpio, value) = event
+        for (expected, future) in self.gpio_waiters.get(gpio, []):
+            if (expected == value) and (not future.done()):
+                future.set_result(True)
+
+        self.publish(frame)
+
+    def publish(self, frame):
+        # The oldest event is dropped if nobody consumes the stream
+        if self.events.full():
+            self.events.get_nowait()
+        self.events.put_nowait(frame)
+
+    async def event_stream(self):
+        while True:
+            yield await self.events.get()
+
+    def send(self, cmd_code, data, seq=None):
+        if self.transport is None:
+            raise IOBoard.IOBoardException("IO Board port not opened !")
+
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(f"TX {cmd_code} : {data}")
+        self.transport.write(bytes(self.encoder.encode(cmd_code, data, seq)))
+
+    async def send_and_receive(self, cmd_code, data=None, timeout=1, seq=None):
+        try:
+            (code, response, _) = await self.exchange(cmd_code, data, timeout, seq)
+        except (IOBoard.IOBoardException, TimeoutError):
+            # The board state is unknown after a protocol error
+            self.gpio_shadow.invalidate()
+            raise
+
+        self.gpio_shadow.invalidate_driven([(cmd_code, data)])
+        return (code, response)
+
+    async def exchange(self, cmd_code, data=None, timeout=1, seq=None):
+        # Returns the (code, data, seq) response frame
+        if data is None:
+            data = []
+
+        loop = asyncio.get_running_loop()
+
+        if (self.protocol == "v2") and (seq is None):
+            seq = self.next_seq
+            while seq in self.pending:
+                seq = ((seq % 255) + 1)
+            self.next_seq = ((seq % 255) + 1)
+
+            future = loop.create_future()
+            self.pending[seq] = future
+            try:
+                self.send(cmd_code, data, seq)
+                return await asyncio.wait_for(future, timeout)
+            except asyncio.TimeoutError:
+                raise TimeoutError("IO Board timeout !")
+            finally:
+                self.pending.pop(seq, None)
+
+        async with self.lock:
+            self.response = loop.create_future()
+            try:
+                self.send(cmd_code, data, seq)
+                return await asyncio.wait_for(self.response, timeout)
+            except asyncio.TimeoutError:
+                raise TimeoutError("IO Board timeout !")
+            finally:
+                self.response = None
+
+    async def detect_protocol(self, timeout=0.5):
+        protocol = self.config.get("io_board_protocol", "auto")
+
+        if protocol == "auto":
+            self.protocol = "v1"
+            try:
+                probe_seq = self.next_seq
+                (code, data, seq) = await self.exchange(*IOBoard.PROTOCOL_PROBE, timeout, seq=probe_seq)
+                protocol = IOBoard.probed_protocol(code, seq, probe_seq)
+            except (IOBoard.IOBoardException, TimeoutError) as ex:
+                self.logger.debug(f"IO Board protocol probe failed : {ex}")
+                protocol = "v1"
+
+        self.protocol = protocol
+        self.logger.info(f"IO Board protocol : {protocol}")
+        return protocol
+
+    async def read_id(self):
+        (code, data) = await self.send_and_receive(IOBoard.CommandCode.ID)
+        if code == IOBoard.CommandCode.ID:
+            return "".join([f"{b:02X}" for b in data])
+
+        raise IOBoard.IOBoardException(f"Invalid response ({code}:{data}) !")
+
+    async def echo(self, buff=[]):
+        (code, data) = await self.send_and_receive(IOBoard.CommandCode.ECHO, buff)
+        if code == IOBoard.CommandCode.ECHO:
+            return data
+
+        raise IOBoard.IOBoardException(f"Invalid response ({code}:{data}) !")
+
+    async def read_version(self):
+        (code, data) = await self.send_and_receive(IOBoard.CommandCode.VERSION)
+        if code == IOBoard.CommandCode.VERSION:
+            return "".join([chr(b) for b in data])
+
+        raise IOBoard.IOBoardException(f"Invalid response ({code}:{data}) !")
+
+    async def reset(self):
+        (code, data) = await self.send_and_receive(IOBoard.CommandCode.RESET, [])
+        return IOBoard.check_return_ok(code, data)
+
+    async def read_gpio(self, gpio):
+        (code, data) = await self.send_and_receive(
+            IOBoard.CommandCode.GPIO, [gpio.value])
+        if (code == IOBoard.CommandCode.GPIO) and (len(data) == 1):
+            return (data[0] != 0)
+
+        raise IOBoard.IOBoardException(f"Invalid response ({code}:{data}) !")
+
+    async def run_steps(self, steps):
+        # Same command sequences as IOBoard, concurrent with protocol v2, one after the other with v1
+        try:
+            commands = next(steps)
+            while True:
+                responses = await asyncio.gather(*[self.send_and_receive(cmd_code, data) for (cmd_code, data) in commands])
+                commands = steps.send(list(responses))
+        except StopIteration as ex:
+            return ex.value
+
+    async def read_gpio_snapshot(self):
+        return await self.run_steps(IOBoard.read_gpio_snapshot_steps(self))
+
+    async def read_gpios(self, gpios):
+        return await self.run_steps(IOBoard.read_gpios_steps(self, gpios))
+
+    def invalidate_gpio_shadow(self, gpios=None):
+        self.gpio_shadow.invalidate(gpios)
+
+    async def write_gpio(self, gpio, value, force=False):
+        return await self.write_gpios([(gpio, value)], force)
+
+    async def write_gpios(self, gpio_values, force=False):
+        return await self.run_steps(IOBoard.write_gpios_steps(self, gpio_values, force))
+
+    async def subscribe_gpio(self, gpio):
+        if not self.gpio_notify_supported:
+            return False
+
+        if self.gpio_subscriptions.get(gpio, 0) <= 0:
+            (code, data) = await self.send_and_receive(IOBoard.CommandCode.GPIO_NOTIFY, [gpio.value, 1])
+            if IOBoard.is_not_supported(code, data):
+                self.logger.warning("IO Board doesn't support GPIO notifications, fallback to polling")
+                self.gpio_notify_supported = False
+                return False
+            IOBoard.check_return_ok(code, data)
+
+        self.gpio_subscriptions[gpio] = (self.gpio_subscriptions.get(gpio, 0) + 1)
+        return True
+
+    async def unsubscribe_gpio(self, gpio):
+        self.gpio_subscriptions[gpio] = (self.gpio_subscriptions.get(gpio, 0) - 1)
+        if self.gpio_subscriptions[gpio] <= 0:
+            self.gpio_subscriptions.pop(gpio)
+            (code, data) = await self.send_and_receive(IOBoard.CommandCode.GPIO_NOTIFY, [gpio.value, 0])
+            return IOBoard.check_return_ok(code, data)
+
+        return True
+
+    async def wait_gpio(self, gpio, value, timeout=None, interval_check=0.05):
+        # Wait for a GPIO notification, fallback to polling the GPIO if the board doesn't support it.
+        # Cancel the task or give a timeout to stop waiting.
+        value = bool(value)
+
+        async def wait():
+            if await self.subscribe_gpio(gpio):
+                future = asyncio.get_running_loop().create_future()
+                waiter = (value, future)
+                self.gpio_waiters.setdefault(gpio, []).append(waiter)
+                try:
+                    # The GPIO may have changed before the notification was enabled
+                    if await self.read_gpio(gpio) == value:
+                        return True
+                    return await future
+                finally:
+                    self.gpio_waiters[gpio].remove(waiter)
+                    await self.unsubscribe_gpio(gpio)
+
+            while True:
+                if await self.read_gpio(gpio) == value:
+                    return True
+                await asyncio.sleep(interval_check)
+
+        try:
+            return await asyncio.wait_for(wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+
+    async def wait_jig(self, closed, timeout=None, interval_check=0.05):
+        return await self.wait_gpio(IOBoard.GPIO.SW_JIG_2, closed, timeout, interval_check)
@@ -0,0 +1,244 @@
+import codecs
+import collections
+import logging
+import re
+import threading
+import time
+
+import serial
+
+
+class ConsoleReader():
+    # Background reader of a serial console : blocks on the port until data arrives and splits it in real lines.
+    # The waiters are woken up by the reader and only search the new data, complete lines are searched once,
+    # the incomplete last line (a prompt) every time it grows. Patterns are matched on the lines joined by "\n"
+    # (^ and $ match at each line), a flag may span up to console_flag_max_lines lines.
+    # Positions are (line index, offset in that line), the cursor is the position of the next unread data.
+    # The oldest lines are dropped, a position before them is clamped to the first line kept.
+
+    def __init__(self, port, name="console", config={}, logger=None):
+        self.config = config
+
+        if logger is None:
+            self.logger = logging.getLogger(__name__)
+        else:
+            self.logger = logger.getChild(__name__)
+
+        self.port = port
+        self.name = name
+
+        self.lines = collections.deque(maxlen=self.config.get("console_max_lines", 10000))
+        self.first_line = 0  # Index of self.lines[0], the oldest lines are dropped
+        self.partial = ""
+        self.cursor = (0, 0)
+        self.flag_max_lines = max(1, self.config.get("console_flag_max_lines", 2))
+        self.condition = threading.Condition()
+
+        self.patterns = {}
+        self.stop_request = threading.Event()
+        self.thread = None
+
+    def start(self):
+        def reader_thread(self):
+            decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+            while not self.stop_request.is_set():
+                try:
+                    data = self.port.read(max(1, self.port.in_waiting))
+                except (serial.SerialException, OSError) as ex:
+                    if not self.stop_request.is_set():
+                        self.logger.error(f"{self.name} console read failed : {ex}")
+                    break
+                if len(data) > 0:
+                    self.feed(decoder.decode(data))
+
+        # The reader wakes up at least every timeout to check if it has to stop
+        self.port.timeout = self.config.get("console_read_timeout", 0.1)
+        self.stop_request.clear()
+        self.thread = threading.Thread(name=f"{self.name}ConsoleThread", target=reader_thread, args=(self,), daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.thread is not None:
+            self.stop_request.set()
+            self.thread.join()
+            self.thread = None
+
+    def feed(self, text):
+        with self.condition:
+            lines = (self.partial + text.replace("\r", "")).split("\n")
+            self.partial = lines.pop()
+            for line in lines:
+                if len(self.lines) == self.lines.maxlen:
+                    self.first_line += 1
+                self.lines.append(line)
+            self.condition.notify_all()
+
+    def compile(self, pattern):
+        compiled = self.patterns.get(pattern)
+        if compiled is None:
+            compiled = self.patterns[pattern] = re.compile(pattern, re.MULTILINE)
+        return compiled
+
+    def position(self):
+        with self.condition:
+            return ((self.first_line + len(self.lines)), len(self.partial))
+
+    def flush(self):
+        # Everything received so far is dropped, like serial.Serial.reset_input_buffer()
+        with self.condition:
+            self.port.reset_input_buffer()
+            self.cursor = self.position()
+
+    def clamp(self, position):
+        if position[0] < self.first_line:
+            return (self.first_line, 0)
+        return position
+
+    def lines_range(self, first, last):
+        # Lines first to last included, indexed from the end of the deque : only the recent lines are walked
+        end = (self.first_line + len(self.lines))
+        return [(self.lines[i - self.first_line] if i < end else self.partial) for i in range(first, (last + 1))]
+
+    def lines_since(self, start, end=None):
+        # Lines received between start and end, the last one may be incomplete
+        with self.condition:
+            if end is None:
+                end = self.position()
+            (line_index, offset) = self.clamp(start)
+            (end_index, end_offset) = self.clamp(end)
+            if end_index < line_index:
+                return []
+            lines = self.lines_range(line_index, end_index)
+            lines[-1] = lines[-1][:end_offset]
+            lines[0] = lines[0][offset:]
+            return lines
+
+    def search(self, patterns, start, searched):
+        # Searches the text from the line index searched, returns the earliest match, its end position and the next line to search.
+        # The previous (console_flag_max_lines - 1) lines are searched again for the flags spanning a line break.
+        (line_index, offset) = self.clamp(start)
+        end = (self.first_line + len(self.lines))
+        first = max((searched - self.flag_max_lines + 1), line_index)
+        text = "\n".join(self.lines_range(first, end))
+        found = None
+        for pattern in patterns:
+            match = pattern.search(text, (offset if first == line_index else 0))
+            if (match is not None) and ((found is None) or (match.start() < found.start())):
+                found = match
+        if found is None:
+            return (None, None, end)
+
+        match_line = (first + text.count("\n", 0, found.end()))
+        return (found, (match_line, (found.end() - (text.rfind("\n", 0, found.end()) + 1))), end)
+
+    def wait(self, end_flags, timeout, start=None):
+        # First end flag received after start and the position of its end, (None, None) on timeout
+        patterns = [self.compile(flag) for flag in end_flags]
+        deadline = (time.time() + timeout)
+        with self.condition:
+            if start is None:
+                start = self.cursor
+            searched = start[0]
+            while True:
+                if len(patterns) > 0:
+                    (match, match_end, searched) = self.search(patterns, start, searched)
+                    if match is not None:
+                        return (match, match_end)
+
+                remaining = (deadline - time.time())
+                if remaining <= 0:
+                    return (None, None)
+                self.condition.wait(remaining)
+
+    def wait_data(self, position, timeout):
+        # Waits for data received after position, False on timeout
+        with self.condition:
+            return self.condition.wait_for((lambda: self.position() != position), timeout)
+
+    def wait_quiet(self, quiet, timeout):
+        # Waits until nothing is received for quiet seconds, False if the data is still coming at the timeout
+        deadline = (time.time() + timeout)
+        with self.condition:
+            while True:
+                remaining = (deadline - time.time())
+                if remaining < quiet:
+                    return False
+                if not self.condition.wait(quiet):
+                    return True
+
+    @staticmethod
+    def strip_lines(lines):
+        return [line.strip() for line in lines if len(line.strip()) > 0]
+
+    def read_lines(self, timeout=1, end_flags=[]):
+        # Unread lines, until one of the end flags is received or the timeout.
+        # Lines are stripped and the empty ones skipped, everything returned is marked as read.
+        with self.condition:
+            self.wait(end_flags, timeout)
+            lines = self.lines_since(self.cursor)
+            self.cursor = self.position()
+        return ConsoleReader.strip_lines(lines)
+
+    def expect(self, end_flags, timeout):
+        # Unread lines up to the end of the first end flag received, what follows stays unread.
+        # On timeout the match is None and every line received is returned.
+        with self.condition:
+            (match, match_end) = self.wait(end_flags, timeout)
+            lines = self.lines_since(self.cursor, match_end)
+            self.cursor = (self.position() if match_end is None else match_end)
+        return (match, ConsoleReader.strip_lines(lines))
+
+
+class ShellSession():
+    # Expect style session on the shell behind a console.
+    # run() echoes the exit status of the command after a tag only the shell output can match
+    # (the echo of the command line has quotes in the middle of it), the command ends as soon as it is received.
+    ESCAPE_SEQUENCE_PATTERN = re.compile(r"\x1b\[[0-9;?]*[A-Za-z]")  # Bracketed paste mode, colors...
+
+    def __init__(self, console, config={}, logger=None):
+        self.config = config
+
+        if logger is None:
+            self.logger = logging.getLogger(__name__)
+        else:
+            self.logger = logger.getChild(__name__)
+
+        self.console = console
+        self.tag_nb = 0
+
+    def send(self, command, log=True):
+        if log:
+            self.logger.debug(f"TX: {command}")
+        if type(command) is bytes:
+            self.console.port.write(command)
+        else:
+            self.console.port.write(f"{command}\n".encode())
+
+    def expect(self, patterns, timeout, log=True):
+        (match, lines) = self.console.expect(patterns, timeout)
+        if log:
+            for line in lines:
+                self.logger.debug(f"RX: {line}")
+        return (match, lines)
+
+    def run(self, command, timeout, log=True):
+        # Output lines joined by "\n" and exit status of the command, None if it didn't end before the timeout
+        self.tag_nb += 1
+        tag = f"@@EXIT{self.tag_nb}"
+        self.send(f'{command}; echo "{tag}""=$?"', log)
+        (match, lines) = self.expect([(re.escape(tag) + r"=(\d+)")], timeout, log)
+
+        # Drop everything up to the echo of the command line (echoed twice if it was typed ahead), and the exit status
+        lines = [ShellSession.ESCAPE_SEQUENCE_PATTERN.sub("", line) for line in lines]
+        for n in range((len(lines) - 1), -1, -1):
+            if f'{tag}""=' in lines[n]:
+                lines = lines[(n + 1):]
+                break
+        if match is None:
+            return ("\n".join(lines), None)
+
+        lines[-1] = lines[-1][:-len(match.group(0))].strip()
+        if len(lines[-1]) <= 0:
+            lines.pop()
+        return ("\n".join(lines), int(match.group(1)))
@@ -0,0 +1,57 @@
+import comm_test_CM4
+
+CommTest = comm_test_CM4.CommTest
+
+VALUES = {
+    "cpu_serial": "10000000a1b2c3d4",
+    "ethernet_mac_address": "dc:a6:32:01:02:03",
+    "wifi_mac_address": "DC:A6:32:01:02:04",
+    "registration_id": ("AbC123" * 9)[:52],
+    "endorsment_key": ("-----BEGIN PUBLIC KEY----- " * 16)[:424],
+    "cam_serial": "12345678",
+}
+
+LINES = [
+    "pego@CM4:~$ ./CM4_ID_script.sh",
+    f"CPU_Serial : {VALUES['cpu_serial']}",
+    f"Ethermet_mac_address: {VALUES['ethernet_mac_address']}",
+    f"Wifi_mac_address :{VALUES['wifi_mac_address']}",
+    f"Registration_ID : {VALUES['registration_id']}",
+    f"Endorsment_Key : {VALUES['endorsment_key']}",
+    f"Cam_serial : {VALUES['cam_serial']}",
+    "pego@CM4:~$ ",
+]
+
+
+def test_parse_every_field():
+    fields = CommTest.parse_cm4_identity(LINES)
+    assert fields == VALUES
+    assert CommTest.CM4Identity(**fields)._asdict() == VALUES
+
+
+def test_wifi_not_enabled():
+    lines = [line for line in LINES if not line.startswith("Wifi")] + ["Wifi_mac_address : WIFI NOT ENABLED"]
+    assert CommTest.parse_cm4_identity(lines)["wifi_mac_address"] == CommTest.WIFI_NOT_ENABLED
+
+
+def test_several_keys_on_one_line():
+    line = f"CPU_Serial : {VALUES['cpu_serial']} Cam_serial : {VALUES['cam_serial']}"
+    assert CommTest.parse_cm4_identity([line]) == {"cpu_serial": VALUES["cpu_serial"], "cam_serial": VALUES["cam_serial"]}
+
+
+def test_invalid_values_are_missing():
+    lines = [
+        "CPU_Serial : 10000000a1b2",  # Truncated
+        "Ethermet_mac_address : dc:a6:32:01:02",
+        "Cam_serial : 1234ABCD",
+        f"Endorsment_Key : {VALUES['endorsment_key'][:100]}",
+    ]
+    assert CommTest.parse_cm4_identity(lines) == {}
+
+
+def test_known_fields_are_kept():
+    # Values already read are not overwritten by a later read
+    known = {"cpu_serial": VALUES["cpu_serial"]}
+    fields = CommTest.parse_cm4_identity(["CPU_Serial : ffffffffffffffff", f"Cam_serial : {VALUES['cam_serial']}"], known)
+    assert fields == {"cpu_serial": VALUES["cpu_serial"], "cam_serial": VALUES["cam_serial"]}
+    assert known == {"cpu_serial": VALUES["cpu_serial"]}
@@ -0,0 +1,74 @@
+import numpy
+import pytest
+
+import dpm802
+
+DPM802 = dpm802.DPM802
+Function = DPM802.Function
+
+
+def frame(range_code, digits, function, negative=False):
+    # range, 4 digits, function, status, 2 option bytes and "\r\n"
+    status = (0b0110000 | (0b100 if negative else 0))
+    return bytes([range_code, *[(0b0110000 + int(digit)) for digit in digits], function.value, status, 0b0110000, 0b0110000]) + b"\r\n"
+
+
+def test_decode_frame():
+    assert DPM802.decode_frame(frame(0b0110001, "1234", Function.VOLTAGE)) == (Function.VOLTAGE, pytest.approx(1.234))
+    assert DPM802.decode_frame(frame(0b0110011, "0420", Function.VOLTAGE, negative=True)) == (Function.VOLTAGE, pytest.approx(-42.0))
+    # Every current is returned in mA
+    assert DPM802.decode_frame(frame(0b0110001, "1500", Function.CURRENT_UA)) == (Function.CURRENT_MA, pytest.approx(1.5))
+    assert DPM802.decode_frame(frame(0b0110000, "0250", Function.CURRENT_A)) == (Function.CURRENT_MA, pytest.approx(2500))
+
+
+def test_decode_frame_at_offset():
+    buff = (b"garbage" + frame(0b0110010, "0999", Function.VOLTAGE))
+    assert DPM802.decode_frame(memoryview(buff), 7) == (Function.VOLTAGE, pytest.approx(9.99))
+
+
+@pytest.mark.parametrize("raw", [
+    frame(0b0110010, "0999", Function.CURRENT_UA),  # No such range for this function
+    frame(0b0110001, "1234", Function.ADP0),
+    frame(0b0110001, "1234", Function.VOLTAGE).replace(b"1", b"?", 1),  # Invalid digit
+])
+def test_decode_frame_invalid(raw):
+    with pytest.raises(DPM802.DPM802Exception):
+        DPM802.decode_frame(raw)
+
+
+def test_decode_many_matches_decode_frame():
+    frames = [
+        frame(0b0110000, "0001", Function.VOLTAGE),
+        frame(0b0110001, "1234", Function.VOLTAGE, negative=True),
+        frame(0b0110100, "0012", Function.VOLTAGE),
+        frame(0b0110000, "9999", Function.CURRENT_UA),
+        frame(0b0110001, "0100", Function.CURRENT_MA),
+        frame(0b0110000, "0003", Function.CURRENT_A, negative=True),
+    ]
+    (functions, values) = DPM802.decode_many(b"".join(frames))
+    measures = [DPM802.decode_frame(raw) for raw in frames]
+    assert list(functions) == [measure.function.value for measure in measures]
+    assert numpy.allclose(values, [measure.value for measure in measures])
+
+
+def test_decode_many_skips_invalid_lines():
+    valid = frame(0b0110001, "1234", Function.VOLTAGE)
+    capture = b"".join([
+        valid[3:],  # Partial frame at the start of the capture
+        valid,
+        frame(0b0110001, "1234", Function.ADP0),  # Unknown scale
+        valid.replace(b"1", b"?", 1),  # Invalid digit
+        b"not a frame\r\n",
+        b"short\r\n",
+        frame(0b0110001, "0042", Function.VOLTAGE),
+        valid[:5],  # Partial frame at the end of the capture
+    ])
+    (functions, values) = DPM802.decode_many(capture)
+    assert list(functions) == [Function.VOLTAGE.value, Function.VOLTAGE.value]
+    assert numpy.allclose(values, [1.234, 0.042])
+
+
+def test_decode_many_empty():
+    (functions, values) = DPM802.decode_many(b"")
+    assert len(functions) == 0
+    assert len(values) == 0
@@ -0,0 +1,156 @@
+import logging
+import types
+
+import pytest
+
+import io_board
+
+IOBoard = io_board.IOBoard
+CommandCode = IOBoard.CommandCode
+GPIO = IOBoard.GPIO
+
+OK = (CommandCode.RETURN, [IOBoard.CommandRetCode.OK.value])
+UNKNOWN = (CommandCode.RETURN, [IOBoard.CommandRetCode.CMD_UNKNOW.value])
+ERROR = (CommandCode.RETURN, [IOBoard.CommandRetCode.GENERIC.value])
+
+
+def fake_board(batched=True, shadow=True, max_gpios=16):
+    # Only what write_gpios_steps() uses
+    return types.SimpleNamespace(gpio_shadow=IOBoard.GPIOShadow(shadow), batched_gpios_supported=batched,
+                                 config={"io_board_max_gpios_per_frame": max_gpios}, logger=logging.getLogger(__name__))
+
+
+def run(steps, respond=(lambda cmd_code, data: OK)):
+    # Same as IOBoard.run_steps(), returns the result and the commands of each round trip
+    round_trips = []
+    try:
+        commands = next(steps)
+        while True:
+            round_trips.append(commands)
+            commands = steps.send([respond(cmd_code, data) for (cmd_code, data) in commands])
+    except StopIteration as ex:
+        return (ex.value, round_trips)
+
+
+def write(board, gpio_values, force=False, respond=(lambda cmd_code, data: OK)):
+    return run(IOBoard.write_gpios_steps(board, gpio_values, force), respond)
+
+
+def test_filter_skips_unchanged_values():
+    shadow = IOBoard.GPIOShadow()
+    shadow.update([(GPIO.GP0, 1), (GPIO.GP1, 0)])
+    assert shadow.filter([(GPIO.GP0, 1), (GPIO.GP1, 1), (GPIO.GP2, 0)]) == [(GPIO.GP1, 1), (GPIO.GP2, 0)]
+
+
+def test_filter_skips_duplicates_of_the_same_write():
+    shadow = IOBoard.GPIOShadow()
+    assert shadow.filter([(GPIO.GP0, 1), (GPIO.GP0, 1), (GPIO.GP0, 0)]) == [(GPIO.GP0, 1), (GPIO.GP0, 0)]
+
+
+def test_filter_does_not_update_the_shadow():
+    # Only the acknowledged writes are remembered
+    shadow = IOBoard.GPIOShadow()
+    shadow.filter([(GPIO.GP0, 1)])
+    assert shadow.values == {}
+    assert shadow.filter([(GPIO.GP0, 1)]) == [(GPIO.GP0, 1)]
+
+
+def test_force_and_disabled_bypass_the_filter():
+    shadow = IOBoard.GPIOShadow()
+    shadow.update([(GPIO.GP0, 1)])
+    assert shadow.filter([(GPIO.GP0, 1)], force=True) == [(GPIO.GP0, 1)]
+
+    shadow = IOBoard.GPIOShadow(enabled=False)
+    shadow.update([(GPIO.GP0, 1)])
+    assert shadow.filter([(GPIO.GP0, 1), (GPIO.GP0, 1)]) == [(GPIO.GP0, 1), (GPIO.GP0, 1)]
+
+
+def test_invalidate():
+    shadow = IOBoard.GPIOShadow()
+    shadow.update([(GPIO.GP0, 1), (GPIO.GP1, 1), (GPIO.GP2, 1)])
+    shadow.invalidate([GPIO.GP0, GPIO.GP3])
+    assert shadow.values == {GPIO.GP1: 1, GPIO.GP2: 1}
+    shadow.invalidate()
+    assert shadow.values == {}
+
+
+def test_invalidate_driven():
+    shadow = IOBoard.GPIOShadow()
+    written = [(GPIO.A0_SWA, 1), (GPIO.A1_SWA, 1), (GPIO.A2_SWA, 1), (GPIO.GPIO_SEL1_DMM1, 1), (GPIO.GPIO_SEL1_DMM2, 1), (GPIO.GP0, 1)]
+    shadow.update(written)
+
+    shadow.invalidate_driven([(CommandCode.GPIO, [GPIO.GP1.value, 1]), (CommandCode.ADC, [0])])
+    assert shadow.values == dict(written)
+
+    shadow.invalidate_driven([(CommandCode.SCAN, [0, 1, 2])])
+    assert shadow.values == {GPIO.GPIO_SEL1_DMM1: 1, GPIO.GPIO_SEL1_DMM2: 1, GPIO.GP0: 1}
+
+    shadow.invalidate_driven([(CommandCode.DPM_AMMETER1, [])])
+    assert shadow.values == {GPIO.GPIO_SEL1_DMM2: 1, GPIO.GP0: 1}
+
+    shadow.invalidate_driven([(CommandCode.RESET, [])])
+    assert shadow.values == {}
+
+
+def test_check_write_ok_failure_clears_the_shadow():
+    shadow = IOBoard.GPIOShadow()
+    shadow.update([(GPIO.GP0, 1)])
+    assert shadow.check_write_ok(*OK)
+    assert shadow.values == {GPIO.GP0: 1}
+    with pytest.raises(IOBoard.IOBoardException):
+        shadow.check_write_ok(*ERROR)
+    assert shadow.values == {}
+
+
+def test_write_skips_unchanged_gpios():
+    board = fake_board()
+    gpio_values = [(GPIO.GP0, 1), (GPIO.GP1, 0), (GPIO.GP2, 1)]
+    assert write(board, gpio_values) == (True, [[(CommandCode.GPIOS, [GPIO.GP0.value, 1, GPIO.GP1.value, 0, GPIO.GP2.value, 1])]])
+    assert board.gpio_shadow.writes_avoided == 0
+
+    # Nothing changed : no round trip, one GPIOS frame avoided
+    assert write(board, gpio_values) == (True, [])
+    assert board.gpio_shadow.writes_avoided == 1
+
+    # A single GPIO changed : one GPIO frame instead of one GPIOS frame, no frame avoided
+    assert write(board, [(GPIO.GP0, 1), (GPIO.GP1, 1), (GPIO.GP2, 1)]) == (True, [[(CommandCode.GPIO, [GPIO.GP1.value, 1])]])
+    assert board.gpio_shadow.writes_avoided == 1
+
+    # Forced writes are always sent
+    assert write(board, [(GPIO.GP0, 1)], force=True) == (True, [[(CommandCode.GPIO, [GPIO.GP0.value, 1])]])
+    assert board.gpio_shadow.writes_avoided == 1
+
+
+def test_write_counts_frames_not_gpios():
+    board = fake_board(max_gpios=2)
+    gpio_values = [(GPIO.GP0, 1), (GPIO.GP1, 1), (GPIO.GP2, 1), (GPIO.GP3, 1), (GPIO.GP4, 1)]
+    (result, round_trips) = write(board, gpio_values)
+    assert [cmd_code for commands in round_trips for (cmd_code, data) in commands] == [CommandCode.GPIOS] * 3
+
+    # 3 GPIOS frames -> 1 GPIOS frame
+    write(board, (gpio_values[:3] + [(GPIO.GP3, 0), (GPIO.GP4, 0)]))
+    assert board.gpio_shadow.writes_avoided == 2
+
+    # Single writes : one frame per GPIO
+    board = fake_board(batched=False)
+    write(board, gpio_values)
+    write(board, gpio_values[:2] + [(GPIO.GP2, 0)])
+    assert board.gpio_shadow.writes_avoided == 2
+
+
+def test_write_failure_is_not_remembered():
+    board = fake_board()
+    with pytest.raises(IOBoard.IOBoardException):
+        write(board, [(GPIO.GP0, 1), (GPIO.GP1, 1)], respond=(lambda cmd_code, data: ERROR))
+    assert board.gpio_shadow.values == {}
+    assert write(board, [(GPIO.GP0, 1)])[1] == [[(CommandCode.GPIO, [GPIO.GP0.value, 1])]]
+
+
+def test_write_fallback_to_single_writes():
+    board = fake_board()
+    responses = {CommandCode.GPIOS: UNKNOWN, CommandCode.GPIO: OK}
+    (result, round_trips) = write(board, [(GPIO.GP0, 1), (GPIO.GP1, 1)], respond=(lambda cmd_code, data: responses[cmd_code]))
+    assert result
+    assert not board.batched_gpios_supported
+    assert round_trips[1] == [(CommandCode.GPIO, [GPIO.GP0.value, 1]), (CommandCode.GPIO, [GPIO.GP1.value, 1])]
+    assert board.gpio_shadow.values == {GPIO.GP0: 1, GPIO.GP1: 1}
@@ -0,0 +1,124 @@
+import random
+
+import pytest
+
+import io_board
+
+IOBoard = io_board.IOBoard
+CommandCode = IOBoard.CommandCode
+
+
+def frame(cmd_code, data, seq=None):
+    # Reference encoder, independent of IOBoard.FrameEncoder
+    if seq is None:
+        raw = [cmd_code.value] + list(data)
+    else:
+        raw = [cmd_code.value | IOBoard.V2_FLAG, seq] + list(data)
+    crc = (sum(raw) & 0xFF)  # The v2 flag and the sequence number are part of the CRC
+    buff = bytearray([IOBoard.SOF])
+    for b in (raw + [crc]):
+        if b in (IOBoard.SOF, IOBoard.ESC, IOBoard.EOF):
+            buff.append(IOBoard.ESC)
+        buff.append(b)
+    buff.append(IOBoard.EOF)
+    return bytes(buff)
+
+
+def decode(*chunks):
+    decoder = IOBoard.FrameDecoder()
+    for chunk in chunks:
+        decoder.feed(chunk)
+    return list(decoder)
+
+
+def test_single_frame():
+    assert decode(frame(CommandCode.RETURN, [0x01])) == [(CommandCode.RETURN, [0x01], None)]
+    assert decode(frame(CommandCode.VERSION, [])) == [(CommandCode.VERSION, [], None)]
+
+
+def test_escaped_bytes():
+    data = [IOBoard.SOF, IOBoard.ESC, IOBoard.EOF, 0x00, IOBoard.EOF]
+    assert decode(frame(CommandCode.ECHO, data)) == [(CommandCode.ECHO, data, None)]
+
+
+def test_escaped_crc():
+    # 0x30 + RETURN + 0x03 : the CRC itself is ESC
+    assert decode(frame(CommandCode.RETURN, [0x30, 0x03])) == [(CommandCode.RETURN, [0x30, 0x03], None)]
+
+
+def test_v2_frame():
+    assert decode(frame(CommandCode.GPIO, [5, 1], seq=42)) == [(CommandCode.GPIO, [5, 1], 42)]
+    assert decode(frame(CommandCode.GPIO, [5], seq=IOBoard.SOF)) == [(CommandCode.GPIO, [5], IOBoard.SOF)]
+
+
+def test_frame_split_across_reads():
+    raw = frame(CommandCode.ECHO, [1, IOBoard.ESC, 2, IOBoard.SOF, 3], seq=7)
+    for cut in range(1, len(raw)):
+        assert decode(raw[:cut], raw[cut:]) == [(CommandCode.ECHO, [1, IOBoard.ESC, 2, IOBoard.SOF, 3], 7)]
+    assert decode(*[raw[i:(i + 1)] for i in range(len(raw))]) == [(CommandCode.ECHO, [1, IOBoard.ESC, 2, IOBoard.SOF, 3], 7)]
+
+
+def test_several_frames_in_one_read():
+    raw = frame(CommandCode.RETURN, [0xFF]) + frame(CommandCode.GPIO, [3], seq=1) + frame(CommandCode.ADC, [1, 2, 3])
+    assert decode(raw) == [
+        (CommandCode.RETURN, [0xFF], None),
+        (CommandCode.GPIO, [3], 1),
+        (CommandCode.ADC, [1, 2, 3], None),
+    ]
+
+
+def test_garbage_before_frame():
+    assert decode(b"\x00\x12" + bytes([IOBoard.EOF]) + frame(CommandCode.RETURN, [0x01])) == [(CommandCode.RETURN, [0x01], None)]
+
+
+def test_unescaped_sof_restarts_frame():
+    truncated = frame(CommandCode.ECHO, [1, 2, 3])[:-3]
+    assert decode(truncated + frame(CommandCode.RETURN, [0x01])) == [(CommandCode.RETURN, [0x01], None)]
+
+
+def test_crc_error():
+    decoder = IOBoard.FrameDecoder()
+    raw = bytearray(frame(CommandCode.RETURN, [0x01]))
+    raw[-2] ^= 0x01
+    decoder.feed(bytes(raw) + frame(CommandCode.RETURN, [0x02]))
+    assert decoder.crc_errors == 1
+    with pytest.raises(IOBoard.IOBoardException):
+        decoder.pop()
+    # The next frame is still decoded
+    assert decoder.pop() == (CommandCode.RETURN, [0x02], None)
+    assert decoder.pop() is None
+
+
+def test_unknown_command_code():
+    decoder = IOBoard.FrameDecoder()
+    decoder.feed(bytes([IOBoard.SOF, 0x70, 0x01, 0x71, IOBoard.EOF]))
+    with pytest.raises(IOBoard.IOBoardException):
+        decoder.pop()
+    assert decoder.crc_errors == 0
+
+
+def test_truncated_v2_frame():
+    decoder = IOBoard.FrameDecoder()
+    code = (CommandCode.GPIO.value | IOBoard.V2_FLAG)
+    decoder.feed(bytes([IOBoard.SOF, code, code, IOBoard.EOF]))
+    with pytest.raises(IOBoard.IOBoardException):
+        decoder.pop()
+
+
+def test_too_short_frames_are_dropped():
+    assert decode(bytes([IOBoard.SOF, IOBoard.EOF, IOBoard.SOF, 0x01, IOBoard.EOF])) == []
+
+
+def test_fast_path_matches_stream_decoding():
+    # The same frames fed one per read (fast path) or as a single stream must give the same result
+    rng = random.Random(1234)
+    codes = [code for code in CommandCode if code != CommandCode.GPIO_EVENT]
+    frames = []
+    for _ in range(500):
+        data = [rng.choice([0, 1, IOBoard.SOF, IOBoard.ESC, IOBoard.EOF, rng.randrange(256)]) for _ in range(rng.randrange(5))]
+        seq = (rng.randrange(256) if rng.random() < 0.3 else None)
+        frames.append(frame(rng.choice(codes), data, seq))
+
+    expected = decode(b"".join(frames))
+    assert len(expected) == len(frames)
+    assert decode(*frames) == expected
@@ -0,0 +1,52 @@
+import pytest
+
+import io_board
+
+IOBoard = io_board.IOBoard
+CommandCode = IOBoard.CommandCode
+
+
+def decode(raw):
+    decoder = IOBoard.FrameDecoder()
+    decoder.feed(bytes(raw))
+    return list(decoder)
+
+
+def test_frame_layout():
+    encoder = IOBoard.FrameEncoder()
+    assert bytes(encoder.build(CommandCode.GPIO, [0x10, 0x01])) == bytes([IOBoard.SOF, 0x05, 0x10, 0x01, 0x16, IOBoard.EOF])
+    assert bytes(encoder.build(CommandCode.GPIO, [0x10], seq=2)) == bytes([IOBoard.SOF, 0x85, 0x02, 0x10, 0x97, IOBoard.EOF])
+
+
+def test_special_bytes_are_escaped():
+    encoder = IOBoard.FrameEncoder()
+    raw = bytes(encoder.build(CommandCode.ECHO, [IOBoard.SOF, 0x01, IOBoard.ESC, IOBoard.EOF]))
+    assert raw == bytes([IOBoard.SOF, 0x03, IOBoard.ESC, IOBoard.SOF, 0x01, IOBoard.ESC, IOBoard.ESC,
+                         IOBoard.ESC, IOBoard.EOF, 0x02, IOBoard.EOF])
+
+
+@pytest.mark.parametrize("seq", [None, 0, 1, IOBoard.SOF, IOBoard.ESC, IOBoard.EOF, 0x7F])
+@pytest.mark.parametrize("data", [[], [0x00], [IOBoard.SOF, IOBoard.ESC, IOBoard.EOF], list(range(256))])
+def test_round_trip(seq, data):
+    encoder = IOBoard.FrameEncoder()
+    for cmd_code in CommandCode:
+        assert decode(encoder.encode(cmd_code, data, seq)) == [(cmd_code, data, seq)]
+
+
+def test_cached_frames():
+    encoder = IOBoard.FrameEncoder()
+    for gpio in IOBoard.GPIO:
+        for data in ([gpio.value], [gpio.value, 0], [gpio.value, 1]):
+            frame = encoder.encode(CommandCode.GPIO, data)
+            assert isinstance(frame, bytes)
+            assert frame is encoder.encode(CommandCode.GPIO, data)
+            assert frame == bytes(IOBoard.FrameEncoder().build(CommandCode.GPIO, data))
+
+    for name in IOBoard.FrameEncoder.FIXED_COMMANDS:
+        assert encoder.encode(CommandCode[name], []) == bytes(IOBoard.FrameEncoder().build(CommandCode[name], []))
+
+
+def test_v2_frames_are_not_cached():
+    encoder = IOBoard.FrameEncoder()
+    assert decode(encoder.encode(CommandCode.GPIO, [0, 1], seq=3)) == [(CommandCode.GPIO, [0, 1], 3)]
+    assert decode(encoder.encode(CommandCode.RESET, [], seq=4)) == [(CommandCode.RESET, [], 4)]
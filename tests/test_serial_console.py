@@ -0,0 +1,137 @@
+import threading
+import time
+
+import serial_console
+
+ConsoleReader = serial_console.ConsoleReader
+
+
+class DummyPort():
+    # Never read : the tests feed the reader directly
+    in_waiting = 0
+    timeout = 0.1
+
+    def reset_input_buffer(self):
+        pass
+
+
+def console(**config):
+    return ConsoleReader(DummyPort(), config=config)
+
+
+def test_lines_are_split_on_line_breaks():
+    reader = console()
+    reader.feed("first li")
+    reader.feed("ne\r\nsecond\r\npego@CM4:~$ ")
+    assert list(reader.lines) == ["first line", "second"]
+    assert reader.partial == "pego@CM4:~$ "
+    assert reader.lines_since((0, 0)) == ["first line", "second", "pego@CM4:~$ "]
+    assert reader.lines_since((0, 6), (1, 3)) == ["line", "sec"]
+
+
+def test_expect_leaves_the_rest_unread():
+    reader = console()
+    reader.feed("a\nDONE 1\nb\nDONE 2\n")
+    (match, lines) = reader.expect([r"DONE \d"], 0)
+    assert match.group(0) == "DONE 1"
+    assert lines == ["a", "DONE 1"]
+    (match, lines) = reader.expect([r"DONE \d"], 0)
+    assert match.group(0) == "DONE 2"
+    assert lines == ["b", "DONE 2"]
+
+
+def test_expect_timeout_returns_every_line():
+    reader = console()
+    reader.feed("a\nb\npartial")
+    assert reader.expect([r"never"], 0.01) == (None, ["a", "b", "partial"])
+    assert reader.expect([r"never"], 0) == (None, [])
+
+
+def test_earliest_flag_wins():
+    reader = console()
+    reader.feed("x\nsecond\nfirst\n")
+    (match, lines) = reader.expect([r"first", r"second"], 0)
+    assert match.group(0) == "second"
+
+
+def test_flag_in_the_prompt():
+    # The incomplete last line is searched too
+    reader = console()
+    reader.feed("output\npego@CM4:~$ ")
+    (match, lines) = reader.expect([r"pego@CM4:~"], 0)
+    assert lines == ["output", "pego@CM4:~"]
+
+
+def test_flag_spanning_a_line_break():
+    reader = console()
+    reader.feed("Pod provision script\nfinished with Serial 42\n")
+    (match, lines) = reader.expect([r"script\s*finished\s*with\s*Serial\s*42"], 0)
+    assert match is not None
+    assert lines == ["Pod provision script", "finished with Serial 42"]
+
+
+def test_flag_spanning_lines_received_later():
+    reader = console()
+
+    def receive():
+        time.sleep(0.05)
+        reader.feed("Image\n")
+        time.sleep(0.05)
+        reader.feed("Captured\n")
+
+    thread = threading.Thread(target=receive)
+    thread.start()
+    (match, lines) = reader.expect([r"Image\s*Captured"], 2)
+    thread.join()
+    assert match is not None
+    assert lines == ["Image", "Captured"]
+
+
+def test_flag_longer_than_flag_max_lines():
+    # Only the lines already searched are limited, a flag received at once may span any number of lines
+    reader = console(console_flag_max_lines=2)
+    reader.feed("one\ntwo\nthree\n")
+    assert reader.wait([r"one\ntwo\nthree"], 0)[0] is not None
+
+    reader.feed("four\n")
+    start = reader.position()
+    reader.feed("one\n")
+
+    def receive():
+        for line in ["two\n", "three\n"]:
+            time.sleep(0.05)
+            reader.feed(line)
+
+    thread = threading.Thread(target=receive)
+    thread.start()
+    assert reader.wait([r"one\ntwo\nthree"], 0.3, start) == (None, None)
+    thread.join()
+
+
+def test_anchors_match_at_each_line():
+    reader = console()
+    reader.feed("xx OK\n  OK\n")
+    (match, lines) = reader.expect([r"^\s*OK$"], 0)
+    assert lines == ["xx OK", "OK"]
+    reader.feed("^C\n")
+    (match, lines) = reader.expect([r"^\^C$"], 0)
+    assert match is not None
+
+
+def test_dropped_lines_are_clamped():
+    reader = console(console_max_lines=5)
+    reader.feed("".join(f"l{i}\n" for i in range(20)))
+    assert reader.first_line == 15
+    assert reader.clamp((3, 2)) == (15, 0)
+    assert reader.lines_since((0, 3)) == ["l15", "l16", "l17", "l18", "l19", ""]
+    assert reader.lines_since((0, 0), (1, 2)) == [""]
+    assert reader.read_lines(0) == ["l15", "l16", "l17", "l18", "l19"]
+
+
+def test_flush_marks_everything_as_read():
+    reader = console()
+    reader.feed("old\nDONE\n")
+    reader.flush()
+    assert reader.expect([r"DONE"], 0) == (None, [])
+    reader.feed("DONE\n")
+    assert reader.expect([r"DONE"], 0)[1] == ["DONE"]